@@ -0,0 +1,50 @@
+# coding=utf-8
+"""
+    Decoding time of a ~5 MB JSON request body with the different
+    `JSON_PARSE_DATES` modes.
+
+        python benchmarks/bench_json_decode.py
+
+"""
+from __future__ import print_function
+import datetime
+import os
+import sys
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shake.serializers import encode_json, from_json, get_json_decoder
+
+
+def make_payload(size=5 * 1024 * 1024):
+    item = {
+        'name': u'Lorem ipsum dolor sit amet',
+        'email': 'someone@example.com',
+        'created_at': datetime.datetime(2013, 1, 2, 3, 4, 5),
+        'birthday': datetime.date(1980, 1, 2),
+        'tags': ['foo', 'bar', 'baz'],
+        'score': 3.1415,
+        'active': True,
+    }
+    size_item = len(encode_json(item)) + 1
+    return encode_json({'items': [item] * (size // size_item)})
+
+
+def main():
+    payload = make_payload()
+    print('Payload size: %.1f MB' % (len(payload) / 1024.0 / 1024.0))
+    modes = (
+        ('plain', False),
+        ('dates (all keys)', True),
+        ('dates (some keys)', ['created_at', 'birthday']),
+    )
+    for name, parse_dates in modes:
+        hook = get_json_decoder(parse_dates)
+        best = min(repeat(lambda: from_json(payload, object_hook=hook),
+            number=1, repeat=5))
+        print('%-20s %8.1f ms' % (name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+# coding=utf-8
+"""
+    End-to-end throughput of the request hot path, measured through
+    `Shake.__call__` with synthetic WSGI environs (no server, no network).
+
+        python benchmarks/bench_requests.py
+        python benchmarks/bench_requests.py --json results.json
+        python benchmarks/bench_requests.py --compare baseline.json
+
+    With `--compare`, the results are checked against a stored baseline
+    (the output of a previous `--json` run) and the exit status is 1 if any
+    case is slower than the baseline by more than `--threshold` percent.
+
+    With `--json -` the JSON is the only thing written to stdout; the
+    progress and the comparison go to stderr.
+
+"""
+from __future__ import print_function
+import argparse
+from io import BytesIO
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from timeit import default_timer as clock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.test import EnvironBuilder
+
+import shake
+from shake import Shake, send_file
+
+
+SETTINGS = {
+    # Measure the production paths (eg: the 404 page without the rules)
+    'DEBUG': False,
+    'SERVER_NAME': 'localhost',
+    'SECRET_KEY': 'benchmark-secret-key-benchmark-secret-key',
+}
+
+URL_FOR_TMPL = u'''<ul>
+{%- for i in range(200) %}
+<li><a href="{{ url_for('item', id=i) }}">{{ i }}</a></li>
+{%- endfor %}
+</ul>'''
+
+
+def get_environ(path='/', **kwargs):
+    kwargs.setdefault('base_url', 'http://localhost/')
+    builder = EnvironBuilder(path, **kwargs)
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    # The body is read once and then fed again to every request
+    environ['wsgi.input'] = environ['wsgi.input'].read()
+    return environ
+
+
+def new_app(**settings):
+    config = dict(SETTINGS, **settings)
+    return Shake(__file__, config)
+
+
+def case_hello_world(tmp):
+    app = new_app()
+    app.add_url('/', lambda request: u'Hello world')
+    return app, get_environ('/')
+
+
+def case_json(tmp):
+    app = new_app()
+    data = {
+        'id': 123,
+        'name': u'Lorem ipsum dolor sit amet',
+        'tags': ['foo', 'bar', 'baz'],
+        'items': [{'n': i, 'ok': i % 2 == 0} for i in range(20)],
+    }
+    app.add_url('/', lambda request: data)
+    return app, get_environ('/')
+
+
+def case_url_for(tmp):
+    app = new_app()
+    tmpl = app.render.env.from_string(URL_FOR_TMPL)
+
+    def index(request):
+        return app.render.render(tmpl)
+
+    def item(request, id):
+        return u''
+
+    app.add_url('/', index)
+    app.add_url('/items/<int:id>/', item, name='item')
+    return app, get_environ('/')
+
+
+def case_session(tmp):
+    app = new_app()
+
+    def index(request):
+        request.session['count'] = request.session.get('count', 0) + 1
+        return u'ok'
+
+    app.add_url('/', index)
+    # Get a valid session cookie to send with every request
+    response = app.test_client().get('/')
+    cookie = response.headers['Set-Cookie'].split(';', 1)[0]
+    return app, get_environ('/', headers={'Cookie': cookie})
+
+
+def case_not_found(tmp):
+    app = new_app()
+    view = lambda request, id: u''
+    for i in range(1000):
+        app.add_url('/section%i/items/<int:id>/' % i, view,
+            name='item%i' % i)
+    return app, get_environ('/section1000/items/1/')
+
+
+def case_send_file(tmp):
+    path = os.path.join(tmp, 'big.bin')
+    with open(path, 'wb') as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(10):
+            f.write(chunk)
+    app = new_app()
+    app.add_url('/', lambda request: send_file(request, path))
+    return app, get_environ('/')
+
+
+def case_form_post(tmp):
+    app = new_app()
+
+    def upload(request):
+        return u'%i %i' % (len(request.form), len(request.files))
+
+    app.add_url('/', upload, methods=['POST'])
+    data = dict(('field%i' % i, u'value %i' % i) for i in range(200))
+    data['file'] = (BytesIO(b'x' * (2 * 1024 * 1024)), 'upload.bin')
+    return app, get_environ('/', method='POST', data=data)
+
+
+CASES = (
+    # name, setup, number of requests per round
+    ('hello_world', case_hello_world, 2000),
+    ('json', case_json, 1000),
+    ('url_for_x200', case_url_for, 50),
+    ('session', case_session, 500),
+    ('not_found_1000_rules', case_not_found, 100),
+    ('send_file_10mb', case_send_file, 10),
+    ('form_post_2mb', case_form_post, 10),
+)
+
+
+def _start_response(status, headers, exc_info=None):
+    return lambda data: None
+
+
+def run_case(app, environ, number):
+    """Returns the time, in seconds, of calling the app `number` times.
+    """
+    body = environ['wsgi.input']
+    start = clock()
+    for _ in range(number):
+        env = environ.copy()
+        env['wsgi.input'] = BytesIO(body)
+        result = app(env, _start_response)
+        try:
+            for data in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    return clock() - start
+
+
+def run(names=None, repeat=5, scale=1.0, out=sys.stdout):
+    results = {}
+    tmp = tempfile.mkdtemp()
+    try:
+        for name, setup, number in CASES:
+            if names and name not in names:
+                continue
+            number = max(1, int(number * scale))
+            app, environ = setup(tmp)
+            run_case(app, environ, 1)  # warm up
+            best = min(run_case(app, environ, number) for _ in range(repeat))
+            results[name] = {
+                'requests': number,
+                'us_per_request': best / number * 1e6,
+                'requests_per_second': number / best,
+            }
+            print('%-22s %12.1f us/req %12.1f req/s' % (name,
+                results[name]['us_per_request'],
+                results[name]['requests_per_second']), file=out)
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    """Prints the change of each case against the `baseline` and returns
+    the list of the cases slower than it by more than `threshold` percent.
+
+    """
+    print(file=out)
+    print('%-22s %12s %12s %9s' % ('case', 'baseline', 'current', 'change'),
+        file=out)
+    regressions = []
+    for name, current in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print('%-22s %12s %12.1f' % (name, '-', current['us_per_request']),
+                file=out)
+            continue
+        change = (current['us_per_request'] / base['us_per_request'] - 1) * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  << REGRESSION'
+        print('%-22s %12.1f %12.1f %+8.1f%%%s' % (name,
+            base['us_per_request'], current['us_per_request'], change, flag),
+            file=out)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('cases', nargs='*',
+        help='run only these cases: %s' % ', '.join(c[0] for c in CASES))
+    parser.add_argument('--repeat', type=int, default=5,
+        help='rounds per case; the best one is used (default: 5)')
+    parser.add_argument('--scale', type=float, default=1.0,
+        help='multiply the number of requests per round by this')
+    parser.add_argument('--json', metavar='PATH',
+        help='write the results as JSON to this file ("-" for stdout)')
+    parser.add_argument('--compare', metavar='PATH',
+        help='compare against the results stored in this file')
+    parser.add_argument('--threshold', type=float, default=10.0,
+        help='percent slower than the baseline that counts as a regression '
+        '(default: 10)')
+    args = parser.parse_args(argv)
+
+    # Keep stdout clean for the JSON
+    out = sys.stderr if args.json == '-' else sys.stdout
+    results = run(args.cases, repeat=args.repeat, scale=args.scale, out=out)
+    output = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'shake': shake.__version__,
+        'cases': results,
+    }
+    if args.json == '-':
+        print(json.dumps(output, indent=2, sort_keys=True))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['cases']
+        if compare(results, baseline, args.threshold, out=out):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
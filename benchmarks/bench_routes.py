@@ -0,0 +1,278 @@
+# coding=utf-8
+"""
+    Route matching microbenchmark.  Generates synthetic `Map`s of different
+    sizes and shapes and measures, for each one:
+
+    - the time to add all the rules to the map (`Map.add`, compilation
+      included),
+    - the latency distribution of `MapAdapter.match` and
+      `MapAdapter.build`,
+    - the memory used by the rules.
+
+        python benchmarks/bench_routes.py
+        python benchmarks/bench_routes.py --sizes 100,1000 --shapes static
+        python benchmarks/bench_routes.py --json routes.json
+
+    Use it to evaluate any change to `shake/routes.py`.
+
+"""
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import types
+from timeit import default_timer as clock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.exceptions import HTTPException
+
+from shake.routes import (Map, Rule, Submount, Subdomain, EndpointPrefix,
+    RuleTemplate, RequestRedirect)
+
+
+SERVER_NAME = 'example.com'
+
+
+def gen_static(size):
+    """Only literal paths, two or three segments deep."""
+    rules, probes = [], []
+    for i in range(size):
+        path = '/section%i/page%i/' % (i // 10, i)
+        endpoint = 'static%i' % i
+        rules.append(Rule(path, endpoint))
+        probes.append(('', path, endpoint, {}))
+    return rules, probes
+
+
+def gen_converters(size):
+    """Every rule has one to three variables with different converters."""
+    rules, probes = [], []
+    for i in range(size):
+        endpoint = 'conv%i' % i
+        kind = i % 4
+        if kind == 0:
+            rule = '/items%i/<int:id>/' % i
+            values = {'id': 42}
+            path = '/items%i/42/' % i
+        elif kind == 1:
+            rule = '/posts%i/<int:year>/<slug>' % i
+            values = {'year': 2013, 'slug': 'hello-world'}
+            path = '/posts%i/2013/hello-world' % i
+        elif kind == 2:
+            rule = '/files%i/<path:filename>' % i
+            values = {'filename': 'a/b/c.txt'}
+            path = '/files%i/a/b/c.txt' % i
+        else:
+            rule = '/pages%i/<any(about, help, terms):page>/<float:v>' % i
+            values = {'page': 'help', 'v': 1.5}
+            path = '/pages%i/help/1.5' % i
+        rules.append(Rule(rule, endpoint))
+        probes.append(('', path, endpoint, values))
+    return rules, probes
+
+
+def gen_nested(size, depth=4, fanout=4):
+    """Rules nested `depth` levels deep in `Submount`s and
+    `EndpointPrefix`es, with `fanout` children on each level.
+    """
+    probes = []
+    ids = iter(range(size))
+
+    def level(path, prefix, n):
+        rules = []
+        j = 0
+        # The top level grows until all the rules have been generated
+        while n == 0 or j < fanout:
+            if n == depth:
+                i = next(ids, None)
+                if i is None:
+                    break
+                rules.append(Rule('/leaf%i/<int:id>' % i, 'leaf%i' % i))
+                probes.append(('', '%s/leaf%i/7' % (path, i),
+                    '%sleaf%i' % (prefix, i), {'id': 7}))
+            else:
+                name = 'l%i_%i' % (n, j)
+                children = level(path + '/' + name, prefix + name + '.', n + 1)
+                if not children:
+                    break
+                rules.append(EndpointPrefix(name, [
+                    Submount('/' + name, children)]))
+            j += 1
+        return rules
+
+    return level('', '', 0), probes
+
+
+def gen_subdomains(size, per_subdomain=10):
+    """Groups of rules, each one in its own `Subdomain`."""
+    rules, probes = [], []
+    for s in range(0, size, per_subdomain):
+        subdomain = 'sub%i' % (s // per_subdomain)
+        group = []
+        for i in range(s, min(size, s + per_subdomain)):
+            group.append(Rule('/page%i/<int:id>' % i, 'sub%i' % i))
+            probes.append((subdomain, '/page%i/3' % i, 'sub%i' % i,
+                {'id': 3}))
+        rules.append(Subdomain(subdomain, group))
+    return rules, probes
+
+
+def gen_defaults(size):
+    """Pairs of rules with `defaults` (for `redirect_defaults`), generated
+    with a `RuleTemplate`.
+    """
+    resource = RuleTemplate([
+        Rule('/$name/', endpoint='$name', defaults={'page': 1}),
+        Rule('/$name/page/<int:page>/', endpoint='$name'),
+    ])
+    rules, probes = [], []
+    for i in range(size // 2):
+        name = 'list%i' % i
+        rules.append(resource(name=name))
+        probes.append(('', '/%s/page/3/' % name, name, {'page': 3}))
+    return rules, probes
+
+
+SHAPES = (
+    ('static', gen_static),
+    ('converters', gen_converters),
+    ('nested', gen_nested),
+    ('subdomains', gen_subdomains),
+    ('defaults', gen_defaults),
+)
+
+
+def get_size(objects, exclude=()):
+    """Approximate number of bytes used by the `objects` and everything
+    they reference, except modules, classes, functions and the objects
+    in `exclude` (and what those reference).
+
+    """
+    skip = set(id(obj) for obj in exclude)
+    seen = set()
+    pending = list(objects)
+    skip_types = (types.ModuleType, type, types.ClassType, types.FunctionType,
+        types.BuiltinFunctionType, types.MethodType)
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or id(obj) in skip or isinstance(obj, skip_types):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    result = {}
+    for p in points:
+        index = min(len(values) - 1, int(len(values) * p / 100.0))
+        result['p%i' % p] = values[index] * 1e6
+    result['max'] = values[-1] * 1e6
+    result['mean'] = sum(values) / len(values) * 1e6
+    return result
+
+
+def measure(shape, size, rounds=3, samples=2000, seed=0):
+    gen = dict(SHAPES)[shape]
+    factories, probes = gen(size)
+
+    url_map = Map(redirect_defaults=True)
+    start = clock()
+    for factory in factories:
+        url_map.add(factory)
+    add_time = clock() - start
+    rules = list(url_map.iter_rules())
+
+    exclude = [url_map, url_map.converters]
+    memory = get_size(rules, exclude=exclude)
+
+    rand = random.Random(seed)
+    probes = [rand.choice(probes) for _ in range(samples)]
+    adapters = {}
+
+    def get_adapter(subdomain):
+        adapter = adapters.get(subdomain)
+        if adapter is None:
+            adapter = adapters[subdomain] = url_map.bind(SERVER_NAME,
+                subdomain=subdomain)
+        return adapter
+
+    match_times, build_times, errors = [], [], 0
+    for _ in range(rounds):
+        for subdomain, path, endpoint, values in probes:
+            adapter = get_adapter(subdomain)
+            start = clock()
+            try:
+                adapter.match(path)
+            except (RequestRedirect, HTTPException):
+                errors += 1
+            match_times.append(clock() - start)
+
+            adapter = get_adapter('')
+            start = clock()
+            adapter.build(endpoint, values)
+            build_times.append(clock() - start)
+
+    return {
+        'rules': len(rules),
+        'add_ms': add_time * 1000,
+        'memory_bytes': memory,
+        'bytes_per_rule': memory / float(len(rules)),
+        'match_us': percentiles(match_times),
+        'build_us': percentiles(build_times),
+        'match_errors': errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shapes', default=','.join(s[0] for s in SHAPES),
+        help='comma separated list of shapes (default: all)')
+    parser.add_argument('--sizes', default='100,1000,5000',
+        help='comma separated list of number of rules (default: 100,1000,5000)')
+    parser.add_argument('--samples', type=int, default=2000,
+        help='match and build calls per round (default: 2000)')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--json', metavar='PATH',
+        help='write the results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args(argv)
+
+    # Keep stdout clean for the JSON
+    out = sys.stderr if args.json == '-' else sys.stdout
+    results = {}
+    print('%-11s %6s %9s %9s %8s %9s %9s %9s %9s %9s' % ('shape', 'rules',
+        'add ms', 'map KB', 'B/rule', 'match p50', 'p99', 'build p50', 'p99',
+        'errors'), file=out)
+    for shape in args.shapes.split(','):
+        for size in [int(s) for s in args.sizes.split(',')]:
+            r = measure(shape, size, rounds=args.rounds, samples=args.samples)
+            results['%s-%i' % (shape, size)] = r
+            print('%-11s %6i %9.1f %9.1f %8.0f %9.1f %9.1f %9.1f %9.1f %9i' % (
+                shape, r['rules'], r['add_ms'], r['memory_bytes'] / 1024.0,
+                r['bytes_per_rule'],
+                r['match_us']['p50'], r['match_us']['p99'],
+                r['build_us']['p50'], r['build_us']['p99'],
+                r['match_errors']), file=out)
+
+    output = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    if args.json == '-':
+        print(json.dumps(output, indent=2, sort_keys=True))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
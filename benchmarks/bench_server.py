@@ -0,0 +1,188 @@
+# coding=utf-8
+"""
+    Throughput of the pre-forking production server (`shake.server`)
+    against the development server of Werkzeug, over real sockets.
+
+        python benchmarks/bench_server.py
+        python benchmarks/bench_server.py --clients 16 --requests 500
+        python benchmarks/bench_server.py --workers 4 --json server.json
+
+    Each server runs in its own process and is hit by `--clients` client
+    processes making `--requests` requests each, to an endpoint that does
+    a little CPU work and a little (simulated) I/O wait.
+
+"""
+from __future__ import print_function
+import argparse
+import httplib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import signal
+import socket
+import sys
+import time
+from timeit import default_timer as clock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.serving import make_server
+
+from shake import Shake
+from shake.server import PreforkServer
+
+
+# No access log
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+
+def new_app(io_wait):
+    app = Shake(__file__, {'DEBUG': False})
+
+    def index(request):
+        time.sleep(io_wait)
+        return {'items': [{'n': i, 'name': u'item %i' % i}
+            for i in range(100)]}
+
+    app.add_url('/', index)
+    return app
+
+
+def run_dev_server(port, io_wait, **kwargs):
+    server = make_server('127.0.0.1', port, new_app(io_wait), threaded=True)
+    server.serve_forever()
+
+
+def run_prefork_server(port, io_wait, workers=None, threads=8):
+    server = PreforkServer(new_app(io_wait), '127.0.0.1', port,
+        workers=workers, threads=threads)
+    server.log = lambda *args: None
+    server.run()
+
+
+SERVERS = (
+    ('werkzeug_threaded', run_dev_server),
+    ('prefork', run_prefork_server),
+)
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('The server did not start')
+
+
+def client(args):
+    port, number = args
+    times = []
+    errors = 0
+    for _ in range(number):
+        start = clock()
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', '/')
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            if resp.status != 200:
+                errors += 1
+        except (socket.error, httplib.HTTPException):
+            errors += 1
+        times.append(clock() - start)
+    return times, errors
+
+
+def measure(run_server, clients, requests, io_wait, **kwargs):
+    port = get_free_port()
+    pid = os.fork()
+    if not pid:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            run_server(port, io_wait, **kwargs)
+        finally:
+            os._exit(0)
+    try:
+        wait_for(port)
+        client((port, 10))  # warm up
+        pool = multiprocessing.Pool(clients)
+        start = clock()
+        results = pool.map(client, [(port, requests)] * clients)
+        elapsed = clock() - start
+        pool.close()
+        pool.join()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    times = sorted(t for result in results for t in result[0])
+    total = len(times)
+    return {
+        'requests': total,
+        'errors': sum(result[1] for result in results),
+        'requests_per_second': total / elapsed,
+        'p50_ms': times[total // 2] * 1000,
+        'p99_ms': times[min(total - 1, int(total * 0.99))] * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=8,
+        help='concurrent client processes (default: 8)')
+    parser.add_argument('--requests', type=int, default=300,
+        help='requests per client (default: 300)')
+    parser.add_argument('--io-wait', type=float, default=0.002,
+        help='seconds each request sleeps (default: 0.002)')
+    parser.add_argument('--workers', type=int, default=None,
+        help='workers of the prefork server (default: CPUs)')
+    parser.add_argument('--threads', type=int, default=8,
+        help='threads per worker of the prefork server (default: 8)')
+    parser.add_argument('--json', metavar='PATH',
+        help='write the results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args(argv)
+
+    # Keep stdout clean for the JSON
+    out = sys.stderr if args.json == '-' else sys.stdout
+    results = {}
+    print('%-18s %10s %10s %10s %8s' % ('server', 'req/s', 'p50 ms',
+        'p99 ms', 'errors'), file=out)
+    for name, run_server in SERVERS:
+        kwargs = {}
+        if run_server is run_prefork_server:
+            kwargs = {'workers': args.workers, 'threads': args.threads}
+        r = measure(run_server, args.clients, args.requests, args.io_wait,
+            **kwargs)
+        results[name] = r
+        print('%-18s %10.1f %10.2f %10.2f %8i' % (name,
+            r['requests_per_second'], r['p50_ms'], r['p99_ms'], r['errors']), file=out)
+
+    output = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'cpus': multiprocessing.cpu_count(),
+        'results': results,
+    }
+    if args.json == '-':
+        print(json.dumps(output, indent=2, sort_keys=True))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
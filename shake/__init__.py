@@ -35,11 +35,16 @@ from werkzeug.utils import cached_property, import_string, redirect # noqa
 
 from .app import *
 from .helpers import *
+from .metrics import *
 from .render import *
+from .resources import *
 from .routes import *
 from .serializers import json  # noqa
 from .session import *
+from .static import *
+from .tasks import *
 from .templates import *
+from .uploads import *
 from .views import *
 from .wrappers import *
 
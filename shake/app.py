@@ -8,23 +8,35 @@ from __future__ import print_function
 
 """
 from datetime import timedelta
+from functools import partial
+import gc
 import io
 import os
 from os.path import isdir, dirname, join, abspath, normpath, realpath
 import socket
 
 from allspeak import I18n, LOCALES_DIR
+from allspeak.reader import get_data
 from pyceo import Manager
 from werkzeug.exceptions import HTTPException, NotFound
 from werkzeug.local import LocalManager
 from werkzeug.serving import run_simple
 from werkzeug.utils import import_string
+from werkzeug.wsgi import ClosingIterator
 
+from .compression import Compressor
 from .config import get_settings_object
 from .helpers import local, to_unicode
-from .render import Render, TEMPLATES_DIR
+from .metrics import Metrics
+from .profiler import RequestProfiler
+from .resources import Resources
+from .render import Render, TEMPLATES_DIR, default_render
 from .routes import Map, Rule
+from .serializers import get_json_encoder, get_json_decoder
+from .server import PreforkServer
 from .session import ItsdangerousSessionInterface
+from .tasks import TaskQueue, SQLiteStore
+from .static import StaticFiles, load_manifest
 from .wrappers import Request, Response, make_response, BaseResponse
 
 
@@ -84,8 +96,16 @@ class Shake(object):
         self.after_request_funcs = []
         # Functions to run if an exception occurs
         self.on_exception_funcs = []
+        # The global chains of before and after hooks, or `None` if
+        # they must be compiled again.  See `compile_hooks()`.
+        self.hooks = None
+        # The `(url_map, url_map.rules_version)` of the compiled hooks
+        self._hooks_version = None
         # A dict of static `url, path` pairs to be used during development.
         self.static_dirs = {}
+        # The fingerprinted URLs of the static files: `{url: hashed url}`.
+        # See `static_url()`.
+        self.static_manifest = {}
 
         root_path = root_path or '.'
         root_path = normpath(abspath(realpath(root_path)))
@@ -106,10 +126,66 @@ class Shake(object):
         }
         self.request_class.max_content_length = settings.MAX_CONTENT_LENGTH
         self.request_class.max_form_memory_size = settings.MAX_FORM_MEMORY_SIZE
+        self.request_class.max_file_size = settings.UPLOAD_MAX_FILE_SIZE
+        self.request_class.uploads_dir = settings.UPLOADS_DIR
+        self.request_class.upload_chunk_size = settings.UPLOAD_CHUNK_SIZE
+        self.request_class.upload_hash = settings.UPLOAD_HASH
+        self.request_class.json_object_hook = staticmethod(
+            get_json_decoder(settings.JSON_PARSE_DATES))
+        # The values of the hot path derived from the settings.
+        # See `get_plan()`.
+        self._plan = None
         self.session_lifetime = timedelta(hours=settings.SESSION_LIFETIME)
         self.session_interface = ItsdangerousSessionInterface(self)
+        self.json_encoder = get_json_encoder(settings.JSON_BACKEND,
+            sort_keys=settings.JSON_SORT_KEYS)
+        # Per-endpoint latency histograms.  See `shake.metrics`.
+        self.metrics = Metrics() if settings.METRICS else None
+        self.profiler = None
+        if settings.PROFILER:
+            self.profiler = RequestProfiler(
+                slow_threshold=settings.PROFILER_SLOW_THRESHOLD,
+                sample_rate=settings.PROFILER_SAMPLE_RATE,
+                report_dir=settings.PROFILER_DIR,
+                interval=settings.PROFILER_INTERVAL)
+        # Resources injected in the views.  See `provide()`.
+        self.resources = Resources()
+        # Work to run after the response.  See `defer()`.
+        store = None
+        if settings.TASKS_DB:
+            store = SQLiteStore(join(root_path, settings.TASKS_DB))
+        self.tasks = TaskQueue(workers=settings.TASKS_WORKERS,
+            max_size=settings.TASKS_MAX_SIZE,
+            max_retries=settings.TASKS_MAX_RETRIES,
+            retry_delay=settings.TASKS_RETRY_DELAY, store=store)
+        # See `freeze()`
+        self.frozen = False
+        self.compressor = None
+        if settings.COMPRESSION:
+            self.compressor = Compressor(level=settings.COMPRESSION_LEVEL,
+                min_size=settings.COMPRESSION_MIN_SIZE)
         self.create_default_services()
 
+    @property
+    def session_lifetime(self):
+        return self._session_lifetime
+
+    @session_lifetime.setter
+    def session_lifetime(self, value):
+        self._session_lifetime = value
+        self._plan = None
+
+    def get_plan(self):
+        """Returns the `RequestPlan` of the current settings, compiling it
+        again if the settings (or the session interface) have changed.
+
+        """
+        plan = self._plan
+        if plan is None or plan.version != self.settings.version or \
+                plan.session_interface is not self.session_interface:
+            plan = self._plan = RequestPlan(self)
+        return plan
+
     def assert_secret_key(self):
         """Make sure the SECRET_KEY is long enough (only if there's one
         defined in the settings).
@@ -145,6 +221,7 @@ class Shake(object):
         )
 
         render.env.globals['t'] = i18n.translate
+        render.env.globals['static_url'] = self.static_url
         render.env.filters.update({
             'format': i18n.format,
             'datetimeformat': i18n.format_datetime,
@@ -158,9 +235,42 @@ class Shake(object):
             'scientificformat': i18n.format_scientific,
         })
 
+        if self.settings.TEMPLATE_PROFILING:
+            render.enable_profiling(self.metrics)
+            if self.settings.DEBUG:
+                self.after_request(render.profiler.inject_panel)
+
         self.render = render
         self.i18n = i18n
 
+    def freeze(self):
+        """Prepares the application to be forked by a pre-forking server
+        (see `shake.server`), so the workers share as much memory as
+        possible with the master process and the first requests of each
+        one aren't slower than the rest:
+
+        - the chains of hooks of the URL rules are compiled,
+        - all the templates are compiled and cached,
+        - all the locale files are loaded,
+        - the garbage is collected and, where available (Python 3.7+),
+          the surviving objects are moved out of the reach of the garbage
+          collector with `gc.freeze()`, so its passes don't write to
+          (and unshare) their memory pages,
+        - the settings become read-only.
+
+        Call it after adding all the URLs, hooks and template globals.
+
+        """
+        self.compile_hooks()
+        self.render.preload()
+        default_render.preload()
+        load_locales(self.i18n)
+        self.settings.freeze()
+        self.frozen = True
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
     def route(self, url, *args, **kwargs):
         """A decorator for mounting an endpoint in a URL.
         Example:
@@ -198,8 +308,8 @@ class Shake(object):
     def add_static(self, url, path):
         """Can be used to specify an URL for static files on the web and
         the folder with static files that should be served at that URL.
-        Used only for the local development server.  In production, you'll have
-        to define the static paths in your server config.
+        Used by the local development server.  In production, define the
+        static paths in your server config or call `serve_static()`.
 
         """
         url = '/' + url.strip('/')
@@ -208,14 +318,109 @@ class Shake(object):
         if not isdir(path):
             path = join(dirname(path), STATIC_DIR)
         self.static_dirs[url] = path
+        for name, hashed_name in load_manifest(path, verify=True).items():
+            self.static_manifest[url + '/' + name] = url + '/' + hashed_name
+
+    def static_url(self, name):
+        """Returns the URL of a static file, eg: `static_url('styles/app.css')`
+        is `/static/styles/app.3f2a9c1b07.css` if the static directory has
+        been fingerprinted (see `shake.static.fingerprint`) or
+        `/static/styles/app.css` otherwise.
+
+        name
+        :   path relative to `STATIC_URL` or, if it starts with a slash,
+            a full path.
+
+        """
+        if not name.startswith('/'):
+            name = self.settings.STATIC_URL.rstrip('/') + '/' + name
+        return self.static_manifest.get(name, name)
+
+    def serve_static(self, **kwargs):
+        """Serves the static directories added with `add_static()` from
+        the application itself, with the `StaticFiles` middleware.
+        Useful in production when there is no web server in front.
+        The keyword arguments are those of `StaticFiles`.
+
+        """
+        kwargs.setdefault('max_age', self.settings.STATIC_MAX_AGE)
+        middleware = StaticFiles(self.wsgi_app, self.static_dirs, **kwargs)
+        self.wsgi_app = middleware
+        return middleware
+
+    def provide(self, name, factory=None, pool_size=None, timeout=30,
+            reset=None, close=None, teardown=None, pool=None):
+        """Registers a resource to be injected into the views that have
+        an argument called `name`.  It's acquired only when it's needed and
+        released at the end of the request.  It can also be requested
+        with `request.resources.get(name)`.  Returns the pool, if any.
+
+            app.provide('db', Session, pool_size=10, reset=Session.rollback)
+
+            def profile(request, username, db):
+                ...
+
+        name
+        :   name of the argument.
+        factory
+        :   function that makes a new resource.
+        pool_size
+        :   if set, the resources are kept in a `Pool` of this size and
+            reused.  Otherwise, a new one is made for every request.
+        timeout
+        :   seconds to wait for a free resource of the pool before
+            answering with an `HTTP 503: SERVICE UNAVAILABLE`.
+        reset, close
+        :   functions called with a pooled resource when it's released or
+            discarded.  See `shake.resources.Pool`.
+        teardown
+        :   function called with a resource without a pool when the request
+            ends.
+        pool
+        :   a `Pool` to use instead of making one.
+
+        The stats of the pools are in `app.resources.stats()`.
+
+        """
+        return self.resources.add(name, factory, pool=pool,
+            pool_size=pool_size, timeout=timeout, reset=reset, close=close,
+            teardown=teardown)
+
+    def defer(self, func, *args, **kwargs):
+        """Runs `func(*args, **kwargs)` in a background thread after the
+        response is sent, or as soon as possible if called outside of a
+        request.  Useful for slow side effects, like sending mail.
+
+            app.defer(mailer.send, message)
+
+        If it fails, it's retried a few times.  Raises
+        `shake.tasks.QueueFull` if too many tasks are already waiting.
+        See `shake.tasks` and the `TASKS_*` settings.
+
+        """
+        tasks = self.tasks
+        task = tasks.make_task(func, args, kwargs)
+        request = getattr(local, 'request', None)
+        if request is None:
+            tasks.put(task)
+            return
+        tasks.reserve()
+        if request.deferred is None:
+            request.deferred = []
+        request.deferred.append(task)
 
     def before_request(self, function):
         """Register a function to run before each request.
         Can be used as a decorator.  See `preprocess_request()`.
 
+        To run a function only before some of the requests, use the
+        `before` argument of `Rule`, `Submount`, `Subdomain` or
+        `EndpointPrefix` instead.
+
         """
         if function not in self.before_request_funcs:
             self.before_request_funcs.append(function)
+            self.hooks = None
         return function
 
     def after_request(self, function):
@@ -224,9 +429,14 @@ class Shake(object):
         return a new response object or the same.  Can be used as a decorator.
         See `process_response()`.
 
+        To run a function only after some of the requests, use the
+        `after` argument of `Rule`, `Submount`, `Subdomain` or
+        `EndpointPrefix` instead.
+
         """
         if function not in self.after_request_funcs:
             self.after_request_funcs.append(function)
+            self.hooks = None
         return function
 
     before_response = after_request
@@ -240,20 +450,61 @@ class Shake(object):
             self.on_exception_funcs.append(function)
         return function
 
+    def compile_hooks(self):
+        """Precomputes, for every rule in the URL map, the full chain of
+        functions to run before and after the request: the global ones
+        plus those of the rule.  This is done automatically on the first
+        request after adding new rules or global hooks.
+
+        """
+        before = tuple(self.before_request_funcs)
+        after = tuple(self.after_request_funcs)
+        url_map = self.url_map
+        for rule in url_map._rules:
+            rule.before_chain = before + rule.before
+            rule.after_chain = rule.after + after
+        self._hooks_version = (url_map, url_map.rules_version)
+        self.hooks = (before, after)
+        return self.hooks
+
+    def get_hooks(self, rule=None):
+        """Returns the `(before, after)` chains of hooks for the `rule`,
+        or the global ones if `rule` is `None`.
+
+        """
+        hooks = self.hooks
+        url_map = self.url_map
+        version = self._hooks_version
+        if hooks is None or version[0] is not url_map or \
+                version[1] != url_map.rules_version:
+            hooks = self.compile_hooks()
+        if rule is None:
+            return hooks
+        if rule.before_chain is None:
+            # A rule that isn't in the URL map: never skip its own hooks
+            return hooks[0] + rule.before, rule.after + hooks[1]
+        return rule.before_chain, rule.after_chain
+
     def preprocess_request(self, request, kwargs):
-        for handler in self.before_request_funcs:
+        for handler in self.get_hooks(request.url_rule)[0]:
             resp_value = handler(request, **kwargs)
             if resp_value is not None:
                 return resp_value
 
-    def process_response(self, response):
-        for handler in self.after_request_funcs:
+    def process_response(self, response, request=None):
+        rule = getattr(request, 'url_rule', None)
+        for handler in self.get_hooks(rule)[1]:
             response = handler(response)
         return response
 
     def make_request(self, environ):
         request = self.request_class(environ)
+        if self.metrics is not None:
+            request.timer = self.metrics.timer()
+        if self.resources:
+            request.resources = self.resources.bind(request)
         request.session = self.session_interface.open_session(request)
+        request.timer.lap('session')
         local.request = request
         return request
 
@@ -279,23 +530,65 @@ class Shake(object):
 
         """
         local.app = self
-        self.force_script_name(environ)
+        plan = self.get_plan()
+        if plan.script_name is not None:
+            self.force_script_name(environ, plan.script_name)
         request = self.make_request(environ)
+        profiler = self.profiler
+        resources = request.resources
+        try:
+            if profiler is not None and profiler.enabled:
+                response = profiler.profile(self.full_dispatch, request)
+            else:
+                response = self.full_dispatch(request)
+            local_manager.cleanup()
+            app_iter = response(environ, start_response)
+        except Exception:
+            if resources is not None:
+                resources.release()
+            if request.deferred:
+                self.tasks.unreserve(len(request.deferred))
+            raise
+        callbacks = []
+        # A streamed body might still be using the resources, so they are
+        # released after it has been sent.
+        if resources is not None and resources.acquired:
+            callbacks.append(resources.release)
+        if request.deferred:
+            callbacks.append(partial(self.tasks.put_many, request.deferred,
+                reserved=True))
+        if callbacks:
+            app_iter = ClosingIterator(app_iter, callbacks)
+        return app_iter
+
+    def full_dispatch(self, request):
+        """Dispatches the request and does the post-processing of the
+        response: running the after-request hooks, saving the session and
+        compressing it.
+
+        """
+        timer = request.timer
         response = self.dispatch(request)
-        response = self.process_response(response)
+        response = self.process_response(response, request)
+        timer.lap('after')
         if isinstance(response, BaseResponse):
             response = self.session_interface.save_session(request.session, response)
-        local_manager.cleanup()
-        return response(environ, start_response)
+            timer.lap('session')
+            if self.compressor is not None:
+                response = self.compressor(request, response)
+                timer.lap('compression')
+        timer.stop(request.url_rule)
+        return response
 
-    def force_script_name(self, environ):
+    def force_script_name(self, environ, new_script_name=None):
         """In some servers (like Lighttpd), when deploying using FastCGI
         and you want the application to work in the URL root you have to work
         around a bug by setting `FORCE_SCRIPT_NAME = ''`.
 
         """
         script_name = environ.get('SCRIPT_NAME')
-        new_script_name = self.settings.FORCE_SCRIPT_NAME
+        if new_script_name is None:
+            new_script_name = self.settings.FORCE_SCRIPT_NAME
 
         if (new_script_name != False) and script_name:
             environ['SCRIPT_NAME'] = new_script_name
@@ -316,21 +609,30 @@ class Shake(object):
         to differetiate it from a real `HTTP 404: NOT FOUND`.
 
         """
+        timer = request.timer
         try:
             endpoint, kwargs = self.match_url(request)
+            timer.lap('match')
             resp_value = self.preprocess_request(request, kwargs)
+            timer.lap('before')
             if resp_value is None:
+                if request.resources is not None:
+                    kwargs = request.resources.inject(endpoint, kwargs)
                 resp_value = endpoint(request, **kwargs)
+                timer.lap('view')
             response = self.make_response(resp_value)
+            timer.lap('response')
 
         except (HTTPException) as exception:
             if self.settings.DEBUG and isinstance(exception, DataNotFound):
                 response = self.handle_exception(request, exception)
             else:
                 response = self.handle_http_exception(request, exception)
+            timer.lap('error')
 
         except (Exception) as error:
             response = self.handle_exception(request, error)
+            timer.lap('error')
 
         return response
 
@@ -344,17 +646,18 @@ class Shake(object):
         request.url_rule = rule
         request.endpoint = endpoint
         request.kwargs = kwargs
+        if rule.max_content_length is not None:
+            request.max_content_length = rule.max_content_length
+        if rule.max_file_size is not None:
+            request.max_file_size = rule.max_file_size
         return endpoint, kwargs
 
     def create_url_adapter(self, request):
         """Creates a URL adapter for the given request.
 
         """
-        server_name = self.settings.SERVER_NAME
-        port = self.settings.SERVER_PORT
-        if port:
-            server_name = '%s:%s' % (server_name, port)
-        return self.url_map.bind_to_environ(request, server_name=server_name)
+        return self.url_map.bind_to_environ(request,
+            server_name=self.get_plan().server_name)
 
     def make_response(self, resp='', status=None, headers=None, **kwargs):
         """Converts the return value from a view function to a real
@@ -391,7 +694,8 @@ class Shake(object):
 
         """
         return make_response(resp, status=status, headers=headers,
-            response_class=self.response_class, **kwargs)
+            response_class=self.response_class,
+            json_encoder=self.json_encoder, **kwargs)
 
     def handle_http_exception(self, request, exception):
         """Handles an HTTP exception.  By default try to use the handler
@@ -414,11 +718,22 @@ class Shake(object):
             endpoint = self.error_handlers.get(500)
 
         if isinstance(endpoint, basestring):
-            endpoint = import_string(endpoint)
+            endpoint = self.load_error_handler(endpoint)
         resp_value = endpoint(request, exception)
         response = self.make_response(resp_value, status)
         return response
 
+    def load_error_handler(self, import_name):
+        """Imports an error handler given by name, replacing the name
+        with it in `error_handlers` so it's imported only once.
+
+        """
+        handler = import_string(import_name)
+        for code, value in self.error_handlers.items():
+            if value == import_name:
+                self.error_handlers[code] = handler
+        return handler
+
     def handle_exception(self, request, error):
         """Default exception handling that kicks in when an exception
         occours that is not caught.  In debug mode the exception is
@@ -433,7 +748,7 @@ class Shake(object):
             raise
         endpoint = self.error_handlers.get(500)
         if isinstance(endpoint, basestring):
-            endpoint = import_string(endpoint)
+            endpoint = self.load_error_handler(endpoint)
         resp_value = endpoint(request, error)
         response = self.make_response(resp_value, 500)
         return response
@@ -471,7 +786,7 @@ class Shake(object):
 
         The development server is not intended to be used on production
         systems.  It was designed especially for development purposes and
-        performs poorly under high load.
+        performs poorly under high load.  Use `serve()` instead.
 
         host
         :   the host for the application. eg: 'localhost' or '0.0.0.0'.
@@ -528,6 +843,23 @@ class Shake(object):
             static_files=static_dirs,
             **kwargs)
 
+    def serve(self, host=None, port=None, **kwargs):
+        """Runs the application on the pre-forking production server.
+        See `shake.server.PreforkServer` for the arguments.  The defaults
+        are taken from the `SERVER_*` settings.
+
+        """
+        settings = self.settings
+        kwargs.setdefault('workers', settings.SERVER_WORKERS)
+        kwargs.setdefault('threads', settings.SERVER_THREADS)
+        kwargs.setdefault('backlog', settings.SERVER_BACKLOG)
+        kwargs.setdefault('timeout', settings.SERVER_TIMEOUT)
+        kwargs.setdefault('max_requests', settings.SERVER_MAX_REQUESTS)
+        kwargs.setdefault('max_memory', settings.SERVER_MAX_MEMORY)
+        server = PreforkServer(self, host or settings.SERVER_NAME,
+            port or settings.SERVER_PORT, **kwargs)
+        return server.run()
+
     def test_client(self, **kwargs):
         """Creates a test client which you can use to send virtual requests
         to the application.
@@ -535,7 +867,7 @@ class Shake(object):
 
         """
         from werkzeug.test import Client
-        if self.settings.SERVER_NAME in '127.0.0.1':
+        if not self.frozen and self.settings.SERVER_NAME in '127.0.0.1':
             self.settings.SERVER_NAME = 'localhost'
         kwargs.setdefault('use_cookies', True)
         return Client(self, self.response_class, **kwargs)
@@ -547,6 +879,61 @@ class Shake(object):
         return self.wsgi_app(environ, start_response)
 
 
+class RequestPlan(object):
+    """The values used by every request that depend only on the settings,
+    computed once instead of on each request.  See `Shake.get_plan`.
+
+    """
+    __slots__ = ('version', 'session_interface', 'server_name',
+        'script_name', 'cookie_name', 'cookie_domain', 'cookie_path',
+        'cookie_httponly', 'cookie_secure', 'cookie_max_size',
+        'session_max_age', 'session_serializer')
+
+    def __init__(self, app):
+        settings = app.settings
+        self.version = settings.version
+
+        server_name = settings.SERVER_NAME
+        if settings.SERVER_PORT:
+            server_name = '%s:%s' % (server_name, settings.SERVER_PORT)
+        self.server_name = server_name
+        # `None` if the SCRIPT_NAME must not be changed
+        script_name = settings.FORCE_SCRIPT_NAME
+        self.script_name = None if script_name is False else script_name
+
+        si = app.session_interface
+        self.session_interface = si
+        self.cookie_name = settings.SESSION_COOKIE_NAME
+        self.cookie_domain = si.get_cookie_domain()
+        self.cookie_path = si.get_cookie_path() or '/'
+        self.cookie_httponly = si.get_cookie_httponly()
+        self.cookie_secure = bool(si.get_cookie_secure())
+        get_max_size = getattr(si, 'get_cookie_max_size', None)
+        self.cookie_max_size = get_max_size() if get_max_size else None
+        td = app.session_lifetime
+        self.session_max_age = (td.microseconds +
+            (td.seconds + td.days * 24 * 3600) * 1e6) / 1e6
+        get_serializer = getattr(si, 'get_serializer', None)
+        self.session_serializer = get_serializer() if get_serializer else None
+
+
+def load_locales(i18n):
+    """Loads all the locale files of `i18n` into its cache."""
+    for search_path in i18n.search_paths:
+        for root, dirnames, filenames in os.walk(search_path):
+            for filename in filenames:
+                if not filename.endswith('.yml'):
+                    continue
+                cache_key = join(root, filename[:-len('.yml')])
+                if cache_key in i18n.translations:
+                    continue
+                try:
+                    data = get_data(join(root, filename))
+                except (IOError, AttributeError):
+                    continue
+                i18n.translations[cache_key] = data
+
+
 def set_env(env):
     """Set the working environment to `env` saving it in `.SHAKE_ENV`.
     `env` is the name of the new environment eg: 'development', 'production',
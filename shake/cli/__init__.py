@@ -7,7 +7,9 @@ from __future__ import print_function
     Command-line scripts
 
 """
-from os.path import sep, dirname, isfile, join, abspath, normpath, realpath
+import os
+from os.path import sep, dirname, isdir, isfile, join, abspath, normpath, realpath
+import sys
 
 from pyceo import Manager, format_title
 import voodoo
@@ -134,6 +136,67 @@ def add(name=None, *args, **options):
     h.insert_import(path, 'from bundles import ' + plural)
 
 
+@manager.command
+def fingerprint(static_dir='static', **options):
+    """[STATIC_DIR='static'] [--copy]
+
+    Hashes every file in the static directory and writes a `manifest.json`
+    in it, used by `static_url()` to add the hash to the URLs of the files,
+    eg: 'styles/app.css' -> 'styles/app.3f2a9c1b07.css'.
+    Run it again every time the static files change.
+
+    With --copy, each file is also copied to its fingerprinted name
+    (not needed if the files are served by `app.serve_static()`).
+
+    Example:
+        shake fingerprint static --copy
+    """
+    from shake.static import fingerprint as fingerprint_dir
+
+    quiet = options.get('quiet', options.get('q', False))
+    static_dir = static_dir.rstrip(sep)
+    if not isdir(static_dir):
+        print(voodoo.formatm('error', static_dir + ' not found', color='red'))
+        return
+    manifest = fingerprint_dir(static_dir, copy=options.get('copy', False))
+    if not quiet:
+        print(voodoo.formatm('create', join(static_dir, 'manifest.json'),
+            color='green'))
+        print('%i files fingerprinted' % len(manifest))
+
+
+@manager.command
+def serve(app='main:app', host='0.0.0.0', port=5000, **options):
+    """[APP='main:app'] [-host HOST] [-port PORT] [options]
+
+    Runs the application on the pre-forking production server.
+
+    Options:
+        --workers N       # Number of worker processes (default: CPUs)
+        --threads N       # Threads per worker (default: 8)
+        --timeout N       # Close idle connections after N seconds
+                          # (default: 30)
+        --max-requests N  # Restart each worker after N requests
+        --max-memory MB   # Restart a worker using more than MB megabytes
+        --reload          # Import the app in each worker, so a SIGHUP
+                          # loads the new code
+
+    Example:
+        shake serve main:app -port 8000 --workers 4
+    """
+    from shake.server import PreforkServer
+
+    # To import the app from the current directory
+    sys.path.insert(0, os.getcwd())
+    kwargs = {'preload': not options.get('reload', False)}
+    for name in ('workers', 'threads', 'timeout', 'max-requests',
+            'max-memory'):
+        if name in options:
+            kwargs[name.replace('-', '_')] = int(options[name])
+    server = PreforkServer(app, host, port, **kwargs)
+    server.run()
+
+
 @manager.command
 def version():
     """Print the Shake current version."""
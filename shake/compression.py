@@ -0,0 +1,152 @@
+# coding=utf-8
+"""
+    Shake.compression
+    --------------------------
+
+    Compression of the responses with gzip or deflate, negotiated with the
+    `Accept-Encoding` header of the request.
+
+    Enable it with the `COMPRESSION` setting.  It runs after the
+    after-request hooks and the saving of the session, so the compressed
+    body is the final one.  Streamed responses are compressed chunk by
+    chunk, as they are sent, instead of being buffered.
+
+"""
+import zlib
+
+from werkzeug.wsgi import ClosingIterator
+
+from .static import parse_accept_encoding
+
+
+__all__ = (
+    'Compressor',
+)
+
+
+# In order of preference
+ENCODINGS = ('gzip', 'deflate')
+
+# The `wbits` argument of `zlib.compressobj` for each encoding
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Mimetypes that are already compressed
+SKIP_MIMETYPES = frozenset([
+    'application/gzip',
+    'application/octet-stream',
+    'application/pdf',
+    'application/x-bzip2',
+    'application/x-gzip',
+    'application/x-rar-compressed',
+    'application/x-xz',
+    'application/zip',
+    'font/woff',
+    'font/woff2',
+    'application/font-woff',
+])
+SKIP_PREFIXES = ('image/', 'audio/', 'video/')
+# ...except for these
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'image/svg+xml',
+    'image/x-icon',
+    'image/bmp',
+])
+
+
+class Compressor(object):
+    """Compresses the responses.  Called as `compressor(request, response)`
+    returns the same response, compressed if possible.
+
+    level
+    :   the compression level, from 1 (fastest) to 9 (smallest).
+    min_size
+    :   the responses smaller than this (in bytes) are not compressed.
+        For the streamed responses, only the `Content-Length` header, if
+        present, is checked.
+    skip_mimetypes
+    :   the mimetypes not to compress, in addition to images, audio and
+        video.
+
+    Responses with `direct_passthrough` (like those of `send_file`), with
+    a `Content-Encoding` or without a body are never compressed.
+
+    """
+
+    def __init__(self, level=6, min_size=500, skip_mimetypes=SKIP_MIMETYPES):
+        self.level = level
+        self.min_size = min_size
+        self.skip_mimetypes = frozenset(skip_mimetypes)
+
+    def is_compressible(self, response):
+        if response.direct_passthrough:
+            return False
+        if response.status_code < 200 or response.status_code in (204, 304):
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        mimetype = response.mimetype
+        if not mimetype or mimetype in self.skip_mimetypes:
+            return False
+        if mimetype.startswith(SKIP_PREFIXES):
+            return mimetype in COMPRESSIBLE_MIMETYPES
+        return True
+
+    def get_encoding(self, request):
+        accepted = parse_accept_encoding(
+            request.environ.get('HTTP_ACCEPT_ENCODING'))
+        for encoding in ENCODINGS:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def __call__(self, request, response):
+        if not self.is_compressible(response):
+            return response
+        # The response varies even if this client doesn't get it compressed
+        response.vary.add('Accept-Encoding')
+        encoding = self.get_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.is_sequence:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = self.get_compressor(encoding)
+            response.set_data(compressor.compress(data) + compressor.flush())
+        else:
+            length = response.headers.get('Content-Length')
+            if length is not None and length.isdigit() and \
+                    int(length) < self.min_size:
+                return response
+            response.response = ClosingIterator(
+                self.compress_iter(response.iter_encoded(), encoding),
+                getattr(response.response, 'close', None))
+            response.headers.pop('Content-Length', None)
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag('%s-%s' % (etag, encoding), weak)
+        return response
+
+    def get_compressor(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+
+    def compress_iter(self, chunks, encoding):
+        """Compresses each chunk as it comes.  The compressor is flushed
+        after each one so the client gets it without waiting for the rest
+        of the response.
+        """
+        compressor = self.get_compressor(encoding)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            data = compressor.compress(chunk) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
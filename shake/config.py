@@ -17,6 +17,17 @@ class DefaultSettings(object):
 
     FORCE_SCRIPT_NAME = False
 
+    # The production server.  See `Shake.serve` and `shake.server`.
+    SERVER_WORKERS = None  # the number of CPUs
+    SERVER_THREADS = 8  # per worker
+    SERVER_BACKLOG = 2048
+    # Seconds before closing an idle connection (0 to disable).
+    SERVER_TIMEOUT = 30
+    # Restart each worker after this many requests (0 to disable).
+    SERVER_MAX_REQUESTS = 0
+    # Restart a worker if it uses more than this many MB (0 to disable).
+    SERVER_MAX_MEMORY = 0
+
     DEBUG = True
     RELOADER = True
 
@@ -27,14 +38,72 @@ class DefaultSettings(object):
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SECURE = None
     SESSION_LIFETIME = 24 * 365 # 365 days
+    # Bigger session cookies are not saved (browsers silently drop cookies
+    # bigger than 4KB).  Measured over the whole `Set-Cookie` header:
+    # name, value and attributes.
+    SESSION_COOKIE_MAX_SIZE = 4000
 
     # The maximum size for uploade files
     MAX_CONTENT_LENGTH = 1024 * 1024 * 50  # 50 MB
     # The maximum size for regular form data (not files)
     MAX_FORM_MEMORY_SIZE = 1024 * 1024 * 5  # 5 MB
 
+    # Uploaded files.  See `shake.uploads`.
+    # The maximum size of each file (`None` for no limit other than
+    # `MAX_CONTENT_LENGTH`).
+    UPLOAD_MAX_FILE_SIZE = None
+    # Where to write the temporary files.  `None` for the system default.
+    UPLOADS_DIR = None
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    # `hashlib` algorithm used to hash the files while they are received.
+    UPLOAD_HASH = None
+
     DEFAULT_MIMETYPE = 'text/html'
 
+    # The URL of the static files used by `Shake.static_url`.
+    STATIC_URL = '/static'
+    # Seconds to cache the static files served by `Shake.serve_static`
+    # (the fingerprinted ones are always cached for a year).
+    STATIC_MAX_AGE = 60 * 60 * 12
+
+    # Compress the responses with gzip or deflate?  See `shake.compression`.
+    COMPRESSION = False
+    COMPRESSION_LEVEL = 6  # from 1 (fastest) to 9 (smallest)
+    COMPRESSION_MIN_SIZE = 500  # bytes
+
+    # Work deferred with `Shake.defer`.  See `shake.tasks`.
+    TASKS_WORKERS = 2  # threads per process
+    TASKS_MAX_SIZE = 1000  # tasks waiting to run
+    TASKS_MAX_RETRIES = 3
+    TASKS_RETRY_DELAY = 1.0  # seconds, doubled on each retry
+    # A SQLite database where the pending tasks are kept, so they survive
+    # a restart.  Relative to the root path of the application.
+    TASKS_DB = None
+
+    # Record the latency of the requests?  See `shake.metrics`.
+    METRICS = False
+
+    # Measure the templates?  See `Render.enable_profiling`.
+    # In DEBUG mode a panel with the templates rendered is added to the pages.
+    TEMPLATE_PROFILING = False
+
+    # Profile the slow requests?  See `shake.profiler`.
+    PROFILER = False
+    PROFILER_SLOW_THRESHOLD = 1.0  # seconds
+    PROFILER_SAMPLE_RATE = 0  # profile 1 of every N requests
+    PROFILER_INTERVAL = 0.005  # seconds
+    PROFILER_DIR = None
+
+    # The library used to serialize the `dict` responses to JSON:
+    # 'orjson', 'ujson', 'simplejson' or 'json'.
+    # If `None`, the fastest one available is used.
+    JSON_BACKEND = None
+    # Sort the keys of the JSON responses?  `False` is a little faster.
+    JSON_SORT_KEYS = True
+    # Convert the dates in the JSON of the requests to `date` or `datetime`?
+    # Can also be a list of the keys to convert.
+    JSON_PARSE_DATES = False
+
     DEFAULT_LOCALE = 'en'
     DEFAULT_TIMEZONE = 'UTC'
 
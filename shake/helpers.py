@@ -8,15 +8,19 @@ import datetime
 from decimal import Decimal
 import io
 import mimetypes
+import mmap
 import os
 import posixpath
 import sys
 import types
+from stat import S_ISREG
 from time import time
 from zlib import adler32
 
 from werkzeug.datastructures import Headers
 from werkzeug.exceptions import NotFound
+from werkzeug.http import (http_date, is_resource_modified, parse_date,
+    parse_range_header)
 from werkzeug.local import Local, LocalProxy
 from werkzeug.urls import url_quote
 from werkzeug.wsgi import wrap_file
@@ -27,7 +31,8 @@ from .routes import BuildError
 __all__ = (
     'local', 'Local', 'LocalProxy', 'url_for',
     'path_join', 'url_join', 'to64', 'from64', 'to36', 'from36',
-    'StorageDict', 'safe_join', 'send_file', 'to_unicode', 'to_bytestring',
+    'StorageDict', 'safe_join', 'send_file', 'FileInfo', 'FileInfoCache',
+    'to_unicode', 'to_bytestring',
 )
 
 local = Local()
@@ -232,15 +237,27 @@ def safe_join(directory, filename):
     return os.path.join(directory, filename)
 
 
+# Ignore the Range header if asks for more ranges than this
+MAX_RANGES = 20
+
+SEND_FILE_CHUNK_SIZE = 256 * 1024
+
+
 def send_file(request, filepath_or_fp, mimetype=None, as_attachment=False,
         attachment_filename=None, add_etags=True, cache_timeout=60 * 60 * 12,
-        conditional=False, use_x_sendfile=False, response_class=None):
+        conditional=False, use_x_sendfile=False, x_accel_redirect=None,
+        response_class=None, file_info=None):
     """Sends the contents of a file to the client.  This will use the
     most efficient method available and configured.  By default it will
-    try to use the WSGI server's file_wrapper support.  Alternatively
-    you can set the `use_x_sendfile` parameter to `True` to directly emit
-    an `X-Sendfile` header.  This however requires support of the underlying
-    webserver for `X-Sendfile`.
+    try to use the WSGI server's file_wrapper support (that usually sends
+    the file with `sendfile`) and, if not available, reads the file through
+    a `mmap`.  Alternatively you can set the `use_x_sendfile` parameter
+    to `True` to directly emit an `X-Sendfile` header, or use
+    `x_accel_redirect` to emit an `X-Accel-Redirect` one for nginx.
+    This however requires support of the underlying webserver.
+
+    Single and multiple byte ranges (`Range` and `If-Range` headers) are
+    supported with `206 Partial Content` responses.
 
     By default it will try to guess the mimetype for you, but you can
     also explicitly provide one.  For extra security you probably want
@@ -290,17 +307,27 @@ def send_file(request, filepath_or_fp, mimetype=None, as_attachment=False,
         Set to `True` to directly emit an `X-Sendfile` header.
         This however requires support of the underlying webserver.
 
+    param x_accel_redirect:
+        A dict of `{directory: internal URL}` to emit an `X-Accel-Redirect`
+        header for the files inside those directories.  Eg: with
+        `{'/var/uploads': '/protected/'}`, the file
+        `/var/uploads/a/b.pdf` is sent as `/protected/a/b.pdf`, an
+        internal location of nginx.
+
     param response_class:
         Set to overwrite the default Response class.
 
+    param file_info:
+        The `FileInfo` of the file, if known (see `FileInfoCache`).  Saves
+        the `stat` call, the mimetype guessing and the ETag calculation.
+
     --------------------------------
-    Copied almost verbatim from Flask <http://flask.pocoo.org/>
+    Based on the function of Flask <http://flask.pocoo.org/>
     Copyright © 2010 by Armin Ronacher.
     Used under the modified BSD license.
     """
     from .wrappers import Response
 
-    mtime = None
     if isinstance(filepath_or_fp, basestring):
         filepath = filepath_or_fp
         file = None
@@ -309,10 +336,18 @@ def send_file(request, filepath_or_fp, mimetype=None, as_attachment=False,
         add_etags = False
         file = filepath_or_fp
         filepath = getattr(file, 'name', None)
-
-    if filepath is not None:
+        if not isinstance(filepath, basestring):
+            filepath = None
+
+    if file is not None:
+        file_info = None
+    if file_info is not None:
+        filepath = file_info.path
+    elif filepath is not None:
         filepath = os.path.abspath(filepath)
-    if mimetype is None and (filepath or attachment_filename):
+    if mimetype is None and file_info is not None:
+        mimetype = file_info.mimetype
+    elif mimetype is None and (filepath or attachment_filename):
         mimetype = mimetypes.guess_type(filepath or attachment_filename)[0]
     if mimetype is None:
         mimetype = 'application/octet-stream'
@@ -327,49 +362,321 @@ def send_file(request, filepath_or_fp, mimetype=None, as_attachment=False,
         headers.add('Content-Disposition', 'attachment',
             filename=attachment_filename)
 
-    if use_x_sendfile and filepath:
+    # The size (of what's left to read) and the mtime, from a single stat
+    offset = 0
+    stat = None
+    if file_info is not None:
+        stat = file_info.stat
+    elif file is None:
+        stat = os.stat(filepath)
+    else:
+        try:
+            stat = os.fstat(file.fileno())
+            offset = file.tell()
+        except (AttributeError, EnvironmentError, ValueError,
+                io.UnsupportedOperation):
+            pass
+    size = stat.st_size - offset if stat is not None else None
+
+    redirect_header = None
+    if filepath:
+        if x_accel_redirect:
+            redirect_header = _get_x_accel_redirect(filepath,
+                x_accel_redirect)
+        if redirect_header is None and use_x_sendfile:
+            redirect_header = ('X-Sendfile', filepath)
+    if redirect_header is not None:
         if file is not None:
             file.close()
-        headers['X-Sendfile'] = filepath
-        data = None
-    else:
-        if file is None:
-            file = io.open(filepath, 'rb')
-            mtime = os.path.getmtime(filepath)
-        data = wrap_file(request.environ, file)
+            file = None
+        headers[redirect_header[0]] = redirect_header[1]
 
     response_class = response_class or Response
-    resp = response_class(data, mimetype=mimetype, headers=headers,
+    resp = response_class(None, mimetype=mimetype, headers=headers,
         direct_passthrough=True)
 
     # if we know the file modification date, we can store it as the
     # the time of the last modification.
-    if mtime is not None:
-        resp.last_modified = int(mtime)
+    if file is None and stat is not None:
+        resp.last_modified = int(stat.st_mtime)
 
     resp.cache_control.public = True
     if cache_timeout:
         resp.cache_control.max_age = cache_timeout
         resp.expires = int(time() + cache_timeout)
 
-    if add_etags and filepath is not None:
-        resp.set_etag('shake-%s-%s-%s' % (
-            os.path.getmtime(filepath),
-            os.path.getsize(filepath),
-            adler32(
-                filepath.encode('utf8') if isinstance(filepath, unicode)
-                else filepath
-            ) & 0xffffffff
-        ))
-        if conditional:
-            resp = resp.make_conditional(request)
-            # make sure we don't send x-sendfile for serespers that
+    if add_etags and stat is not None:
+        resp.set_etag(file_info.etag if file_info is not None
+            else make_file_etag(filepath, stat))
+
+    environ = request.environ
+    if conditional and environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+        resp.headers['Date'] = http_date()
+        if not is_resource_modified(environ, resp.headers.get('etag'), None,
+                resp.headers.get('last-modified')):
+            resp.status_code = 304
+            # make sure we don't send x-sendfile for servers that
             # ignore the 304 status code for x-sendfile.
-            if resp.status_code == 304:
-                resp.headers.pop('x-sendfile', None)
+            resp.headers.pop('x-sendfile', None)
+            resp.headers.pop('x-accel-redirect', None)
+            if file is not None:
+                file.close()
+            return resp
+
+    if redirect_header is not None:
+        return resp
+
+    if file is None:
+        file = io.open(filepath, 'rb')
+        if file_info is not None:
+            # The cached stat is outdated if the file has changed since:
+            # what is sent must match the headers.
+            fresh = os.fstat(file.fileno())
+            if (fresh.st_ino, fresh.st_size, fresh.st_mtime) != (
+                    stat.st_ino, stat.st_size, stat.st_mtime):
+                file_info.stale = True
+                stat = fresh
+                size = stat.st_size
+                resp.last_modified = int(stat.st_mtime)
+                if add_etags:
+                    resp.set_etag(make_file_etag(filepath, stat))
+
+    if size is None:
+        resp.response = wrap_file(environ, file)
+        return resp
+
+    resp.headers['Accept-Ranges'] = 'bytes'
+    ranges = None
+    if environ.get('HTTP_RANGE') and environ['REQUEST_METHOD'] in ('GET', 'HEAD') \
+            and _if_range_matches(environ, resp):
+        ranges = _get_ranges(environ['HTTP_RANGE'], size)
+        if ranges == []:
+            if file is not None:
+                file.close()
+            resp.status_code = 416
+            resp.headers['Content-Range'] = 'bytes */%i' % size
+            resp.headers['Content-Length'] = '0'
+            resp.response = []
+            return resp
+
+    if not ranges:
+        resp.headers['Content-Length'] = str(size)
+        if 'wsgi.file_wrapper' in environ:
+            resp.response = wrap_file(environ, file)
+        else:
+            resp.response = FileChunks(file, [(offset, offset + size)])
+        return resp
+
+    resp.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        resp.headers['Content-Range'] = 'bytes %i-%i/%i' % (
+            start, stop - 1, size)
+        resp.headers['Content-Length'] = str(stop - start)
+        resp.response = FileChunks(file, [(offset + start, offset + stop)])
+        return resp
+
+    boundary = os.urandom(12).encode('hex')
+    content_type = resp.headers['Content-Type']
+    parts = []
+    length = 0
+    for start, stop in ranges:
+        part_header = ('\r\n--%s\r\nContent-Type: %s\r\n'
+            'Content-Range: bytes %i-%i/%i\r\n\r\n' % (
+                boundary, content_type, start, stop - 1, size))
+        parts.append(part_header)
+        parts.append((offset + start, offset + stop))
+        length += len(part_header) + stop - start
+    closing = '\r\n--%s--\r\n' % boundary
+    parts.append(closing)
+    length += len(closing)
+    resp.headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+    resp.headers['Content-Length'] = str(length)
+    resp.response = FileChunks(file, parts)
     return resp
 
 
+def make_file_etag(filepath, stat):
+    return 'shake-%s-%s-%s' % (
+        stat.st_mtime,
+        stat.st_size,
+        adler32(
+            filepath.encode('utf8') if isinstance(filepath, unicode)
+            else filepath
+        ) & 0xffffffff
+    )
+
+
+class FileInfo(object):
+    """What `send_file` needs to know about a file: its absolute `path`,
+    the result of `os.stat`, its guessed `mimetype` and its `etag`.
+    `stale` is set by `send_file` when it finds that the file has changed.
+    """
+    __slots__ = ('path', 'stat', 'mimetype', 'etag', 'stale')
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.stat = stat
+        self.mimetype = mimetypes.guess_type(path)[0]
+        self.etag = make_file_etag(path, stat)
+        self.stale = False
+
+
+class FileInfoCache(object):
+    """An in-process cache of the `FileInfo` of the files, so the files
+    served often don't need a `stat` call, the mimetype guessing and the
+    ETag hashing on every request.  Used by `send_from_directory`.
+
+    The entries (including those of missing files) expire after `ttl`
+    seconds, or as soon as `send_file` finds that the file has changed.
+
+    ttl
+    :   seconds to keep each entry.
+    max_entries
+    :   when the cache grows beyond this size it's emptied.
+
+    """
+
+    def __init__(self, ttl=2, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = {}
+
+    def get(self, filepath):
+        """Returns the `FileInfo` of `filepath` or `None` if it's not a
+        regular file.
+        """
+        now = time()
+        info = self._cache.get(filepath)
+        if info is not None and info[0] > now and \
+                not (info[1] is not None and info[1].stale):
+            return info[1]
+        path = os.path.abspath(filepath)
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            stat = None
+        if stat is None or not S_ISREG(stat.st_mode):
+            result = None
+        else:
+            result = FileInfo(path, stat)
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+        self._cache[filepath] = (now + self.ttl, result)
+        return result
+
+    def clear(self):
+        self._cache.clear()
+
+
+file_info_cache = FileInfoCache()
+
+
+def _get_x_accel_redirect(filepath, locations):
+    for directory, location in locations.items():
+        directory = os.path.abspath(directory).rstrip(os.sep) + os.sep
+        if filepath.startswith(directory):
+            path = filepath[len(directory):].replace(os.sep, '/')
+            if isinstance(path, unicode):
+                path = path.encode('utf8')
+            return ('X-Accel-Redirect',
+                location.rstrip('/') + '/' + url_quote(path))
+    return None
+
+
+def _if_range_matches(environ, resp):
+    """Checks the `If-Range` header, if any: the ranges are only sent if
+    the file hasn't changed.
+    """
+    if_range = environ.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        etag = resp.headers.get('etag')
+        return etag is not None and not if_range.startswith('W/') and \
+            if_range == etag
+    last_modified = resp.headers.get('last-modified')
+    return last_modified is not None and \
+        parse_date(if_range) == parse_date(last_modified)
+
+
+def _get_ranges(header, size):
+    """Returns a list of the `(start, stop)` byte ranges requested, or
+    `None` if the header is invalid or must be ignored.  An empty list
+    means that none of the ranges can be satisfied.
+    """
+    try:
+        rng = parse_range_header(header)
+    except ValueError:
+        return None
+    if rng is None or rng.units != 'bytes' or len(rng.ranges) > MAX_RANGES:
+        return None
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start = max(0, size + start)
+            stop = size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+class FileChunks(object):
+    """Iterates over byte ranges of a file, using a `mmap` if possible.
+
+    file
+    :   an open file.
+    parts
+    :   a list of `(start, stop)` ranges to read and/or bytestrings
+        to send as is between them.
+    chunk_size
+    :   maximum size of each chunk.
+
+    """
+
+    def __init__(self, file, parts, chunk_size=SEND_FILE_CHUNK_SIZE):
+        self.file = file
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self.map = None
+        try:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError,
+                io.UnsupportedOperation):
+            # Empty files, pipes, file-like objects, etc.
+            pass
+
+    def __iter__(self):
+        chunk_size = self.chunk_size
+        for part in self.parts:
+            if isinstance(part, basestring):
+                yield part
+                continue
+            start, stop = part
+            if self.map is not None:
+                for pos in xrange(start, stop, chunk_size):
+                    yield self.map[pos:min(pos + chunk_size, stop)]
+                continue
+            self.file.seek(start)
+            left = stop - start
+            while left > 0:
+                data = self.file.read(min(chunk_size, left))
+                if not data:
+                    break
+                left -= len(data)
+                yield data
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if hasattr(self.file, 'close'):
+            self.file.close()
+
+
 def is_protected_type(obj):
     """Determine if the object instance is of a protected type.
 
@@ -0,0 +1,381 @@
+# coding=utf-8
+"""
+    Shake.metrics
+    --------------------------
+
+    Low-overhead timing of the requests, by endpoint and by phase.
+
+    Enable it with the `METRICS` setting and then read the data from
+    `app.metrics.snapshot()` or expose it to Prometheus:
+
+        app.add_url('/metrics', 'shake.views.metrics_page')
+
+    The phases measured are: `match` (URL matching), `before` (the before
+    hooks), `view`, `response` (`make_response`), `after` (the after hooks),
+    `session` (loading and saving), `render` (templates rendering, included
+    in `view`), `error` (the error handlers) and `total`.
+
+"""
+from bisect import bisect_left
+import threading
+from timeit import default_timer as clock
+import weakref
+
+
+__all__ = (
+    'Metrics', 'HistogramData', 'TemplateMetrics',
+)
+
+
+# Upper bounds, in seconds, of the histogram buckets: 10µs * 2^n,
+# from 10µs to ~84s.
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(24))
+
+UNMATCHED = '<unmatched>'
+
+class HistogramData(object):
+    """The merged data of one histogram.
+
+    count
+    :   number of values recorded.
+    sum
+    :   sum of all the values recorded.
+    buckets
+    :   list of the number of values that fall in each bucket (not
+        cumulative).  The last one is for the values bigger than the
+        last bound in `bounds`.
+
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def merge(self, counts, total):
+        buckets = self.buckets
+        for i, num in enumerate(counts):
+            buckets[i] += num
+        self.count += sum(counts)
+        self.sum += total
+
+    def percentile(self, p):
+        """Returns an estimate (the upper bound of the bucket) of the
+        `p` percentile, `p` being a number between 0 and 100.
+
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, num in enumerate(self.buckets):
+            seen += num
+            if seen >= rank and num:
+                if i < len(self.bounds):
+                    return self.bounds[i]
+                return float('inf')
+        return float('inf')
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def __repr__(self):
+        return '<HistogramData count=%i sum=%f>' % (self.count, self.sum)
+
+
+class Timer(object):
+    """Measures the phases of a single request.  Each phase can be
+    measured more than once; the times are added.
+
+    """
+    __slots__ = ('metrics', 'laps', 'extra')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.laps = [(None, clock())]
+        self.extra = []
+
+    def lap(self, phase):
+        """Marks the end of `phase`: the time since the last lap is added
+        to it.
+        """
+        self.laps.append((phase, clock()))
+
+    def add(self, phase, seconds):
+        """Adds `seconds` to `phase` without starting a new lap.  Used for
+        the phases measured inside another one, like the template rendering.
+
+        """
+        self.extra.append((phase, seconds))
+
+    def get_phases(self):
+        """Returns a dict with the time, in seconds, of each phase measured
+        so far and the `total` time since the start.
+        """
+        laps = self.laps
+        last = laps[0][1]
+        phases = {'total': clock() - last}
+        for phase, time in laps[1:]:
+            phases[phase] = phases.get(phase, 0) + (time - last)
+            last = time
+        for phase, seconds in self.extra:
+            phases[phase] = phases.get(phase, 0) + seconds
+        return phases
+
+    def stop(self, rule=None):
+        """Records the phases and the total time under the `rule` that
+        matched the request.
+        """
+        self.metrics.record(rule, self.get_phases())
+
+
+class NullTimer(object):
+    """Does nothing.  Used when the metrics are disabled.
+    """
+    __slots__ = ()
+
+    def lap(self, phase):
+        pass
+
+    def add(self, phase, seconds):
+        pass
+
+    def get_phases(self):
+        return {}
+
+    def stop(self, rule=None):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    """A registry of per-endpoint and per-phase latency histograms.
+
+    Each thread records in its own store, without locking; the stores are
+    only merged when the data is read.  The stores of the threads that
+    have exited are folded into a single one.
+
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self._local = threading.local()
+        # `(weakref to the thread, store)` pairs of the live threads
+        self._stores = []
+        # The data of the threads that have exited
+        self._merged = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+
+    def timer(self):
+        return Timer(self)
+
+    def _get_store(self):
+        try:
+            return self._local.store
+        except AttributeError:
+            store = self._local.store = {}
+            thread = weakref.ref(threading.current_thread())
+            with self._lock:
+                self._collect()
+                self._stores.append((thread, store))
+            return store
+
+    def _collect(self):
+        """Folds the stores of the threads that have exited into
+        `self._merged`.  Must be called with the lock held.
+        """
+        live = []
+        merged = self._merged
+        for ref, store in self._stores:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                live.append((ref, store))
+                continue
+            for key, (counts, total) in store.items():
+                data = merged.get(key)
+                if data is None:
+                    merged[key] = [list(counts), total]
+                    continue
+                data_counts = data[0]
+                for i, num in enumerate(counts):
+                    data_counts[i] += num
+                data[1] += total
+        self._stores = live
+
+    def get_label(self, rule):
+        """Returns the name used for the metrics of a rule: its name, if it
+        has one, or the name of its endpoint.
+
+        """
+        if rule is None:
+            return UNMATCHED
+        label = self._labels.get(id(rule))
+        if label is None:
+            label = rule.name
+            if not label:
+                endpoint = rule.endpoint
+                if isinstance(endpoint, basestring):
+                    label = endpoint
+                else:
+                    label = '%s.%s' % (getattr(endpoint, '__module__', ''),
+                        getattr(endpoint, '__name__', repr(endpoint)))
+            self._labels[id(rule)] = label
+        return label
+
+    def record(self, rule, phases):
+        """Records the duration, in seconds, of the `phases` (a dict)
+        of a request that matched the `rule`.
+
+        """
+        self.record_label(self.get_label(rule), phases)
+
+    def record_label(self, label, phases):
+        """Like `record` but using a `label` instead of a rule.
+        """
+        try:
+            store = self._local.store
+        except AttributeError:
+            store = self._get_store()
+        bounds = self.bounds
+        for phase, seconds in phases.iteritems():
+            data = store.get((label, phase))
+            if data is None:
+                data = store[(label, phase)] = [[0] * (len(bounds) + 1), 0.0]
+            data[0][bisect_left(bounds, seconds)] += 1
+            data[1] += seconds
+
+    def snapshot(self):
+        """Returns a dict of `(label, phase): HistogramData` with the
+        merged data of all threads.
+
+        """
+        result = {}
+        with self._lock:
+            self._collect()
+            stores = [store for _, store in self._stores]
+            for key, (counts, total) in self._merged.items():
+                hist = result[key] = HistogramData(self.bounds)
+                hist.merge(counts, total)
+        for store in stores:
+            for key, (counts, total) in store.items():
+                hist = result.get(key)
+                if hist is None:
+                    hist = result[key] = HistogramData(self.bounds)
+                hist.merge(counts, total)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._merged.clear()
+            for _, store in self._stores:
+                store.clear()
+
+    def to_prometheus(self, name='shake_request_duration_seconds'):
+        """Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            '# HELP %s Request latency by endpoint and phase.' % name,
+            '# TYPE %s histogram' % name,
+        ]
+        snapshot = self.snapshot()
+        for label, phase in sorted(snapshot):
+            hist = snapshot[(label, phase)]
+            labels = 'endpoint="%s",phase="%s"' % (_escape(label), phase)
+            cumulative = 0
+            for bound, num in zip(self.bounds, hist.buckets):
+                cumulative += num
+                lines.append('%s_bucket{%s,le="%r"} %i' % (
+                    name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %i' % (
+                name, labels, hist.count))
+            lines.append('%s_sum{%s} %r' % (name, labels, hist.sum))
+            lines.append('%s_count{%s} %i' % (name, labels, hist.count))
+        return '\n'.join(lines) + '\n'
+
+
+class TemplateMetrics(object):
+    """Statistics of the templates rendered: compilation and rendering
+    times, output size and number of calls to the helpers like `url_for`.
+    Filled by `Render.enable_profiling`.
+
+    If a `Metrics` registry is provided, the compile and render times are
+    also recorded there, labeled as `template:<name>`.
+
+    A template is flagged if any of the helpers is called more than
+    `max_helper_calls` times in a single render.
+
+    """
+
+    def __init__(self, metrics=None, max_helper_calls=50):
+        self.metrics = metrics
+        self.max_helper_calls = max_helper_calls
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        data = self._data.get(name)
+        if data is None:
+            data = self._data[name] = {
+                'compiles': 0, 'compile_time': 0.0,
+                'renders': 0, 'render_time': 0.0, 'max_render_time': 0.0,
+                'output_size': 0, 'calls': {}, 'max_calls': {},
+            }
+        return data
+
+    def record_compile(self, name, seconds):
+        with self._lock:
+            data = self._get(name)
+            data['compiles'] += 1
+            data['compile_time'] += seconds
+        if self.metrics is not None:
+            self.metrics.record_label('template:' + name,
+                {'compile': seconds})
+
+    def record_render(self, name, seconds, size, calls):
+        with self._lock:
+            data = self._get(name)
+            data['renders'] += 1
+            data['render_time'] += seconds
+            data['max_render_time'] = max(data['max_render_time'], seconds)
+            data['output_size'] += size
+            for helper, num in calls.iteritems():
+                data['calls'][helper] = data['calls'].get(helper, 0) + num
+                data['max_calls'][helper] = max(
+                    data['max_calls'].get(helper, 0), num)
+        if self.metrics is not None:
+            self.metrics.record_label('template:' + name,
+                {'render': seconds})
+
+    def snapshot(self):
+        """Returns a dict of `name: stats` for each template."""
+        with self._lock:
+            return dict((name, dict(data, calls=dict(data['calls']),
+                max_calls=dict(data['max_calls'])))
+                for name, data in self._data.iteritems())
+
+    def flagged(self):
+        """Returns a list of `(template, helper, max calls in a render)` of
+        the templates that call a helper too many times.
+        """
+        result = []
+        for name, data in sorted(self.snapshot().items()):
+            for helper, num in sorted(data['max_calls'].items()):
+                if num > self.max_helper_calls:
+                    result.append((name, helper, num))
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
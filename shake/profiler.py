@@ -0,0 +1,246 @@
+# coding=utf-8
+"""
+    Shake.profiler
+    --------------------------
+
+    Profiling of the slow requests in production.
+
+    Enable it with the `PROFILER` setting.  Every request slower than
+    `PROFILER_SLOW_THRESHOLD` seconds is sampled by a background thread
+    (that takes a snapshot of its stack every `PROFILER_INTERVAL` seconds),
+    and one of every `PROFILER_SAMPLE_RATE` requests is fully profiled with
+    `cProfile`.  A report is written for each one of them, to
+    `PROFILER_DIR` or, if that's not set, to the `shake.profiler` logger.
+
+    The profiler can be turned on and off at runtime with
+    `app.profiler.toggle()`, with a signal (see `install_signal`) or
+    from the `shake.views.profiler_page` view.
+
+"""
+import cProfile
+from collections import defaultdict
+import errno
+import io
+import itertools
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+from time import strftime, sleep
+from timeit import default_timer as clock
+
+
+__all__ = (
+    'RequestProfiler',
+)
+
+
+logger = logging.getLogger('shake.profiler')
+
+_slug_re = re.compile(r'[^a-zA-Z0-9_.-]+')
+
+
+class RequestProfiler(object):
+    """Profiles the slow requests and a sample of all the requests.
+
+    slow_threshold
+    :   time in seconds after which a request is considered slow and its
+        stack starts to be sampled.  `None` to disable it.
+    sample_rate
+    :   profile with `cProfile` one of every `sample_rate` requests.
+        `0` to disable it.
+    report_dir
+    :   directory where the reports are written.  If `None`, they are sent
+        to the `shake.profiler` logger.
+    interval
+    :   seconds between each snapshot of the stacks of the slow requests.
+    top
+    :   number of functions included in the reports.
+    enabled
+    :   start enabled?
+
+    """
+
+    def __init__(self, slow_threshold=1.0, sample_rate=0, report_dir=None,
+            interval=0.005, top=20, enabled=True):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.report_dir = report_dir
+        self.interval = interval
+        self.top = top
+        self.enabled = enabled
+        # {thread ident: [start time, samples, request]} of the requests
+        # being watched by the sampler thread.
+        self._active = {}
+        self._counter = itertools.count(1)
+        self._reports = itertools.count(1)
+        self._sampler = None
+        # Wakes up the sampler thread when there's something to watch
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def toggle(self, enabled=None):
+        """Turns the profiler on or off.  If `enabled` isn't provided,
+        the current state is switched.  When turned off, the sampler
+        thread stops.
+        """
+        if enabled is None:
+            enabled = not self.enabled
+        self.enabled = bool(enabled)
+        self._wake.set()
+        return self.enabled
+
+    def install_signal(self, signum=None):
+        """Toggles the profiler each time the process receives the signal
+        `signum` (`SIGUSR2` by default).  Must be called from the main thread.
+        """
+        import signal
+        if signum is None:
+            signum = signal.SIGUSR2
+        signal.signal(signum, lambda *args: self.toggle())
+
+    def profile(self, func, request):
+        """Calls `func(request)`, profiling it if it's one of the sampled
+        requests or if it turns out to be slow.
+        """
+        if self.sample_rate and next(self._counter) % self.sample_rate == 0:
+            return self.run_cprofile(func, request)
+        if self.slow_threshold is None:
+            return func(request)
+
+        ident = threading.current_thread().ident
+        watch = [clock(), None, request]
+        self._active[ident] = watch
+        self._start_sampler()
+        try:
+            return func(request)
+        finally:
+            del self._active[ident]
+            elapsed = clock() - watch[0]
+            if elapsed >= self.slow_threshold:
+                self.report_samples(request, elapsed, watch[1])
+
+    def run_cprofile(self, func, request):
+        prof = cProfile.Profile()
+        start = clock()
+        prof.enable()
+        try:
+            return func(request)
+        finally:
+            prof.disable()
+            elapsed = clock() - start
+            stream = io.BytesIO()
+            stats = pstats.Stats(prof, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            self.write_report(request, elapsed, 'cProfile',
+                stream.getvalue().strip())
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop,
+                    name='shake-profiler')
+                self._sampler.daemon = True
+                self._sampler.start()
+        self._wake.set()
+
+    def _sample_loop(self):
+        while True:
+            self._wake.clear()
+            if not self._active:
+                with self._lock:
+                    if not self.enabled:
+                        self._sampler = None
+                        return
+                # Sleep until there's a request to watch
+                self._wake.wait()
+                continue
+            sleep(self.interval)
+            now = clock()
+            frames = sys._current_frames()
+            for ident, watch in self._active.items():
+                if now - watch[0] < self.slow_threshold:
+                    continue
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                if watch[1] is None:
+                    watch[1] = defaultdict(int)
+                self.add_sample(watch[1], frame)
+
+    def add_sample(self, samples, frame):
+        """Counts each function in the stack of `frame` once.
+        """
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if key not in seen:
+                seen.add(key)
+                samples[key] += 1
+            frame = frame.f_back
+        samples[None] += 1
+
+    def report_samples(self, request, elapsed, samples):
+        if not samples:
+            body = 'No samples were taken.'
+        else:
+            total = samples.pop(None)
+            lines = ['%d samples, every %.1f ms after the first %.1f ms' % (
+                total, self.interval * 1000, self.slow_threshold * 1000),
+                '',
+                '  samples      %  function']
+            top = sorted(samples.items(), key=lambda x: -x[1])[:self.top]
+            for (filename, lineno, name), num in top:
+                lines.append('%9d  %5.1f  %s (%s:%d)' % (
+                    num, num * 100.0 / total, name, filename, lineno))
+            body = '\n'.join(lines)
+        self.write_report(request, elapsed, 'stack samples', body)
+
+    def get_report(self, request, elapsed, kind, body):
+        rule = getattr(request, 'url_rule', None)
+        endpoint = getattr(request, 'endpoint', None)
+        lines = [
+            'URL:      %s %s' % (request.method, request.url),
+            'Rule:     %s' % (rule.rule if rule is not None else '-'),
+            'Endpoint: %s' % (getattr(endpoint, '__name__', None) or
+                endpoint or '-'),
+            'Time:     %.1f ms' % (elapsed * 1000),
+        ]
+        phases = request.timer.get_phases()
+        if phases:
+            lines.append('Phases:   ' + ', '.join(['%s=%.1fms' % (k, v * 1000)
+                for k, v in sorted(phases.items())]))
+        lines.extend(['', '--- %s ---' % kind, body, ''])
+        return '\n'.join(lines)
+
+    def write_report(self, request, elapsed, kind, body):
+        """Writes the report to a file in `report_dir` (created if
+        needed) and returns its path.  If that fails, the error is logged
+        along with the report instead of reaching the request.
+        """
+        report = self.get_report(request, elapsed, kind, body)
+        if not self.report_dir:
+            logger.warning(report)
+            return
+        filename = '%s-%s-%d.txt' % (strftime('%Y%m%d-%H%M%S'),
+            _slug_re.sub('_', request.path.strip('/')) or 'index',
+            next(self._reports))
+        path = os.path.join(self.report_dir, filename)
+        try:
+            try:
+                os.makedirs(self.report_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with io.open(path, 'wb') as f:
+                f.write(report.encode('utf8') if isinstance(report, unicode)
+                    else report)
+        except (IOError, OSError):
+            logger.exception('Error writing the profiler report to %s',
+                self.report_dir)
+            logger.warning(report)
+            return
+        return path
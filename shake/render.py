@@ -9,12 +9,17 @@
 from collections import defaultdict
 from datetime import datetime
 import io
+import logging
 from os.path import isdir, dirname, join, abspath, normpath, realpath
+import threading
+from timeit import default_timer as clock
 
 import jinja2
+from jinja2.utils import escape
 from werkzeug.local import LocalProxy
 
 from .helpers import url_for, local
+from .metrics import TemplateMetrics
 from .session import get_csrf, get_messages
 from .templates import link_to, dumb_plural
 from .wrappers import Response, make_response
@@ -25,6 +30,9 @@ __all__ = (
 )
 
 
+logger = logging.getLogger('shake.render')
+
+
 TEMPLATES_DIR = 'templates'
 
 
@@ -102,6 +110,7 @@ class Render(object):
         self.env = env
         self.default_mimetype = default_mimetype
         self.response_class = response_class
+        self.profiler = None
 
 
     def render(self, tmpl, context=None, to_string=False, **kwargs):
@@ -111,7 +120,11 @@ class Render(object):
 
         """
         context = context or {}
+        start = clock()
         result = tmpl.render(context)
+        request = getattr(local, 'request', None)
+        if request is not None:
+            request.timer.add('render', clock() - start)
         if to_string:
             return result
         kwargs.setdefault('mimetype', self.default_mimetype)
@@ -140,8 +153,199 @@ class Render(object):
 
         """
         tmpl = self.env.from_string(source)
+        if self.profiler is not None:
+            self.profiler.wrap(tmpl)
         return self.render(tmpl, context=context, to_string=to_string, **kwargs)
 
+    def preload(self, extensions=None):
+        """Compiles every template that the loader can list, so the first
+        requests don't have to, and returns how many were loaded.
+        The cache of the environment is enlarged if needed to fit them all.
+
+        extensions
+        :   only load the templates with these extensions, eg:
+            `('html', 'txt')`.  Files that aren't valid UTF-8 or valid
+            Jinja templates (eg: client-side templates) are skipped.
+
+        """
+        env = self.env
+        try:
+            names = env.list_templates(extensions=extensions)
+        except TypeError:
+            # The loader can't list its templates
+            return 0
+        capacity = getattr(env.cache, 'capacity', None)
+        if capacity is not None and capacity < len(names):
+            env.cache = jinja2.utils.LRUCache(len(names) * 2)
+        loaded = 0
+        for name in names:
+            try:
+                env.get_template(name)
+            except UnicodeDecodeError:
+                continue
+            except (jinja2.TemplateSyntaxError,
+                    jinja2.TemplateNotFound) as e:
+                logger.warning('Template %r not preloaded: %s', name, e)
+                continue
+            loaded += 1
+        return loaded
+
+    def enable_profiling(self, metrics=None, max_helper_calls=50):
+        """Starts recording, for every template, the time it takes to
+        compile and render it (included the templates it extends or
+        includes), the size of the output and how many times it calls
+        the `url_for`, `link_to` and `t` helpers.  The data is stored in
+        `self.profiler.stats`, a `shake.metrics.TemplateMetrics` instance.
+
+        metrics
+        :   an optional `shake.metrics.Metrics` registry where the times
+            are also recorded.
+        max_helper_calls
+        :   templates calling a helper more than this number of times
+            in a single render are flagged.
+
+        Enable it only after all the globals have been added.
+
+        """
+        stats = TemplateMetrics(metrics, max_helper_calls=max_helper_calls)
+        profiler = TemplateProfiler(stats)
+        env = self.env
+        for name in profiler.helpers:
+            if name in env.globals:
+                env.globals[name] = profiler.count_calls(name,
+                    env.globals[name])
+        env.loader = _ProfilingLoader(env.loader, profiler)
+        # The templates already loaded are not instrumented.
+        if env.cache is not None:
+            env.cache.clear()
+        self.profiler = profiler
+        return profiler
+
+
+class TemplateProfiler(object):
+    """Instruments the templates to fill a `TemplateMetrics` instance.
+    See `Render.enable_profiling`.
+
+    """
+
+    # The template globals whose calls are counted
+    helpers = ('url_for', 'link_to', 't')
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._local = threading.local()
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def count_calls(self, name, func):
+        stack = self._get_stack
+
+        def counted(*args, **kwargs):
+            frames = stack()
+            if frames:
+                calls = frames[-1][1]
+                calls[name] = calls.get(name, 0) + 1
+            return func(*args, **kwargs)
+        counted.__name__ = getattr(func, '__name__', name)
+        counted.__doc__ = getattr(func, '__doc__', None)
+        return counted
+
+    def wrap(self, tmpl):
+        """Wraps the render function of the template `tmpl` to measure it.
+        """
+        render_func = tmpl.root_render_func
+        name = tmpl.name or '<string>'
+        stats = self.stats
+        get_stack = self._get_stack
+
+        def root_render_func(context):
+            stack = get_stack()
+            frame = (name, {})
+            stack.append(frame)
+            size = 0
+            start = clock()
+            try:
+                for chunk in render_func(context):
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                elapsed = clock() - start
+                stack.remove(frame)
+            stats.record_render(name, elapsed, size, frame[1])
+            log = getattr(local, 'rendered_templates', None)
+            if log is None and getattr(local, 'request', None) is not None:
+                log = local.rendered_templates = []
+            if log is not None:
+                log.append((name, elapsed, size, frame[1]))
+
+        tmpl.root_render_func = root_render_func
+        return tmpl
+
+    def inject_panel(self, response):
+        """An after-request hook that appends, to the HTML responses, a
+        panel with the templates rendered during the request.  Meant to be
+        used in development only.
+
+        """
+        log = getattr(local, 'rendered_templates', None)
+        if not log or response.mimetype != 'text/html' \
+                or response.direct_passthrough or not response.is_sequence:
+            return response
+        body = response.get_data()
+        pos = body.rfind('</body>')
+        if pos < 0:
+            return response
+        response.set_data(body[:pos] + render_panel(log).encode('utf8') +
+            body[pos:])
+        return response
+
+
+PANEL_TMPL = u"""<div id="shake-templates-panel" style="position:fixed;bottom:0;\
+right:0;z-index:99999;max-height:40%%;overflow:auto;background:#fffbe6;\
+border:1px solid #aaa;font:12px monospace;padding:4px 8px;">\
+<b>Templates</b><table>\
+<tr><th>template</th><th>ms</th><th>chars</th><th>helper calls</th></tr>\
+%s</table></div>"""
+
+PANEL_ROW_TMPL = u"""<tr><td>%s</td><td>%.2f</td><td>%i</td><td>%s</td></tr>"""
+
+
+def render_panel(log):
+    rows = []
+    for name, elapsed, size, calls in log:
+        calls = u', '.join([u'%s: %i' % item for item in sorted(calls.items())])
+        rows.append(PANEL_ROW_TMPL % (escape(name), elapsed * 1000, size,
+            escape(calls)))
+    return PANEL_TMPL % u''.join(rows)
+
+
+class _ProfilingLoader(jinja2.BaseLoader):
+    """Wraps a loader to measure the compilation of the templates and
+    to instrument them.
+
+    """
+
+    def __init__(self, loader, profiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def get_source(self, environment, template):
+        return self.loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        start = clock()
+        tmpl = self.loader.load(environment, name, globals)
+        self.profiler.stats.record_compile(name, clock() - start)
+        return self.profiler.wrap(tmpl)
+
 
 default_loader = jinja2.PackageLoader('shake', 'default_templates')
 default_render = Render(loader=default_loader)
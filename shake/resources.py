@@ -0,0 +1,324 @@
+# coding=utf-8
+"""
+    Shake.resources
+    --------------------------
+
+    Request-scoped resources (database sessions, HTTP clients, cache
+    connections...) injected into the views that ask for them.
+
+        app.provide('db', Session, pool_size=10, reset=Session.rollback)
+
+        def profile(request, username, db):
+            user = db.query(User).filter_by(username=username).first()
+            ...
+
+    A resource is created, or taken from its pool, only when a view has an
+    argument with its name (URL arguments take precedence) or when it's
+    requested with `request.resources.get(name)`.  In both cases it's
+    released at the end of the request, even if the view fails.
+
+"""
+from collections import deque
+import inspect
+import logging
+import threading
+from timeit import default_timer as clock
+
+from werkzeug.exceptions import ServiceUnavailable
+
+
+__all__ = (
+    'Pool', 'PoolTimeout', 'Resources',
+)
+
+
+logger = logging.getLogger('shake.resources')
+
+
+class PoolTimeout(ServiceUnavailable):
+    """No resource of a pool was released in time.  Answered with an
+    `HTTP 503: SERVICE UNAVAILABLE`.
+    """
+    description = 'The server is too busy right now.  Try again later.'
+
+
+class Pool(object):
+    """A thread-safe pool of up to `size` objects made by `factory`.
+
+    factory
+    :   function that makes a new object.
+    size
+    :   maximum number of objects.  `acquire` blocks when all of them are
+        in use.
+    timeout
+    :   seconds to wait for a free object before raising `PoolTimeout`.
+        `None` to wait forever.
+    reset
+    :   function called with an object when it's released, eg: to roll
+        back an unfinished transaction.  If it fails, the object is closed
+        and discarded.
+    close
+    :   function called with an object when it's discarded.
+
+    """
+
+    def __init__(self, factory, size=10, timeout=30, reset=None, close=None,
+            name=None):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.reset = reset
+        self.close = close
+        self.name = name or getattr(factory, '__name__', 'pool')
+        self._idle = deque()
+        self._cond = threading.Condition(threading.Lock())
+        # Stats
+        self.created = 0
+        self.in_use = 0
+        self.waiters = 0
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+    def acquire(self):
+        """Returns an object of the pool, making a new one if there are
+        no free objects and there's room for it.
+        """
+        cond = self._cond
+        with cond:
+            if not self._idle and self.created >= self.size:
+                self._wait()
+            self.in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        try:
+            return self.factory()
+        except Exception:
+            with cond:
+                self.created -= 1
+                self.in_use -= 1
+                cond.notify()
+            raise
+
+    def _wait(self):
+        # Called with the lock held
+        start = clock()
+        deadline = None if self.timeout is None else start + self.timeout
+        self.waiters += 1
+        try:
+            while not self._idle and self.created >= self.size:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout()
+                self._cond.wait(remaining)
+        finally:
+            self.waiters -= 1
+            waited = clock() - start
+            self.wait_count += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+    def release(self, obj, discard=False):
+        """Returns `obj` to the pool or, if `discard` is true, closes it
+        and makes room for a new one.
+        """
+        if not discard and self.reset is not None:
+            try:
+                self.reset(obj)
+            except Exception:
+                discard = True
+        if discard:
+            self._close(obj)
+        with self._cond:
+            self.in_use -= 1
+            if discard:
+                self.created -= 1
+            else:
+                self._idle.append(obj)
+            self._cond.notify()
+
+    def _close(self, obj):
+        if self.close is not None:
+            try:
+                self.close(obj)
+            except Exception:
+                pass
+
+    def clear(self):
+        """Closes and discards the idle objects."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self.created -= len(idle)
+            self._cond.notify_all()
+        for obj in idle:
+            self._close(obj)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'created': self.created,
+                'in_use': self.in_use,
+                'idle': len(self._idle),
+                'waiters': self.waiters,
+                'wait_count': self.wait_count,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'timeouts': self.timeouts,
+            }
+
+
+class Provider(object):
+    """How to get and release a resource: from a `Pool` or, without one,
+    calling `factory` for each request (and `teardown` at the end).
+    """
+    __slots__ = ('name', 'pool', 'factory', 'teardown')
+
+    def __init__(self, name, pool=None, factory=None, teardown=None):
+        self.name = name
+        self.pool = pool
+        self.factory = factory
+        self.teardown = teardown
+
+    def acquire(self):
+        if self.pool is not None:
+            return self.pool.acquire()
+        return self.factory()
+
+    def release(self, obj, discard=False):
+        if self.pool is not None:
+            self.pool.release(obj, discard=discard)
+        elif self.teardown is not None:
+            self.teardown(obj)
+
+
+class Resources(object):
+    """The resources registered in an application.  See `Shake.provide`.
+    """
+
+    def __init__(self):
+        self.providers = {}
+        # {endpoint: names of the resources in its signature}
+        self._injections = {}
+
+    def __nonzero__(self):
+        return bool(self.providers)
+
+    def add(self, name, factory=None, pool=None, pool_size=None, timeout=30,
+            reset=None, close=None, teardown=None):
+        if pool is None and pool_size:
+            pool = Pool(factory, size=pool_size, timeout=timeout,
+                reset=reset, close=close, name=name)
+        if pool is None and factory is None:
+            raise ValueError('A factory or a pool is required')
+        self.providers[name] = Provider(name, pool, factory, teardown)
+        self._injections.clear()
+        return pool
+
+    def get_injections(self, endpoint):
+        """Returns the names of the resources that `endpoint` takes as
+        arguments.  Computed once per endpoint.
+        """
+        try:
+            return self._injections[endpoint]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable
+            return ()
+        names = ()
+        args = get_arg_names(endpoint)
+        if args:
+            names = tuple(name for name in args if name in self.providers)
+        self._injections[endpoint] = names
+        return names
+
+    def bind(self, request):
+        return RequestResources(self, request)
+
+    def stats(self):
+        """Returns the stats of every pool: `{name: stats}`."""
+        return dict((name, provider.pool.stats())
+            for name, provider in self.providers.items()
+            if provider.pool is not None)
+
+    def to_prometheus(self, name='shake_pool'):
+        """Returns the stats of the pools in the Prometheus text format."""
+        lines = []
+        stats = self.stats()
+        for key, kind in (('in_use', 'gauge'), ('idle', 'gauge'),
+                ('waiters', 'gauge'), ('wait_count', 'counter'),
+                ('wait_time', 'counter'), ('timeouts', 'counter')):
+            metric = '%s_%s' % (name, key)
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for pool_name in sorted(stats):
+                lines.append('%s{pool="%s"} %r' % (metric, pool_name,
+                    stats[pool_name][key]))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestResources(object):
+    """The resources used by a request, acquired lazily."""
+
+    __slots__ = ('registry', 'request', 'acquired')
+
+    def __init__(self, registry, request):
+        self.registry = registry
+        self.request = request
+        self.acquired = []
+
+    def get(self, name):
+        for key, obj in self.acquired:
+            if key == name:
+                return obj
+        provider = self.registry.providers[name]
+        start = clock()
+        obj = provider.acquire()
+        self.request.timer.add('resources', clock() - start)
+        self.acquired.append((name, obj))
+        return obj
+
+    def inject(self, endpoint, kwargs):
+        """Returns `kwargs` plus the resources that `endpoint` takes as
+        arguments, unless they are URL arguments.
+        """
+        names = self.registry.get_injections(endpoint)
+        if not names:
+            return kwargs
+        kwargs = dict(kwargs)
+        for name in names:
+            if name not in kwargs:
+                kwargs[name] = self.get(name)
+        return kwargs
+
+    def release(self):
+        """Releases all the resources, in reverse order.  The errors are
+        logged, so one failure doesn't prevent the others from being
+        released.
+        """
+        acquired = self.acquired
+        self.acquired = []
+        providers = self.registry.providers
+        for name, obj in reversed(acquired):
+            try:
+                providers[name].release(obj)
+            except Exception:
+                logger.exception('Error releasing the %r resource', name)
+
+
+def get_arg_names(func):
+    if not (inspect.isfunction(func) or inspect.ismethod(func)):
+        func = getattr(func, '__call__', None)
+        if not (inspect.isfunction(func) or inspect.ismethod(func)):
+            return ()
+    try:
+        return inspect.getargspec(func).args
+    except TypeError:
+        return ()
@@ -244,8 +244,10 @@ def parse_rule(rule):
 
 
 def get_converter(map, name, args):
-    """Create a new converter for the given arguments or raise
-    exception if the converter does not exist.
+    """Return a converter for the given arguments or raise
+    exception if the converter does not exist.  The converters are
+    shared by all the rules of the map with the same converter class
+    and arguments.
 
     :internal:
     """
@@ -256,7 +258,20 @@ def get_converter(map, name, args):
     else:
         args = ()
         kwargs = {}
-    return map.converters[name](map, *args, **kwargs)
+    return _get_shared_converter(map, map.converters[name], args, kwargs)
+
+
+def _get_shared_converter(map, cls, args=(), kwargs=None):
+    kwargs = kwargs or {}
+    try:
+        key = (cls, args, tuple(sorted(kwargs.items())))
+        convobj = map._converter_cache.get(key)
+    except TypeError:
+        # Unhashable arguments
+        return cls(map, *args, **kwargs)
+    if convobj is None:
+        convobj = map._converter_cache[key] = cls(map, *args, **kwargs)
+    return convobj
 
 
 def get_regex_variables(rule):
@@ -325,12 +340,44 @@ class RuleFactory(object):
     factories to avoid repetitive tasks.  Some of them are builtin, others can
     be added by subclassing `RuleFactory` and overriding `get_rules`.
     """
+    __slots__ = ()
+
+    # Functions to run before and after the requests that match any of
+    # the rules of this factory.  See `Rule`.
+    before = after = ()
+
+    # `True` if `get_rules` returns new rules instead of shared ones, so
+    # they can be modified in place by an outer factory.
+    returns_copies = False
 
     def get_rules(self, map):
         """Subclasses of `RuleFactory` have to override this method and return
         an iterable of rules."""
         raise NotImplementedError()
 
+    def get_rule_copies(self, map):
+        """Iterate over new copies of the rules of the sub-factories
+        in `self.rules`, that can be modified in place.  The rules that are
+        already copies are not copied again.
+        """
+        for rulefactory in self.rules:
+            if rulefactory.returns_copies:
+                for rule in rulefactory.get_rules(map):
+                    yield rule
+            else:
+                for rule in rulefactory.get_rules(map):
+                    yield rule.empty()
+
+    def add_hooks(self, rule):
+        """Add the `before` and `after` functions of this factory to those
+        of the `rule`.  The hooks of the outer factories run first before
+        the request and last after it.
+        """
+        if self.before:
+            rule.before = tuple(self.before) + rule.before
+        if self.after:
+            rule.after = rule.after + tuple(self.after)
+
 
 class Subdomain(RuleFactory):
     """All URLs provided by this factory have the subdomain set to a
@@ -349,18 +396,24 @@ class Subdomain(RuleFactory):
     All the rules except for the `'#select_language'` endpoint will now
     listen on a two letter long subdomain that holds the language code
     for the current request.
+
+    Like with `Submount` and `EndpointPrefix`, the optional `before` and
+    `after` lists of functions are added to the hooks of every rule.
     """
 
-    def __init__(self, subdomain, rules):
+    returns_copies = True
+
+    def __init__(self, subdomain, rules, before=None, after=None):
         self.subdomain = subdomain
         self.rules = rules
+        self.before = before or ()
+        self.after = after or ()
 
     def get_rules(self, map):
-        for rulefactory in self.rules:
-            for rule in rulefactory.get_rules(map):
-                rule = rule.empty()
-                rule.subdomain = self.subdomain
-                yield rule
+        for rule in self.get_rule_copies(map):
+            rule.subdomain = self.subdomain
+            self.add_hooks(rule)
+            yield rule
 
 
 class Submount(RuleFactory):
@@ -375,20 +428,33 @@ class Submount(RuleFactory):
         ])
 
     Now the rule `'blog/show'` matches `/blog/entry/<entry_slug>`.
+
+    The optional `before` and `after` lists of functions are run only for
+    the requests matching these rules (eg: to check the permissions of an
+    admin section)::
+
+        url_map = Map([
+            Submount('/admin', [
+                Rule('/', endpoint='admin/index'),
+            ], before=[requires_login]),
+        ])
+
     """
+    returns_copies = True
 
-    def __init__(self, path, rules):
+    def __init__(self, path, rules, before=None, after=None):
         if isinstance(rules, basestring):
             rules = import_string(rules)
         self.path = path.rstrip('/')
         self.rules = rules
+        self.before = before or ()
+        self.after = after or ()
 
     def get_rules(self, map):
-        for rulefactory in self.rules:
-            for rule in rulefactory.get_rules(map):
-                rule = rule.empty()
-                rule.rule = self.path + rule.rule
-                yield rule
+        for rule in self.get_rule_copies(map):
+            rule.rule = self.path + rule.rule
+            self.add_hooks(rule)
+            yield rule
 
 
 class EndpointPrefix(RuleFactory):
@@ -406,17 +472,19 @@ class EndpointPrefix(RuleFactory):
         ])
 
     """
+    returns_copies = True
 
-    def __init__(self, prefix, rules):
+    def __init__(self, prefix, rules, before=None, after=None):
         self.prefix = prefix.rstrip('.') + '.'
         self.rules = rules
+        self.before = before or ()
+        self.after = after or ()
 
     def get_rules(self, map):
-        for rulefactory in self.rules:
-            for rule in rulefactory.get_rules(map):
-                rule = rule.empty()
-                rule.endpoint = self.prefix + rule.endpoint
-                yield rule
+        for rule in self.get_rule_copies(map):
+            rule.endpoint = self.prefix + rule.endpoint
+            self.add_hooks(rule)
+            yield rule
 
 
 class RuleTemplate(object):
@@ -451,36 +519,26 @@ class RuleTemplateFactory(RuleFactory):
 
     :internal:
     """
+    returns_copies = True
 
     def __init__(self, rules, context):
         self.rules = rules
         self.context = context
 
     def get_rules(self, map):
-        for rulefactory in self.rules:
-            for rule in rulefactory.get_rules(map):
-                new_defaults = subdomain = None
-                if rule.defaults:
-                    new_defaults = {}
-                    for key, value in rule.defaults.iteritems():
-                        if isinstance(value, basestring):
-                            value = format_string(value, self.context)
-                        new_defaults[key] = value
-                if rule.subdomain is not None:
-                    subdomain = format_string(rule.subdomain, self.context)
-                new_endpoint = rule.endpoint
-                if isinstance(new_endpoint, basestring):
-                    new_endpoint = format_string(new_endpoint, self.context)
-                yield Rule(
-                    format_string(rule.rule, self.context),
-                    endpoint=new_endpoint,
-                    defaults=new_defaults,
-                    subdomain=subdomain,
-                    methods=rule.methods,
-                    name=rule.name,
-                    build_only=rule.build_only,
-                    strict_slashes=rule.strict_slashes
-                )
+        context = self.context
+        for rule in self.get_rule_copies(map):
+            if rule.defaults:
+                for key, value in rule.defaults.iteritems():
+                    if isinstance(value, basestring):
+                        rule.defaults[key] = format_string(value, context)
+            if rule.subdomain is not None:
+                rule.subdomain = format_string(rule.subdomain, context)
+            if isinstance(rule.endpoint, basestring):
+                rule.endpoint = format_string(rule.endpoint, context)
+            rule.rule = format_string(rule.rule, context)
+            rule.is_leaf = not rule.rule.endswith('/')
+            yield rule
 
 
 class Rule(RuleFactory):
@@ -596,11 +654,34 @@ class Rule(RuleFactory):
         used to provide a match rule for the whole host.  This also means
         that the subdomain feature is disabled.
 
+    before
+    :   A list of functions to run, after the global ones of the application,
+        before the view of this rule.  See `Shake.before_request`.
+
+    after
+    :   A list of functions to run, before the global ones of the application,
+        after the view of this rule.  See `Shake.after_request`.
+
+    max_content_length
+    :   Overrides the `MAX_CONTENT_LENGTH` setting for the requests
+        matching this rule (eg: for an upload form).
+
+    max_file_size
+    :   Overrides the `UPLOAD_MAX_FILE_SIZE` setting for the requests
+        matching this rule.
+
     """
+    # An application can have thousands of rules, so they are kept small.
+    __slots__ = ('rule', 'is_leaf', 'map', 'strict_slashes', 'subdomain',
+        'host', 'defaults', 'build_only', 'alias', 'methods', 'endpoint',
+        'name', 'redirect_to', 'before', 'after', 'max_content_length',
+        'max_file_size', 'arguments',
+        'before_chain', 'after_chain', '_trace', '_converters', '_regex')
 
     def __init__(self, string, endpoint=None, defaults=None, subdomain=None,
             methods=None, name=None, build_only=False, strict_slashes=None,
-            redirect_to=None, alias=False, host=None):
+            redirect_to=None, alias=False, host=None, before=None, after=None,
+            max_content_length=None, max_file_size=None):
         if not string.startswith('/'):
             raise ValueError('URLs must start with a leading slash')
         self.rule = string.rstrip('$')
@@ -622,11 +703,19 @@ class Rule(RuleFactory):
         self.endpoint = endpoint
         self.name = name
         self.redirect_to = redirect_to
+        self.before = tuple(before or ())
+        self.after = tuple(after or ())
+        self.max_content_length = max_content_length
+        self.max_file_size = max_file_size
+        # The complete chains of functions to run before and after the
+        # requests matching this rule, including the global ones.
+        # Set by the application (see `Shake.compile_hooks`).
+        self.before_chain = self.after_chain = None
 
         if defaults:
-            self.arguments = set(map(str, defaults))
+            self.arguments = frozenset(map(str, defaults))
         else:
-            self.arguments = set()
+            self.arguments = frozenset()
         self._trace = self._converters = self._regex = None
 
     def empty(self):
@@ -647,7 +736,11 @@ class Rule(RuleFactory):
             strict_slashes=self.strict_slashes,
             redirect_to=self.redirect_to,
             alias=self.alias,
-            host=self.host)
+            host=self.host,
+            before=self.before,
+            after=self.after,
+            max_content_length=self.max_content_length,
+            max_file_size=self.max_file_size)
 
     def get_rules(self, map):
         yield self
@@ -686,38 +779,45 @@ class Rule(RuleFactory):
         else:
             domain_rule = self.subdomain or ''
 
-        self._trace = []
-        self._converters = {}
+        trace = []
+        converters = {}
+        arguments = set(map(str, self.defaults or ()))
         regex_parts = []
+        # The parts of the traces are shared by all the rules of the map
+        intern_part = self.map._trace_parts.setdefault
 
         def _build_raw_regex(rule):
             rule = r'\/' + rule.lstrip('/^')
             regex_parts.append(rule)
-            convobj = _RawConverter(self.map)
+            convobj = _get_shared_converter(self.map, _RawConverter)
             for variable in get_regex_variables(rule):
-                self._converters[variable] = convobj
+                converters[variable] = convobj
 
         def _build_regex(rule):
             if '(?P<' in rule:
                 return _build_raw_regex(rule)
 
-            for converter, arguments, variable in parse_rule(rule):
+            for converter, args, variable in parse_rule(rule):
                 if converter is None:
                     regex_parts.append(re.escape(variable))
-                    self._trace.append((False, variable))
+                    part = (False, variable)
                 else:
-                    convobj = get_converter(self.map, converter, arguments)
+                    convobj = get_converter(self.map, converter, args)
                     regex_parts.append('(?P<%s>%s)' % (variable, convobj.regex))
-                    self._converters[variable] = convobj
-                    self._trace.append((True, variable))
-                    self.arguments.add(str(variable))
+                    converters[variable] = convobj
+                    part = (True, variable)
+                    arguments.add(str(variable))
+                trace.append(intern_part(part, part))
 
         _build_regex(domain_rule)
         regex_parts.append('\\|')
-        self._trace.append((False, '|'))
+        trace.append(intern_part((False, '|'), (False, '|')))
         _build_regex(self.is_leaf and self.rule or self.rule.rstrip('/'))
         if not self.is_leaf:
-            self._trace.append((False, '/'))
+            trace.append(intern_part((False, '/'), (False, '/')))
+        self._trace = tuple(trace)
+        self._converters = converters
+        self.arguments = frozenset(arguments)
 
         if self.build_only:
             return
@@ -1110,6 +1210,12 @@ class Map(object):
         self._rules_by_endpoint = {}
         self._rules_by_name = {}
         self._remap = True
+        # Incremented every time rules are added, so the values computed
+        # from them can be cached until it changes.
+        self.rules_version = 0
+        # Shared by the rules.  See `get_converter` and `Rule.compile`.
+        self._converter_cache = {}
+        self._trace_parts = {}
 
         self.default_subdomain = default_subdomain
         self.charset = charset
@@ -1179,6 +1285,7 @@ class Map(object):
             if rule.name:
                 self._rules_by_name.setdefault(rule.name, []).append(rule)
         self._remap = True
+        self.rules_version += 1
 
     def bind(self, server_name, script_name=None, subdomain=None,
                 url_scheme='http', default_method='GET', path_info=None,
@@ -5,6 +5,7 @@
 
 """
 import datetime
+import re
 # Get the fastest json available
 try:
     import simplejson as json
@@ -33,27 +34,176 @@ DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 DATE_FORMAT = '%Y-%m-%d'
 
 
+def json_default(obj):
+    """The `default` hook used to serialize the values that JSON doesn't
+    support natively.
+
+    """
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime(DATETIME_FORMAT)
+    if isinstance(obj, datetime.date):
+        return obj.strftime(DATE_FORMAT)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
 class JSONEncoder(json.JSONEncoder):
 
     def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.strftime(DATETIME_FORMAT)
-        else:
+        try:
+            return json_default(obj)
+        except TypeError:
             return json.JSONEncoder.default(self, obj)
 
 
+def _maybe_date(value):
+    """A cheap check to discard the strings that can't be parsed neither
+    with `DATETIME_FORMAT` nor with `DATE_FORMAT`, so we don't have to pay
+    for a `strptime` call (and an exception) on every other string.
+
+    """
+    return (8 <= len(value) <= 19 and value[4:5] == '-' and
+        value[:4].isdigit())
+
+
+_DATETIME_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)$')
+_DATE_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)$')
+
+
+def _parse_date(value):
+    # Fast path for the canonical formats, the ones we generate
+    m = _DATETIME_RE.match(value) or _DATE_RE.match(value)
+    if m is not None:
+        try:
+            parts = [int(part) for part in m.groups()]
+            if len(parts) == 3:
+                return datetime.date(*parts)
+            return datetime.datetime(*parts)
+        except ValueError:
+            return value
+    try:
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    except ValueError:
+        try:
+            return datetime.datetime.strptime(value, DATE_FORMAT).date()
+        except ValueError:
+            return value
+
+
 def json_decoder(d):
     if isinstance(d, list):
         return [json_decoder(item) for item in d]
     for k, v in d.items():
-        if not isinstance(v, basestring):
+        if isinstance(v, basestring) and _maybe_date(v):
+            d[k] = _parse_date(v)
+    return d
+
+
+def get_json_decoder(parse_dates=False):
+    """Returns the `object_hook` to use when decoding JSON.
+
+    parse_dates
+    :   If `False`, no hook is used and the JSON is decoded as is.
+        If `True`, every string value that looks like a date or a datetime
+        is converted (see `json_decoder`).  It can also be a list of keys,
+        so only the values of those keys are converted.
+
+    """
+    if not parse_dates:
+        return None
+    if parse_dates is True:
+        return json_decoder
+    keys = frozenset(parse_dates)
+
+    def keys_decoder(d):
+        for k in keys.intersection(d):
+            v = d[k]
+            if isinstance(v, basestring) and _maybe_date(v):
+                d[k] = _parse_date(v)
+        return d
+    return keys_decoder
+
+
+#------------------------------------------------------------------------------
+
+
+def _stdlib_encoder(module, sort_keys):
+    # A pre-built encoder skips the argument checking and the creation of a
+    # new encoder object that `dumps` does when called with any option.
+    # With `ensure_ascii` the result is already a bytestring.
+    encoder = module.JSONEncoder(default=json_default, sort_keys=sort_keys,
+        separators=(',', ':'))
+    return encoder.encode
+
+
+def _ujson_encoder(ujson, sort_keys):
+    fallback = _stdlib_encoder(json, sort_keys)
+
+    def encode(value):
+        try:
+            return ujson.dumps(value, sort_keys=sort_keys,
+                escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            # ujson doesn't support a `default` hook
+            return fallback(value)
+    return encode
+
+
+def _orjson_encoder(orjson, sort_keys):
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+
+    def encode(value):
+        return orjson.dumps(value, default=json_default, option=option)
+    return encode
+
+
+def has_speedups(module):
+    """Is this `simplejson` compiled with its C speedups?  Without them
+    it's slower than the standard library.
+    """
+    try:
+        __import__(module.__name__ + '._speedups')
+    except ImportError:
+        return False
+    return module.encoder.c_make_encoder is not None
+
+
+JSON_BACKENDS = (
+    # name, encoder factory
+    ('orjson', _orjson_encoder),
+    # Before ujson, that has to encode again with the standard library
+    # any value with a date or another type it doesn't know.
+    ('simplejson', _stdlib_encoder),
+    ('ujson', _ujson_encoder),
+    ('json', _stdlib_encoder),
+)
+
+
+def get_json_encoder(backend=None, sort_keys=True):
+    """Returns a function that serializes a value to a JSON bytestring
+    using the `backend` library: 'orjson', 'ujson', 'simplejson' or 'json'.
+    If `backend` is `None`, the fastest one available is used (`simplejson`
+    only if it has its C speedups).
+
+    Like `to_json`, the keys are sorted unless `sort_keys` is `False`,
+    which is a little faster.
+
+    """
+    for name, factory in JSON_BACKENDS:
+        if backend is not None and name != backend:
             continue
         try:
-            d[k] = datetime.datetime.strptime(v, DATETIME_FORMAT)
-        except ValueError:
-            try:
-                d[k] = datetime.datetime.strptime(v, DATE_FORMAT).date()
-            except ValueError:
-                pass
-    return d
+            module = __import__(name)
+        except ImportError:
+            if backend is not None:
+                raise
+            continue
+        if backend is None and name == 'simplejson' and \
+                not has_speedups(module):
+            continue
+        return factory(module, sort_keys)
+    raise ValueError('Unknown JSON backend %r' % backend)
+
 
+encode_json = get_json_encoder()
@@ -0,0 +1,378 @@
+# coding=utf-8
+"""
+    Shake.server
+    --------------------------
+
+    A pre-forking WSGI server for production, using only the standard
+    library (and the request handler of Werkzeug).
+
+        app.serve(port=8000, workers=4)
+
+    or, from the command line:
+
+        shake serve main:app --port 8000 --workers 4
+
+    The master process opens the listening socket and forks the workers,
+    which share it.  If the application is imported before forking (the
+    default when passing an app object), its memory is shared
+    copy-on-write between all the workers.
+
+    Each worker accepts connections in its main thread and hands them to a
+    pool of threads through a bounded queue.  When the queue is full the
+    worker stops accepting, so the pending connections wait in the
+    listening backlog for a less busy worker instead of piling up.
+
+    Signals, sent to the master process:
+
+    SIGHUP
+    :   graceful reload: new workers are started and the old ones finish
+        their requests and exit.  If the app was given as an import string
+        and `preload` is `False`, the new workers import it again, so the
+        new code is used.
+    SIGTERM, SIGINT
+    :   graceful shutdown.
+    SIGTTIN, SIGTTOU
+    :   add or remove one worker.
+
+"""
+from __future__ import print_function
+import errno
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from Queue import Queue
+
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.utils import import_string
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+__all__ = (
+    'PreforkServer',
+)
+
+
+logger = logging.getLogger('shake.server')
+
+
+def get_default_workers():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 2
+
+
+def get_memory_usage():
+    """Returns the maximum resident memory used by this process, in bytes.
+    """
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes in Linux, bytes in OS X
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+
+class WorkerServer(BaseWSGIServer):
+    """The HTTP server run by each worker: the connections are accepted in
+    the main thread and processed by a pool of `threads` threads.
+
+    """
+    multithread = True
+    multiprocess = True
+    # Seconds to wait for a connection before checking if it must stop
+    timeout = 1.0
+
+    def __init__(self, host, port, app=None, backlog=2048,
+            connection_timeout=30):
+        self.request_queue_size = backlog
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.connection_timeout = connection_timeout
+        self.tasks = None
+        self.pool = []
+        self.requests = 0
+
+    def start_pool(self, threads, queue_size=None):
+        self.tasks = Queue(queue_size or threads * 2)
+        for _ in range(threads):
+            thread = threading.Thread(target=self.process_tasks)
+            thread.daemon = True
+            thread.start()
+            self.pool.append(thread)
+
+    def stop_pool(self, timeout=None):
+        """Processes the queued connections and stops the threads."""
+        for _ in self.pool:
+            self.tasks.put(None)
+        deadline = time.time() + timeout if timeout else None
+        for thread in self.pool:
+            thread.join(None if deadline is None else
+                max(0, deadline - time.time()))
+        self.pool = []
+
+    def process_request(self, request, client_address):
+        self.requests += 1
+        # So slow or idle clients can't hold the threads forever
+        if self.connection_timeout:
+            request.settimeout(self.connection_timeout)
+        # Blocks while all the threads are busy and the queue is full
+        self.tasks.put((request, client_address))
+
+    def process_tasks(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            request, client_address = task
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logger.exception('Error processing a request from %s',
+            client_address[0] if client_address else '-')
+
+
+class PreforkServer(object):
+    """Runs a WSGI application in `workers` processes forked from this one.
+
+    app
+    :   a WSGI application or its import string, eg: 'main:app'.
+    host, port
+    :   where to listen.
+    workers
+    :   number of worker processes.  Defaults to the number of CPUs.
+    threads
+    :   number of threads of each worker.
+    queue_size
+    :   connections accepted by each worker that can wait for a free thread.
+        Defaults to twice the number of threads.
+    backlog
+    :   the size of the listening queue of the socket.
+    timeout
+    :   seconds a connection can stay idle (while sending the request or
+        receiving the response) before it's closed.  `0` to disable it.
+    max_requests
+    :   restart each worker after this many requests (plus a random
+        jitter of up to 10%), to limit the damage of memory leaks.
+        `0` to disable it.
+    max_memory
+    :   restart a worker when it uses more than this many megabytes.
+        `0` to disable it.
+    graceful_timeout
+    :   seconds the workers have to finish their requests when stopping
+        before being killed.
+    preload
+    :   import the application before forking the workers.  Always `True`
+        if `app` is not an import string.
+    freeze
+    :   call `app.freeze()` (if the app has it) before forking or, without
+        `preload`, when each worker starts.
+
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=5000, workers=None,
+            threads=8, queue_size=None, backlog=2048, timeout=30,
+            max_requests=0, max_memory=0, graceful_timeout=30, preload=True,
+            freeze=True):
+        self.app = app
+        self.host = host
+        self.port = int(port)
+        self.num_workers = int(workers or get_default_workers())
+        self.threads = int(threads)
+        self.queue_size = queue_size
+        self.backlog = int(backlog)
+        self.timeout = timeout
+        self.max_requests = int(max_requests)
+        self.max_memory = int(max_memory) * 1024 * 1024
+        self.graceful_timeout = graceful_timeout
+        self.preload = preload or not isinstance(app, basestring)
+        self.freeze = freeze
+        self.server = None
+        self.workers = {}  # {pid: generation}
+        self.generation = 0
+        self.signals = []
+        self.stopping = False
+
+    def load_app(self):
+        app = self.app
+        if isinstance(app, basestring):
+            app = import_string(app)
+        if self.freeze and hasattr(app, 'freeze'):
+            app.freeze()
+        return app
+
+    def log(self, message, *args):
+        print('[%i] %s' % (os.getpid(), message % args))
+        sys.stdout.flush()
+
+    # Master
+
+    def run(self):
+        """Opens the socket, starts the workers and supervises them until
+        a SIGTERM or SIGINT is received.
+        """
+        app = self.load_app() if self.preload else None
+        self.server = WorkerServer(self.host, self.port, app,
+            backlog=self.backlog, connection_timeout=self.timeout)
+        self.port = self.server.server_address[1]
+        self.log('Listening at http://%s:%i (%i workers, %i threads each)',
+            self.host, self.port, self.num_workers, self.threads)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, self.on_signal)
+        try:
+            self.manage_workers()
+            while not self.stopping:
+                # Interrupted by any signal
+                time.sleep(1)
+                self.process_signals()
+                self.reap_workers()
+                self.manage_workers()
+        finally:
+            self.stop()
+            self.server.server_close()
+
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def process_signals(self):
+        while self.signals:
+            signum = self.signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self.stopping = True
+            elif signum == signal.SIGHUP:
+                self.reload()
+            elif signum == signal.SIGTTIN:
+                self.num_workers += 1
+            elif signum == signal.SIGTTOU and self.num_workers > 1:
+                self.num_workers -= 1
+
+    def reload(self):
+        """Starts a new generation of workers and gracefully stops the
+        old ones.
+        """
+        self.log('Reloading')
+        old = list(self.workers)
+        self.generation += 1
+        self.manage_workers()
+        self.kill_workers(old, signal.SIGTERM)
+
+    def manage_workers(self):
+        if self.stopping:
+            return
+        current = [pid for pid, gen in self.workers.items()
+            if gen == self.generation]
+        for _ in range(self.num_workers - len(current)):
+            self.spawn_worker()
+        # Too many workers (after a SIGTTOU)
+        extra = len(current) - self.num_workers
+        if extra > 0:
+            self.kill_workers(sorted(current)[:extra], signal.SIGTERM)
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return pid
+        # In the worker
+        status = 0
+        try:
+            self.run_worker()
+        except Exception:
+            logger.exception('Worker failed')
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+
+    def kill_workers(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    self.workers.pop(pid, None)
+
+    def stop(self):
+        """Gracefully stops all the workers, killing those that don't
+        finish in `graceful_timeout` seconds.
+        """
+        self.stopping = True
+        self.kill_workers(list(self.workers), signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        self.kill_workers(list(self.workers), signal.SIGKILL)
+        self.reap_workers()
+
+    # Worker
+
+    def run_worker(self):
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+        for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGTTIN,
+                signal.SIGTTOU):
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        random.seed()
+
+        server = self.server
+        # All the workers are woken up by a new connection but only one
+        # gets it, the others must not block in `accept()`.
+        server.socket.setblocking(0)
+        if server.app is None:
+            server.app = self.load_app()
+        server.start_pool(self.threads, self.queue_size)
+        tasks = getattr(server.app, 'tasks', None)
+        if tasks is not None and tasks.store is not None:
+            # Run the tasks left by the workers that died without waiting
+            # for a request to defer a new one.
+            try:
+                tasks.start()
+            except Exception:
+                logger.exception('Error recovering the tasks')
+        max_requests = self.max_requests
+        if max_requests:
+            max_requests += random.randint(0, max_requests // 10)
+        max_memory = self.max_memory
+
+        while not stopping:
+            server.handle_request()
+            if max_requests and server.requests >= max_requests:
+                self.log('Max requests reached, restarting')
+                break
+            if max_memory and get_memory_usage() > max_memory:
+                self.log('Max memory reached, restarting')
+                break
+        server.stop_pool(self.graceful_timeout)
+        if tasks is not None:
+            if tasks.store is None:
+                # Nowhere to keep them, so finish the queued tasks
+                tasks.join(self.graceful_timeout)
+            tasks.stop(self.graceful_timeout)
@@ -4,24 +4,32 @@
     --------------------------
 
 """
-from datetime import datetime
+from datetime import datetime, date, timedelta, tzinfo
 import hashlib
+import logging
 import os
+import struct
 from time import time
+import zlib
 
 from jinja2 import Markup
-from itsdangerous import URLSafeTimedSerializer, BadSignature
+from itsdangerous import (URLSafeTimedSerializer, TimedSerializer, BadData,
+    BadPayload, base64_encode, base64_decode)
 from werkzeug.datastructures import CallbackDict
+from werkzeug.http import dump_cookie
 
 from .helpers import local, to64
 
 
 __all__ = (
     'Session', 'NullSession', 'SessionInterface', 'ItsdangerousSessionInterface',
-    'generate_key', 'CSRFToken', 'get_csrf', 'new_csrf', 'flash', 'get_messages',
+    'BinarySessionSerializer', 'generate_key', 'CSRFToken', 'get_csrf', 'new_csrf', 'flash', 'get_messages',
 )
 
 
+logger = logging.getLogger('shake.session')
+
+
 CSRF_FORM_NAME = '_csrf'
 CSRF_SESSION_NAME = '_c'
 LOCAL_FLASHES = '_fm'
@@ -186,61 +194,326 @@ class SessionInterface(object):
         request.session = self.session_class()
 
 
+class BinarySessionSerializer(object):
+    """A compact binary serializer for the session data, meant to replace
+    the default JSON one of `ItsdangerousSessionInterface`:
+
+        app.session_interface = ItsdangerousSessionInterface(app,
+            serializer=BinarySessionSerializer())
+
+    Besides the JSON types, it can also store `datetime` (naive or aware,
+    keeping its UTC offset) and `date` values.
+    The payload is zlib-compressed only when it's bigger than
+    `compress_threshold` bytes and is prefixed with a version byte, so the
+    format can be changed later while still reading the old cookies.
+
+    """
+
+    version = 1
+
+    def __init__(self, compress_threshold=128, compress_level=6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.decoders = {1: _binary_loads}
+
+    def dumps(self, obj):
+        data = _binary_dumps(obj)
+        flags = 0
+        if len(data) > self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                data = compressed
+                flags = _FLAG_ZLIB
+        return struct.pack('>BB', self.version, flags) + data
+
+    def loads(self, data):
+        version, flags = struct.unpack('>BB', data[:2])
+        decoder = self.decoders.get(version)
+        if decoder is None:
+            raise ValueError('Unknown session format version %r' % version)
+        data = data[2:]
+        if flags & _FLAG_ZLIB:
+            data = zlib.decompress(data)
+        return decoder(data)
+
+
+_FLAG_ZLIB = 1
+
+_DATETIME = struct.Struct('>HBBBBBI')
+# A `_DATETIME` plus its UTC offset, in seconds
+_AWARE_DATETIME = struct.Struct('>HBBBBBIi')
+_DATE = struct.Struct('>HBB')
+_FLOAT = struct.Struct('>d')
+
+
+class FixedOffset(tzinfo):
+    """A timezone `offset` seconds away from UTC.  Used for the aware
+    datetimes read from the session.
+    """
+
+    def __init__(self, offset):
+        self.offset = timedelta(seconds=offset)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+    def __eq__(self, other):
+        return isinstance(other, FixedOffset) and self.offset == other.offset
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<FixedOffset %s>' % self.offset
+
+
+def _write_varint(out, num):
+    while True:
+        byte = num & 0x7f
+        num >>= 7
+        if num:
+            out.append(chr(byte | 0x80))
+        else:
+            out.append(chr(byte))
+            return
+
+
+def _read_varint(data, pos):
+    num = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        num |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return num, pos
+        shift += 7
+
+
+def _encode(obj, out):
+    if obj is None:
+        out.append('N')
+    elif obj is True:
+        out.append('T')
+    elif obj is False:
+        out.append('F')
+    elif isinstance(obj, (int, long)):
+        if obj < 0:
+            out.append('-')
+            obj = -obj
+        else:
+            out.append('i')
+        _write_varint(out, obj)
+    elif isinstance(obj, float):
+        out.append('f')
+        out.append(_FLOAT.pack(obj))
+    elif isinstance(obj, unicode):
+        obj = obj.encode('utf8')
+        out.append('u')
+        _write_varint(out, len(obj))
+        out.append(obj)
+    elif isinstance(obj, str):
+        out.append('s')
+        _write_varint(out, len(obj))
+        out.append(obj)
+    elif isinstance(obj, datetime):
+        offset = obj.utcoffset()
+        if offset is None:
+            out.append('D')
+            out.append(_DATETIME.pack(obj.year, obj.month, obj.day,
+                obj.hour, obj.minute, obj.second, obj.microsecond))
+        else:
+            out.append('Z')
+            out.append(_AWARE_DATETIME.pack(obj.year, obj.month, obj.day,
+                obj.hour, obj.minute, obj.second, obj.microsecond,
+                offset.days * 86400 + offset.seconds))
+    elif isinstance(obj, date):
+        out.append('d')
+        out.append(_DATE.pack(obj.year, obj.month, obj.day))
+    elif isinstance(obj, (list, tuple)):
+        out.append('l')
+        _write_varint(out, len(obj))
+        for item in obj:
+            _encode(item, out)
+    elif isinstance(obj, dict):
+        out.append('m')
+        _write_varint(out, len(obj))
+        for key, value in obj.iteritems():
+            _encode(key, out)
+            _encode(value, out)
+    else:
+        raise TypeError('%r is not serializable in a session' % (obj,))
+
+
+def _decode(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == 'N':
+        return None, pos
+    if tag == 'T':
+        return True, pos
+    if tag == 'F':
+        return False, pos
+    if tag in 'i-':
+        num, pos = _read_varint(data, pos)
+        return (num if tag == 'i' else -num), pos
+    if tag == 'f':
+        end = pos + _FLOAT.size
+        return _FLOAT.unpack(data[pos:end])[0], end
+    if tag in 'us':
+        size, pos = _read_varint(data, pos)
+        end = pos + size
+        value = data[pos:end]
+        if tag == 'u':
+            value = value.decode('utf8')
+        return value, end
+    if tag == 'D':
+        end = pos + _DATETIME.size
+        return datetime(*_DATETIME.unpack(data[pos:end])), end
+    if tag == 'Z':
+        end = pos + _AWARE_DATETIME.size
+        values = _AWARE_DATETIME.unpack(data[pos:end])
+        return datetime(*values[:-1], tzinfo=FixedOffset(values[-1])), end
+    if tag == 'd':
+        end = pos + _DATE.size
+        return date(*_DATE.unpack(data[pos:end])), end
+    if tag == 'l':
+        size, pos = _read_varint(data, pos)
+        items = []
+        for i in xrange(size):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == 'm':
+        size, pos = _read_varint(data, pos)
+        items = {}
+        for i in xrange(size):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+    raise ValueError('Invalid session data')
+
+
+def _binary_dumps(obj):
+    out = []
+    _encode(obj, out)
+    return ''.join(out)
+
+
+def _binary_loads(data):
+    obj, pos = _decode(data, 0)
+    if pos != len(data):
+        raise ValueError('Invalid session data')
+    return obj
+
+
+class _Base64TimedSerializer(TimedSerializer):
+    """Like `URLSafeTimedSerializer` but without its zlib step, because
+    `BinarySessionSerializer` already takes care of the compression.
+
+    """
+
+    def load_payload(self, payload):
+        try:
+            payload = base64_decode(payload)
+        except Exception as e:
+            raise BadPayload('Could not base64 decode the payload because of '
+                'an exception', original_error=e)
+        return super(_Base64TimedSerializer, self).load_payload(payload)
+
+    def dump_payload(self, obj):
+        payload = super(_Base64TimedSerializer, self).dump_payload(obj)
+        return base64_encode(payload)
+
+
 class ItsdangerousSessionInterface(SessionInterface):
 
     session_class = Session
     digest_method = staticmethod(hashlib.sha256)
 
-    def __init__(self, app, salt='shake-session'):
+    def __init__(self, app, salt='shake-session', serializer=None):
+        """
+
+        app
+        :   the `Shake` application.
+        salt
+        :   salt used when signing the cookie.
+        serializer
+        :   optional object with `dumps` and `loads` methods to encode the
+            session data (eg: a `BinarySessionSerializer` instance).  If
+            not provided, the data is stored as compressed JSON.
+
+        """
         super(ItsdangerousSessionInterface, self).__init__(app)
         self.salt = salt
+        self.serializer = serializer
 
     def get_serializer(self):
         secret_key = self.app.settings.get('SECRET_KEY')
         if not secret_key:
             return None
-        s = URLSafeTimedSerializer(secret_key, salt=self.salt)
+        if self.serializer is None:
+            s = URLSafeTimedSerializer(secret_key, salt=self.salt)
+        else:
+            s = _Base64TimedSerializer(secret_key, salt=self.salt,
+                serializer=self.serializer)
         s.digest_method = self.digest_method
         return s
 
+    def get_cookie_max_size(self):
+        """Returns the maximum size, in bytes, of the `Set-Cookie` header
+        of the session (name, value and attributes).  This is the value of
+        the ``SESSION_COOKIE_MAX_SIZE`` setting.
+
+        """
+        return self.app.settings.SESSION_COOKIE_MAX_SIZE
+
     def open_session(self, request):
-        s = self.get_serializer()
+        # The settings-derived values are computed once, see `Shake.get_plan`
+        plan = self.app.get_plan()
+        s = plan.session_serializer
         if s is None:
             return self.make_null_session()
 
-        cookie_name = self.app.settings['SESSION_COOKIE_NAME']
-        val = request.cookies.get(cookie_name)
+        val = request.get_cookie(plan.cookie_name)
         if not val:
             return self.session_class()
 
-        # Python 2.6 compatibility hack :(
-        td = self.app.session_lifetime
-        max_age = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 1e6) / 1e6
-        # max_age = self.app.session_lifetime.total_seconds()
         try:
-            data = s.loads(val, max_age=max_age)
+            data = s.loads(val, max_age=plan.session_max_age)
             session = self.session_class(data)
             return session
 
-        except BadSignature:
+        except BadData:
             return self.session_class()
 
     def save_session(self, session, response):
-        domain = self.get_cookie_domain()
-        cookie_name = self.app.settings['SESSION_COOKIE_NAME']
-        # if not session:
-        #     if session.modified:
-        #         response.delete_cookie(cookie_name, domain=domain)
-        #     return response
-        expires = self.get_expiration_time(session)
-        s = self.get_serializer()
+        plan = self.app.get_plan()
+        s = plan.session_serializer
         if s is None:
             return response
 
         session_data = s.dumps(dict(session))
-        httponly = self.get_cookie_httponly()
-        response.set_cookie(cookie_name, session_data, expires=expires,
-            httponly=httponly, domain=domain)
+        expires = self.get_expiration_time(session)
+        # Like `response.set_cookie` but measuring the whole header
+        header = dump_cookie(plan.cookie_name, session_data, expires=expires,
+            path=plan.cookie_path, domain=plan.cookie_domain,
+            secure=plan.cookie_secure, httponly=plan.cookie_httponly,
+            charset=response.charset)
+        max_size = plan.cookie_max_size
+        if max_size and len(header) > max_size:
+            # The browser would silently drop the cookie, so instead we keep
+            # the previous one and make some noise about it.
+            logger.warning('The session cookie is too big (%i bytes, the '
+                'limit is %i) and will not be updated.', len(header), max_size)
+            return response
+
+        response.headers.add('Set-Cookie', header)
         return response
 
     def invalidate(self, request):
@@ -18,6 +18,20 @@ def server(host='0.0.0.0', port=None, **kwargs):
     app.run(host, port, **kwargs)
 
 
+@manager.command
+def serve(host='0.0.0.0', port=None, **kwargs):
+    """[-host HOST] [-port PORT] [--workers N] [--threads N] [--timeout N]
+    Runs the application on the pre-forking production server.
+    """
+    kwargs = dict((key.replace('-', '_'), value)
+        for key, value in kwargs.items())
+    for name in ('workers', 'threads', 'timeout', 'max_requests',
+            'max_memory'):
+        if name in kwargs:
+            kwargs[name] = int(kwargs[name])
+    app.serve(host, port, **kwargs)
+
+
 @manager.command
 def syncdb():
     """Create the database tables (if they don't exist)"""
@@ -0,0 +1,323 @@
+# coding=utf-8
+"""
+    Shake.static
+    --------------------------
+
+    A WSGI middleware to serve the static files in production, when the
+    application server is the edge.
+
+        app.add_static('/static', STATIC_DIR)
+        app.serve_static()
+
+    The static directories are scanned once, at startup, so looking up a
+    file doesn't touch the filesystem.  If a precompressed `.br` or `.gz`
+    sibling of a file exists (eg: `app.css.gz`), it's sent instead when the
+    client accepts that encoding.  Files with a content hash in their name
+    (eg: `app.3f2a9c1b.css`) are sent with a far-future, immutable
+    `Cache-Control`.
+
+    The `shake fingerprint` command hashes the static files and writes a
+    `manifest.json` of `{name: hashed name}` in each static directory.
+    `Shake.static_url` (also a template global) resolves the names with it,
+    so the hashed URLs can be cached forever.
+
+"""
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+
+from werkzeug.http import http_date, parse_etags
+
+from .helpers import FileChunks, make_file_etag
+
+
+__all__ = (
+    'StaticFiles', 'fingerprint', 'load_manifest',
+)
+
+
+logger = logging.getLogger('shake.static')
+
+
+# Seconds to cache the files without a content hash in their names.
+DEFAULT_MAX_AGE = 60 * 60 * 12
+
+# One year, the maximum recommended by the HTTP spec.
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+# The precompressed siblings, in order of preference
+ENCODINGS = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+)
+
+# Matches names like `app.3f2a9c1b.css`
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{8,}\.[^./]+$')
+
+MANIFEST_NAME = 'manifest.json'
+
+_encoding_q_re = re.compile(r';\s*q\s*=\s*([0-9.]+)')
+
+
+class StaticFile(object):
+    """The precomputed response of a static file: the path of the file to
+    send and the headers of each available encoding.
+    """
+    __slots__ = ('path', 'etag', 'variants')
+
+    def __init__(self, path, etag, variants):
+        self.path = path
+        self.etag = etag
+        # {encoding or None: (path, size, etag, headers)}
+        self.variants = variants
+
+
+class StaticFiles(object):
+    """Serves the files in the `dirs` and passes every other request to
+    the wrapped `app`.
+
+    app
+    :   the WSGI application to wrap.
+    dirs
+    :   a dict of `{url: directory}`, like `Shake.static_dirs`.
+    max_age
+    :   seconds to cache the files (except the hashed ones).
+
+    If a directory has a `manifest.json` (see `fingerprint`), the hashed
+    names in it are also served, even if the files were not copied.  The
+    entries that don't match the current content of their files are
+    ignored.
+
+    """
+
+    def __init__(self, app, dirs, max_age=DEFAULT_MAX_AGE):
+        self.app = app
+        self.dirs = dirs
+        self.max_age = max_age
+        self.files = {}
+        self.reload()
+
+    def reload(self):
+        """Scans the static directories again."""
+        files = {}
+        for url, directory in self.dirs.items():
+            url = url.rstrip('/')
+            for root, dirnames, filenames in os.walk(directory):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                for filename in filenames:
+                    if filename.startswith('.') or filename == MANIFEST_NAME:
+                        continue
+                    path = os.path.join(root, filename)
+                    name = os.path.relpath(path, directory).replace(os.sep, '/')
+                    entry = self.make_entry(path, HASHED_NAME_RE.search(name))
+                    if entry is not None:
+                        files[url + '/' + name] = entry
+            manifest = load_manifest(directory, verify=True)
+            for name, hashed_name in manifest.items():
+                path = os.path.join(directory, *name.split('/'))
+                if not os.path.isfile(path):
+                    continue
+                entry = self.make_entry(path, True)
+                if entry is not None:
+                    files[url + '/' + hashed_name] = entry
+        self.files = files
+
+    def make_entry(self, path, immutable):
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return None
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+        etag = make_file_etag(path, stat)
+        if immutable:
+            cache_control = 'public, max-age=%i, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            cache_control = 'public, max-age=%i' % self.max_age
+
+        variants = {}
+        compressed = [(encoding, path + ext) for encoding, ext in ENCODINGS
+            if os.path.isfile(path + ext)]
+        base_headers = [
+            ('Content-Type', mimetype),
+            ('Cache-Control', cache_control),
+            ('Last-Modified', http_date(stat.st_mtime)),
+        ]
+        if compressed:
+            base_headers.append(('Vary', 'Accept-Encoding'))
+
+        quoted = '"%s"' % etag
+        variants[None] = (path, stat.st_size, quoted, base_headers + [
+            ('Content-Length', str(stat.st_size)),
+            ('ETag', quoted),
+        ])
+        for encoding, cpath in compressed:
+            size = os.path.getsize(cpath)
+            quoted = '"%s-%s"' % (etag, encoding)
+            variants[encoding] = (cpath, size, quoted, base_headers + [
+                ('Content-Encoding', encoding),
+                ('Content-Length', str(size)),
+                ('ETag', quoted),
+            ])
+        return StaticFile(path, etag, variants)
+
+    def get_encoding(self, entry, environ):
+        if len(entry.variants) == 1:
+            return None
+        accepted = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        for encoding, ext in ENCODINGS:
+            if encoding in entry.variants and encoding in accepted:
+                return encoding
+        return None
+
+    def __call__(self, environ, start_response):
+        entry = self.files.get(environ.get('PATH_INFO', ''))
+        method = environ.get('REQUEST_METHOD')
+        if entry is None or method not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        path, size, etag, headers = \
+            entry.variants[self.get_encoding(entry, environ)]
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and parse_etags(if_none_match).contains_raw(etag):
+            start_response('304 Not Modified', [h for h in headers
+                if h[0] not in ('Content-Length', 'Content-Type')])
+            return []
+
+        if method == 'HEAD':
+            start_response('200 OK', headers)
+            return []
+        try:
+            file = io.open(path, 'rb')
+        except EnvironmentError:
+            # Deleted since the startup
+            return self.app(environ, start_response)
+        start_response('200 OK', headers)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(file)
+        return FileChunks(file, [(0, size)])
+
+
+def parse_accept_encoding(header):
+    """Returns the set of encodings accepted by the client."""
+    accepted = set()
+    if not header:
+        return accepted
+    for item in header.split(','):
+        name, sep, params = item.partition(';')
+        name = name.strip().lower()
+        if sep:
+            match = _encoding_q_re.search(';' + params)
+            if match is not None:
+                try:
+                    if float(match.group(1)) <= 0:
+                        continue
+                except ValueError:
+                    continue
+        accepted.add(name)
+    return accepted
+
+
+def load_manifest(directory, verify=False):
+    """Returns the `{name: hashed name}` manifest of the static
+    `directory`, or an empty dict if there isn't one.
+
+    verify
+    :   hash the files again and leave out the entries of those that
+        have changed since the manifest was written.
+
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with io.open(path, 'rt', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not verify:
+        return manifest
+    result = {}
+    for name, hashed_name in manifest.items():
+        if is_current(directory, name, hashed_name):
+            result[name] = hashed_name
+        else:
+            logger.warning('Outdated manifest entry %r in %s', name,
+                directory)
+    return result
+
+
+def is_current(directory, name, hashed_name):
+    """Is `hashed_name` the name that `fingerprint` would give to the
+    file `name` of the `directory` now?
+    """
+    length = len(hashed_name) - len(name) - 1
+    if length <= 0:
+        return False
+    path = os.path.join(directory, *name.split('/'))
+    try:
+        digest = get_file_hash(path, length)
+    except EnvironmentError:
+        return False
+    return get_hashed_name(name, digest) == hashed_name
+
+
+def get_file_hash(path, length=10, chunk_size=64 * 1024):
+    hasher = hashlib.md5()
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()[:length]
+
+
+def get_hashed_name(name, digest):
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def fingerprint(directory, copy=False, hash_length=10):
+    """Hashes every file in the static `directory` and writes a
+    `manifest.json` of `{name: hashed name}` in it, eg:
+    `{"styles/app.css": "styles/app.3f2a9c1b07.css"}`.  Returns the
+    manifest.
+
+    copy
+    :   also copy each file (and its `.br`/`.gz` siblings) to its hashed
+        name.  Not needed if the files are served by `StaticFiles`.
+    hash_length
+    :   how many hexadecimal digits of the hash to use.
+
+    Hidden files, precompressed siblings and the names that already have a
+    hash are skipped.
+
+    """
+    manifest = {}
+    extensions = tuple(ext for encoding, ext in ENCODINGS)
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if (filename.startswith('.') or filename == MANIFEST_NAME or
+                    filename.endswith(extensions) or
+                    HASHED_NAME_RE.search(filename)):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            hashed_name = get_hashed_name(name,
+                get_file_hash(path, hash_length))
+            manifest[name] = hashed_name
+            if not copy:
+                continue
+            hashed_path = os.path.join(directory, *hashed_name.split('/'))
+            shutil.copy2(path, hashed_path)
+            for ext in extensions:
+                if os.path.isfile(path + ext):
+                    shutil.copy2(path + ext, hashed_path + ext)
+
+    path = os.path.join(directory, MANIFEST_NAME)
+    with io.open(path, 'wb') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True).encode('utf8'))
+    return manifest
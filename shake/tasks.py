@@ -0,0 +1,486 @@
+# coding=utf-8
+"""
+    Shake.tasks
+    --------------------------
+
+    Work deferred until after the response is sent, so slow side effects
+    (sending mail, calling other services...) don't delay it.
+
+        def signup(request):
+            user = create_user(request.form)
+            app.defer(send_welcome_mail, user.email)
+            return redirect('/welcome/')
+
+    The tasks deferred during a request are queued when the response has
+    been sent; outside of a request, they are queued immediately.  They run
+    in a pool of threads of each process, started the first time a task is
+    queued (so a pre-forking server can fork the application safely).
+
+    A task that raises an exception is retried, after an exponentially
+    growing delay, up to `max_retries` times.
+
+    With a `SQLiteStore` the tasks are also written to a local SQLite
+    database until they are done, so the pending ones survive a restart.
+    The functions must then be importable (module-level functions) and
+    their arguments serializable to JSON.  The tasks that fail for good
+    are kept in the database with the state `'failed'`.
+
+"""
+import errno
+import heapq
+import itertools
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+from timeit import default_timer as clock
+
+from werkzeug.utils import import_string
+
+from .serializers import json
+
+
+__all__ = (
+    'TaskQueue', 'QueueFull', 'SQLiteStore',
+)
+
+
+logger = logging.getLogger('shake.tasks')
+
+
+class QueueFull(Exception):
+    """The queue already has `max_size` tasks waiting."""
+
+
+class Task(object):
+    __slots__ = ('id', 'func', 'name', 'args', 'kwargs', 'attempts', 'run_at')
+
+    def __init__(self, func, args=(), kwargs=None, name=None, id=None,
+            attempts=0, run_at=0):
+        self.func = func
+        self.name = name
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.id = id
+        self.attempts = attempts
+        self.run_at = run_at
+
+    def __repr__(self):
+        return '<Task %s>' % (self.name or getattr(self.func, '__name__', '?'))
+
+
+def get_import_name(func):
+    """Returns the import string of `func`, eg: 'main.mail:send_mail', or
+    raises a `ValueError` if it can't be imported by that name.
+    """
+    module = getattr(func, '__module__', None)
+    name = getattr(func, '__name__', None)
+    if module and name:
+        import_name = '%s:%s' % (module, name)
+        try:
+            if import_string(import_name) is func:
+                return import_name
+        except ImportError:
+            pass
+    raise ValueError('%r is not a module-level function, so it '
+        'can\'t be stored' % func)
+
+
+class SQLiteStore(object):
+    """Keeps the queued tasks in a SQLite database.
+
+    Each process only recovers the tasks of processes that are no
+    longer running, so several workers can share the same database.
+
+    path
+    :   the path of the database file.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        # The connections can't be shared with a forked process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                check_same_thread=False)
+            self._pid = os.getpid()
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                func TEXT NOT NULL,
+                args TEXT NOT NULL,
+                kwargs TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at REAL NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                owner INTEGER,
+                error TEXT)''')
+            self._conn.commit()
+        return self._conn
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            conn = self.get_connection()
+            try:
+                cursor = conn.execute(sql, params)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return cursor
+
+    def add(self, task):
+        task.id = self.execute('INSERT INTO tasks '
+            '(func, args, kwargs, attempts, run_at, owner) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (task.name, json.dumps(task.args), json.dumps(task.kwargs),
+            task.attempts, task.run_at, os.getpid())).lastrowid
+
+    def retry(self, task, error):
+        self.execute('UPDATE tasks SET attempts = ?, run_at = ?, error = ? '
+            'WHERE id = ?', (task.attempts, task.run_at, error, task.id))
+
+    def done(self, task):
+        self.execute('DELETE FROM tasks WHERE id = ?', (task.id,))
+
+    def fail(self, task, error):
+        self.execute('UPDATE tasks SET state = \'failed\', attempts = ?, '
+            'error = ? WHERE id = ?', (task.attempts, error, task.id))
+
+    def recover(self):
+        """Claims the queued tasks of the processes that are no longer
+        running and returns them.
+        """
+        pid = os.getpid()
+        with self._lock:
+            conn = self.get_connection()
+            try:
+                owners = [row[0] for row in conn.execute('SELECT DISTINCT '
+                    'owner FROM tasks WHERE state = \'queued\'')]
+                dead = [owner for owner in owners
+                    if owner != pid and not is_running(owner)]
+                for owner in dead:
+                    conn.execute('UPDATE tasks SET owner = ? WHERE '
+                        'owner IS ? AND state = \'queued\'', (pid, owner))
+                rows = conn.execute('SELECT id, func, args, kwargs, attempts, '
+                    'run_at FROM tasks WHERE owner = ? AND state = \'queued\'',
+                    (pid,)).fetchall()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        tasks = []
+        for id, name, args, kwargs, attempts, run_at in rows:
+            tasks.append(Task(None, json.loads(args), json.loads(kwargs),
+                name=name, id=id, attempts=attempts, run_at=run_at))
+        return tasks
+
+    def failed(self):
+        """Returns the tasks that failed for good as a list of
+        `(id, func, args, kwargs, attempts, error)`.
+        """
+        rows = self.execute('SELECT id, func, args, kwargs, attempts, error '
+            'FROM tasks WHERE state = \'failed\' ORDER BY id').fetchall()
+        return [(id, name, json.loads(args), json.loads(kwargs), attempts,
+            error) for id, name, args, kwargs, attempts, error in rows]
+
+
+def is_running(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class TaskQueue(object):
+    """Runs functions in a pool of background threads.
+
+    workers
+    :   the number of threads.
+    max_size
+    :   the maximum number of tasks waiting to run (including those
+        waiting to be retried and those deferred by requests that haven't
+        finished).  When full, `put` and `reserve` raise `QueueFull`.
+    max_retries
+    :   how many times a failed task is retried.
+    retry_delay
+    :   seconds before the first retry.  The delay doubles with each
+        retry (with some random jitter) up to `max_retry_delay`.
+    store
+    :   a `SQLiteStore` to persist the tasks, or `None` to keep them
+        only in memory.
+
+    """
+
+    def __init__(self, workers=2, max_size=1000, max_retries=3,
+            retry_delay=1.0, max_retry_delay=300, store=None):
+        self.num_workers = workers
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.store = store
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._threads = []
+        self._pid = None
+        self._stopping = False
+        # Slots reserved by `reserve()` for tasks not yet queued, and the
+        # process they were reserved in.
+        self.reserved = 0
+        self._reserved_pid = os.getpid()
+        # Stats
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+        self.run_time = 0.0
+
+    def make_task(self, func, args=(), kwargs=None):
+        """Returns a new task, checking that it can be persisted if the
+        queue has a store.
+        """
+        name = None
+        if self.store is not None:
+            name = get_import_name(func)
+            # Fail now, instead of after the response
+            json.dumps(args)
+            json.dumps(kwargs or {})
+        return Task(func, args, kwargs, name=name)
+
+    def _check_capacity(self):
+        # Called with the lock held
+        if len(self._heap) + self.reserved >= self.max_size:
+            self.rejected += 1
+            raise QueueFull('The task queue is full')
+
+    def reserve(self):
+        """Reserves a place in the queue for a task that will be queued
+        later with `put(task, reserved=True)`, or raises `QueueFull`.
+        Used for the tasks deferred during a request.
+        """
+        with self._cond:
+            self._check_capacity()
+            self.reserved += 1
+
+    def unreserve(self, count=1):
+        """Frees places reserved for tasks that will not be queued."""
+        with self._cond:
+            self.reserved = max(0, self.reserved - count)
+
+    def put(self, task, reserved=False):
+        """Queues a task to run as soon as a thread is free.  Raises
+        `QueueFull` if there are already `max_size` tasks waiting, unless
+        its place was `reserved`.
+        """
+        self.start()
+        with self._cond:
+            if reserved:
+                self.reserved = max(0, self.reserved - 1)
+            else:
+                self._check_capacity()
+        if self.store is not None:
+            self.store.add(task)
+        with self._cond:
+            self.submitted += 1
+            self._push(task)
+
+    def put_many(self, tasks, reserved=False):
+        """Queues all the `tasks`, logging, instead of raising, the
+        errors.
+        """
+        for task in tasks:
+            try:
+                self.put(task, reserved=reserved)
+            except Exception:
+                logger.exception('Error queueing %r', task)
+
+    def _push(self, task):
+        # Called with the lock held
+        heapq.heappush(self._heap, (task.run_at, next(self._counter), task))
+        self._cond.notify()
+
+    def start(self):
+        """Starts the threads, if they aren't running in this process,
+        and queues the tasks recovered from the store.  Called by `put`
+        and, if there is a store, when a worker of `PreforkServer` starts.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._cond:
+            if self._pid == pid:
+                return
+            # After a fork only the calling thread survives: the tasks
+            # queued in the parent are its business, not ours.
+            self._heap = []
+            self._threads = []
+            self._stopping = False
+            self.running = 0
+            if self._reserved_pid != pid:
+                self.reserved = 0
+                self._reserved_pid = pid
+            if self.store is not None:
+                for task in self.store.recover():
+                    self._push(task)
+            for _ in range(self.num_workers):
+                thread = threading.Thread(target=self.work,
+                    name='shake-tasks')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = pid
+
+    def stop(self, timeout=None):
+        """Stops the threads after they finish their current task.  The
+        queued tasks that haven't started are lost, unless the queue has
+        a store.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.time() + timeout if timeout else None
+        for thread in self._threads:
+            thread.join(None if deadline is None else
+                max(0, deadline - time.time()))
+        self._threads = []
+        self._pid = None
+
+    def join(self, timeout=None):
+        """Waits until there are no tasks queued or running (including
+        those waiting to be retried).  Returns `False` on timeout.
+        """
+        deadline = time.time() + timeout if timeout else None
+        with self._cond:
+            while self._heap or self.running:
+                if deadline is None:
+                    self._cond.wait(1)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 1))
+        return True
+
+    def _next_task(self):
+        cond = self._cond
+        with cond:
+            while not self._stopping:
+                heap = self._heap
+                if heap:
+                    wait = heap[0][0] - time.time()
+                    if wait <= 0:
+                        self.running += 1
+                        return heapq.heappop(heap)[2]
+                    cond.wait(wait)
+                else:
+                    cond.wait()
+        return None
+
+    def work(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            try:
+                self.run(task)
+            except Exception:
+                # Nothing must kill the thread
+                logger.exception('Error running %r', task)
+            finally:
+                with self._cond:
+                    self.running -= 1
+                    self._cond.notify_all()
+
+    def run(self, task):
+        task.attempts += 1
+        start = clock()
+        try:
+            func = task.func
+            if func is None:
+                func = task.func = import_string(task.name)
+            func(*task.args, **task.kwargs)
+        except Exception:
+            error = traceback.format_exc()
+            with self._cond:
+                self.run_time += clock() - start
+            self.on_error(task, error)
+        else:
+            self.write_store('done', task)
+            with self._cond:
+                self.run_time += clock() - start
+                self.completed += 1
+
+    def on_error(self, task, error):
+        if task.attempts > self.max_retries:
+            logger.error('Task %r failed after %i attempts:\n%s', task,
+                task.attempts, error)
+            self.write_store('fail', task, error)
+            with self._cond:
+                self.failed += 1
+            return
+
+        delay = min(self.retry_delay * 2 ** (task.attempts - 1),
+            self.max_retry_delay)
+        task.run_at = time.time() + delay * random.uniform(0.5, 1.0)
+        logger.warning('Task %r failed (attempt %i), retrying:\n%s', task,
+            task.attempts, error)
+        self.write_store('retry', task, error)
+        with self._cond:
+            self.retried += 1
+            self._push(task)
+
+    def write_store(self, method, *args):
+        """Calls `method` of the store, if any, logging instead of raising
+        its errors (eg: a locked database), so they can't stop the thread.
+        The task then runs again, or stays as failed, after a restart.
+        """
+        if self.store is None:
+            return
+        try:
+            getattr(self.store, method)(*args)
+        except Exception:
+            logger.exception('Error writing %r to the store', args[0])
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._heap),
+                'reserved': self.reserved,
+                'running': self.running,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'retried': self.retried,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'run_time': self.run_time,
+            }
+
+    def to_prometheus(self, name='shake_tasks'):
+        """Returns the stats in the Prometheus text format."""
+        stats = self.stats()
+        lines = []
+        for key, kind in (('queued', 'gauge'), ('reserved', 'gauge'),
+                ('running', 'gauge'),
+                ('submitted', 'counter'), ('completed', 'counter'),
+                ('retried', 'counter'), ('failed', 'counter'),
+                ('rejected', 'counter'), ('run_time', 'counter')):
+            metric = '%s_%s' % (name, key)
+            lines.append('# TYPE %s %s' % (metric, kind))
+            lines.append('%s %r' % (metric, stats[key]))
+        return '\n'.join(lines) + '\n'
@@ -121,8 +121,7 @@ def link_to(text='', endpoint='', classes='', wrapper=None, partial=False, **kwa
         regular dashes.
 
     """
-    request = local.request
-    path = request.path.rstrip('/')
+    path = local.request.info.stripped_path
 
     patterns = endpoint if isinstance(endpoint, (list, tuple)) else [endpoint]
     patterns = [p
@@ -0,0 +1,279 @@
+# coding=utf-8
+"""
+    Shake.uploads
+    --------------------------
+
+    A multipart parser that streams the uploaded files to their
+    destination in fixed-size chunks, so the memory used doesn't depend
+    on the size of the files (the parser of Werkzeug works line by line,
+    so a binary file without newlines ends up fully in memory).
+
+    The destination of each file is returned by `Request._get_file_stream`:
+    a temporary file in `UPLOADS_DIR` or whatever `request.upload_sink`
+    returns.  The size of each file can be limited and its hash computed
+    while is being received.
+
+"""
+import hashlib
+
+from werkzeug.datastructures import FileStorage, Headers, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser as BaseFormDataParser
+from werkzeug.formparser import exhaust_stream
+from werkzeug.http import parse_options_header
+
+
+__all__ = (
+    'FormDataParser', 'MultiPartParser', 'UploadedFile',
+)
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class UploadedFile(FileStorage):
+    """A `FileStorage` that also knows its size and, if requested,
+    its hash.
+
+    size
+    :   size in bytes of the file.
+    hash
+    :   the hexadecimal digest of the file (see the `UPLOAD_HASH` setting)
+        or `None`.
+
+    """
+
+    def __init__(self, stream=None, filename=None, name=None,
+            content_type=None, content_length=None, headers=None,
+            size=0, hash=None):
+        FileStorage.__init__(self, stream, filename, name=name,
+            content_type=content_type, content_length=content_length,
+            headers=headers)
+        self.size = size
+        self.hash = hash
+
+
+class MultiPartParser(object):
+    """Parses a `multipart/form-data` body reading it in chunks of
+    `chunk_size` bytes.
+
+    stream_factory
+    :   called as `stream_factory(total_content_length, content_type,
+        filename, content_length)` to get a writable file-like object for
+        each uploaded file.
+    charset, errors
+    :   used to decode the field values and the filenames.
+    max_form_memory_size
+    :   maximum size of all the regular fields (not files) combined.
+    cls
+    :   the class used for `form` and `files`.
+    chunk_size
+    :   size of the reads from the input stream and of the writes to the
+        files.
+    max_file_size
+    :   maximum size of each uploaded file.
+    hash_name
+    :   name of a `hashlib` algorithm (eg: 'sha1') used to compute
+        the hash of each file while it's being received.
+    max_header_size
+    :   maximum size of the headers of each part.
+
+    """
+
+    def __init__(self, stream_factory, charset='utf-8', errors='replace',
+            max_form_memory_size=None, cls=None, chunk_size=DEFAULT_CHUNK_SIZE,
+            max_file_size=None, hash_name=None, max_header_size=8 * 1024):
+        self.stream_factory = stream_factory
+        self.charset = charset
+        self.errors = errors
+        self.max_form_memory_size = max_form_memory_size
+        self.cls = cls or MultiDict
+        self.chunk_size = chunk_size
+        self.max_file_size = max_file_size
+        self.hash_name = hash_name
+        self.max_header_size = max_header_size
+
+    def fail(self, message):
+        raise ValueError(message)
+
+    def iter_chunks(self, stream, content_length):
+        chunk_size = self.chunk_size
+        remaining = content_length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else \
+                min(chunk_size, remaining)
+            chunk = stream.read(size)
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    def fill(self, buf, chunks, size):
+        """Reads until there are at least `size` bytes in the buffer or
+        the stream ends.
+        """
+        while len(buf) < size:
+            chunk = next(chunks, b'')
+            if not chunk:
+                break
+            buf += chunk
+        return buf
+
+    def parse(self, stream, boundary, content_length):
+        """Returns a `(form, files)` tuple."""
+        delimiter = b'\r\n--' + boundary
+        chunks = self.iter_chunks(stream, content_length)
+        form = []
+        files = []
+        form_size = [0]
+
+        # The first boundary doesn't have to be preceded by a newline
+        buf = self.read_part(b'\r\n', chunks, delimiter, lambda data: None)
+        while True:
+            buf = self.fill(buf, chunks, 2)
+            if buf[:2] == b'--':
+                break
+            headers, buf = self.read_headers(buf, chunks)
+            disposition, extra = parse_options_header(
+                headers.get('content-disposition', ''))
+            if not disposition:
+                self.fail('Missing Content-Disposition header')
+            name = extra.get('name')
+            filename = extra.get('filename')
+
+            if filename is None:
+                parts = []
+
+                def write(data):
+                    form_size[0] += len(data)
+                    if self.max_form_memory_size is not None and \
+                            form_size[0] > self.max_form_memory_size:
+                        raise RequestEntityTooLarge()
+                    parts.append(data)
+
+                buf = self.read_part(buf, chunks, delimiter, write)
+                value = b''.join(parts).decode(self.charset, self.errors)
+                form.append((name, value))
+            else:
+                buf, upload = self.read_file(buf, chunks, delimiter, headers,
+                    name, filename, content_length)
+                files.append((name, upload))
+
+        return self.cls(form), self.cls(files)
+
+    def read_headers(self, buf, chunks):
+        """Reads the rest of the boundary line and the headers of a part.
+        Returns the headers and the buffer after them.
+        """
+        while True:
+            pos = buf.find(b'\r\n\r\n')
+            if pos >= 0:
+                break
+            if len(buf) > self.max_header_size:
+                self.fail('Multipart headers too long')
+            chunk = next(chunks, b'')
+            if not chunk:
+                self.fail('Unexpected end of stream')
+            buf += chunk
+
+        # The first line is the end of the boundary line
+        lines = buf[:pos].split(b'\r\n')[1:]
+        headers = Headers()
+        for line in lines:
+            key, sep, value = line.partition(b':')
+            if not sep:
+                self.fail('Invalid multipart header')
+            headers.add(key.strip().decode('latin1'),
+                value.strip().decode(self.charset, self.errors))
+        return headers, buf[pos + 4:]
+
+    def read_part(self, buf, chunks, delimiter, write):
+        """Passes to `write` the data of the part until the `delimiter`.
+        Returns the buffer after the delimiter.
+        """
+        dlen = len(delimiter)
+        # What might be the beginning of a delimiter is kept in the buffer
+        keep = dlen - 1
+        while True:
+            pos = buf.find(delimiter)
+            if pos >= 0:
+                if pos:
+                    write(buf[:pos])
+                return buf[pos + dlen:]
+            if len(buf) > keep:
+                write(buf[:-keep])
+                buf = buf[-keep:]
+            chunk = next(chunks, b'')
+            if not chunk:
+                self.fail('Unexpected end of stream')
+            buf += chunk
+
+    def read_file(self, buf, chunks, delimiter, headers, name, filename,
+            total_content_length):
+        content_type = headers.get('content-type')
+        try:
+            content_length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            content_length = 0
+        stream = self.stream_factory(total_content_length, content_type,
+            filename, content_length)
+        hasher = hashlib.new(self.hash_name) if self.hash_name else None
+        max_file_size = self.max_file_size
+        stream_write = stream.write
+        size = [0]
+
+        def write(data):
+            size[0] += len(data)
+            if max_file_size is not None and size[0] > max_file_size:
+                raise RequestEntityTooLarge()
+            if hasher is not None:
+                hasher.update(data)
+            stream_write(data)
+
+        buf = self.read_part(buf, chunks, delimiter, write)
+        if hasattr(stream, 'seek'):
+            try:
+                stream.seek(0)
+            except (IOError, OSError, ValueError):
+                pass
+        upload = UploadedFile(stream, filename, name=name,
+            content_type=content_type, content_length=content_length,
+            headers=headers, size=size[0],
+            hash=hasher.hexdigest() if hasher is not None else None)
+        return buf, upload
+
+
+class FormDataParser(BaseFormDataParser):
+    """A Werkzeug `FormDataParser` that uses `MultiPartParser` for the
+    multipart requests.  The extra parameters are those of
+    `MultiPartParser`.
+
+    """
+
+    def __init__(self, stream_factory=None, charset='utf-8',
+            errors='replace', max_form_memory_size=None,
+            max_content_length=None, cls=None, silent=True,
+            chunk_size=DEFAULT_CHUNK_SIZE, max_file_size=None, hash_name=None):
+        BaseFormDataParser.__init__(self, stream_factory, charset, errors,
+            max_form_memory_size, max_content_length, cls, silent)
+        self.chunk_size = chunk_size
+        self.max_file_size = max_file_size
+        self.hash_name = hash_name
+
+    @exhaust_stream
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        parser = MultiPartParser(self.stream_factory, self.charset,
+            self.errors, max_form_memory_size=self.max_form_memory_size,
+            cls=self.cls, chunk_size=self.chunk_size,
+            max_file_size=self.max_file_size, hash_name=self.hash_name)
+        boundary = options.get('boundary')
+        if boundary is None:
+            raise ValueError('Missing boundary')
+        if isinstance(boundary, unicode):
+            boundary = boundary.encode('ascii')
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+    parse_functions = dict(BaseFormDataParser.parse_functions)
+    parse_functions['multipart/form-data'] = _parse_multipart
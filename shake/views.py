@@ -6,37 +6,187 @@
     Generic views
 
 """
+import logging
+import os
 from random import choice
+import threading
+from timeit import default_timer as clock
+import weakref
 
-from .helpers import local, NotFound, safe_join, send_file
+from werkzeug.exceptions import Forbidden
+
+from .helpers import local, NotFound, safe_join, send_file, file_info_cache
 from .render import default_render
+from .session import CSRF_FORM_NAME, CSRF_SESSION_NAME, get_csrf
 
 
 __all__ = (
-    'not_found_page', 'error_page', 'not_allowed_page', 'render_template',
+    'CachedErrorPage', 'not_found_page', 'error_page', 'not_allowed_page',
+    'render_template', 'metrics_page', 'profiler_page',
 )
 
 
-def not_found_page(request, error):
-    """Default "Not Found" page.
+logger = logging.getLogger('shake.views')
+
+
+class CachedErrorPage(object):
+    """An error handler that renders its template once (per locale) and
+    then returns the cached body, so a flood of errors doesn't become a
+    flood of template renders.
+
+        app.error_handlers[404] = CachedErrorPage('404.html')
+
+    template
+    :   the name of the template.
+    render
+    :   the `Render` to use.  If none is provided `local.app.render` is used.
+    context
+    :   values to add to the template context.  The template should not
+        use anything from the request, because the body is shared by all
+        of them.
+    per_locale
+    :   cache a different body for each locale of the requests (see
+        `Shake.i18n`).
+    max_renders
+    :   maximum number of renders every `period` seconds.  The requests
+        over the limit, and those whose render fails, get a static
+        `fallback` body instead.
+    max_entries
+    :   maximum number of bodies (locales) to cache.
+
+    In DEBUG mode the template is rendered for every request (within the
+    rate limit) and the body is not cached.
+
+    Each application using the page has its own cache and rate limit, so
+    the same instance can be shared between them.
 
     """
-    rules = local.urls.map._rules
-    return default_render('error_notfound.html', locals())
 
+    def __init__(self, template, render=None, context=None, per_locale=True,
+            max_renders=10, period=1.0, max_entries=50, fallback=None):
+        self.template = template
+        self.render = render
+        self.context = context or {}
+        self.per_locale = per_locale
+        self.max_renders = max_renders
+        self.period = period
+        self.max_entries = max_entries
+        self.fallback = fallback or FALLBACK_ERROR_PAGE
+        self.lock = threading.Lock()
+        # {app: ErrorPageState}
+        self._states = weakref.WeakKeyDictionary()
+
+    def get_state(self):
+        app = local.app
+        state = self._states.get(app)
+        if state is None:
+            with self.lock:
+                state = self._states.get(app)
+                if state is None:
+                    state = self._states[app] = ErrorPageState(
+                        self.max_renders)
+        return state
+
+    def get_locale_key(self):
+        if not self.per_locale:
+            return None
+        i18n = getattr(local.app, 'i18n', None)
+        if i18n is None:
+            return None
+        return str(i18n.get_locale())
+
+    def can_render(self, state):
+        """A token bucket of `max_renders` every `period` seconds."""
+        with self.lock:
+            now = clock()
+            rate = self.max_renders / self.period
+            state.tokens = min(self.max_renders,
+                state.tokens + (now - state.last) * rate)
+            state.last = now
+            if state.tokens < 1:
+                return False
+            state.tokens -= 1
+            return True
+
+    def render_body(self):
+        render = self.render or local.app.render
+        try:
+            body = render(self.template, dict(self.context), to_string=True)
+        except Exception:
+            logger.exception('Error rendering the %r error page', self.template)
+            return None
+        return body.encode('utf8')
 
-def error_page(request, error):
-    """A generic error page.
+    def get_body(self):
+        debug = local.app.settings.DEBUG
+        state = self.get_state()
+        cache = state.cache
+        key = self.get_locale_key()
+        if not debug:
+            body = cache.get(key)
+            if body is not None:
+                return body
+        if not self.can_render(state):
+            return self.fallback
+        body = self.render_body()
+        if body is None:
+            return self.fallback
+        if not debug and (key in cache or len(cache) < self.max_entries):
+            cache[key] = body
+        return body
 
+    def clear(self):
+        """Empties the cache of every application."""
+        for state in list(self._states.values()):
+            state.cache.clear()
+
+    def __call__(self, request, error):
+        return local.app.response_class(self.get_body(), mimetype='text/html')
+
+
+class ErrorPageState(object):
+    """The cache and the rate limit of a `CachedErrorPage` for one
+    application.
     """
-    return default_render('error.html')
+    __slots__ = ('cache', 'tokens', 'last')
+
+    def __init__(self, max_renders):
+        self.cache = {}
+        self.tokens = float(max_renders)
+        self.last = clock()
+
 
+# Used when an error page can't be rendered.  Padded to more than 512 bytes,
+# so browsers show it instead of their own error page.
+FALLBACK_ERROR_PAGE = (b'<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+    b'<title>Error</title></head><body><h1>Error</h1>'
+    b'<p>The server could not complete your request.  '
+    b'Please try again later.</p></body></html>\n<!-- ' + b'-' * 400 + b' -->\n')
 
-def not_allowed_page(request, error):
-    """A default "access denied" page.
+
+_cached_not_found_page = CachedErrorPage('error_notfound.html',
+    render=default_render, per_locale=False)
+
+
+def not_found_page(request, error):
+    """Default "Not Found" page.  In DEBUG mode, it includes the list of
+    URL rules of the application.
 
     """
-    return default_render('error_notallowed.html')
+    if local.app.settings.DEBUG:
+        rules = local.urls.map._rules
+        return default_render('error_notfound.html', {'rules': rules,
+            'debug': True})
+    return _cached_not_found_page(request, error)
+
+
+# A generic error page.
+error_page = CachedErrorPage('error.html', render=default_render,
+    per_locale=False)
+
+# A default "access denied" page.
+not_allowed_page = CachedErrorPage('error_notallowed.html',
+    render=default_render, per_locale=False)
 
 
 def render_template(request, template, render=None, context=None, **kwargs):
@@ -56,7 +206,58 @@ def render_template(request, template, render=None, context=None, **kwargs):
     return render(template, context, **kwargs)
 
 
-def send_from_directory(request, directory, filename, **options):
+def metrics_page(request):
+    """Exposes the request metrics of the application in the text format
+    used by Prometheus, including the stats of the resource pools and the
+    task queue.
+    The `METRICS` setting must be enabled.
+
+        app.add_url('/metrics', 'shake.views.metrics_page')
+
+    """
+    app = local.app
+    metrics = app.metrics
+    if metrics is None:
+        raise NotFound
+    text = metrics.to_prometheus()
+    if app.resources.stats():
+        text += app.resources.to_prometheus()
+    text += app.tasks.to_prometheus()
+    return app.response_class(text, mimetype='text/plain; version=0.0.4')
+
+
+def profiler_page(request):
+    """Shows if the profiler of the application is enabled, with a form to
+    turn it on or off.  The `POST` of that form, with `enabled=1` or
+    `enabled=0`, must include the CSRF token of the session (see
+    `shake.session.get_csrf`) or it's rejected with a `403 Forbidden`.
+    Remember to also protect this view, for instance with a `before` hook:
+
+        app.add_url('/admin/profiler', 'shake.views.profiler_page',
+            before=[requires_admin])
+
+    """
+    profiler = local.app.profiler
+    if profiler is None:
+        raise NotFound
+    if request.method == 'POST':
+        token = request.session.get(CSRF_SESSION_NAME)
+        if not token or request.form.get(CSRF_FORM_NAME) != token:
+            raise Forbidden
+        enabled = request.form.get('enabled')
+        profiler.toggle(enabled == '1' if enabled is not None else None)
+        return local.app.response_class(
+            'enabled' if profiler.enabled else 'disabled')
+    state = 'enabled' if profiler.enabled else 'disabled'
+    body = (u'<p>The profiler is %s.</p><form method="post">%s'
+        u'<button name="enabled" value="%s">Turn it %s</button></form>') % (
+        state, get_csrf(request).input, '0' if profiler.enabled else '1',
+        'off' if profiler.enabled else 'on')
+    return local.app.response_class(body, mimetype='text/html')
+
+
+def send_from_directory(request, directory, filename, cache=file_info_cache,
+        **options):
     """Send a file from a given directory with `send_file`.  This
     is a secure way to quickly expose static files from an upload folder
     or something similar.
@@ -77,6 +278,9 @@ def send_from_directory(request, directory, filename, **options):
     :   the directory where all the files are stored.
     filename
     :   the filepath relative to that directory to download.
+    cache
+    :   a `FileInfoCache` to avoid checking the file on every request, or
+        `None` to disable it.
     options
     :   optional keyword arguments that are directly forwarded to `send_file`.
 
@@ -86,7 +290,13 @@ def send_from_directory(request, directory, filename, **options):
     Used under the modified BSD license.
     """
     filepath = safe_join(directory, filename)
-    if not os.path.isfile(filepath):
+    if cache is None:
+        if not os.path.isfile(filepath):
+            raise NotFound
+        return send_file(request, filepath, conditional=True, **options)
+    file_info = cache.get(filepath)
+    if file_info is None:
         raise NotFound
-    return send_file(request, filepath, conditional=True, **options)
+    return send_file(request, filepath, conditional=True, file_info=file_info,
+        **options)
 
@@ -4,20 +4,50 @@
     --------------------------
 
 """
+from io import BytesIO
+from tempfile import TemporaryFile
+
+from werkzeug.http import parse_cookie
 from werkzeug.utils import cached_property
 from werkzeug.wrappers import Request as BaseRequest
 from werkzeug.wrappers import Response as BaseResponse
 from werkzeug.datastructures import ImmutableMultiDict
 
 from .helpers import local, StorageDict, to_unicode
-from .serializers import from_json, to_json
+from .metrics import NULL_TIMER
+from .serializers import from_json, encode_json
+from .uploads import FormDataParser
 
 
 __all__ = (
-    'Request', 'Response', 'Settings', 'make_response',
+    'Request', 'RequestInfo', 'Response', 'JSONStreamResponse', 'Settings', 'make_response',
 )
 
 
+class RequestInfo(object):
+    """The most used fields of a request, computed once.  Available as
+    `request.info`.
+
+    method
+    :   the HTTP method, in uppercase.
+    path
+    :   the requested path.
+    stripped_path
+    :   the path without the trailing slash (eg: to compare it with
+        other URLs).
+    host
+    :   the host, including the port if available.
+
+    """
+    __slots__ = ('method', 'path', 'stripped_path', 'host')
+
+    def __init__(self, request):
+        self.method = request.environ.get('REQUEST_METHOD', 'GET').upper()
+        self.path = request.path
+        self.stripped_path = self.path.rstrip('/')
+        self.host = request.host
+
+
 class Request(BaseRequest):
     """The request object used by default in shake.
     Remembers the route rule, the matched endpoint and the view arguments.
@@ -61,21 +91,110 @@ class Request(BaseRequest):
     # Set by the application
     max_form_memory_size = 0
 
+    # The maximum size of each uploaded file or `None`.
+    # Set by the application
+    max_file_size = None
+
+    # Directory for the temporary files of the uploads.  `None` to use the
+    # default temporary directory.
+    # Set by the application
+    uploads_dir = None
+
+    # The uploads are read and written in chunks of this size.
+    # Set by the application
+    upload_chunk_size = 64 * 1024
+
+    # Name of a `hashlib` algorithm (eg: 'sha1') to hash the uploaded files
+    # while they're being received.  The digest is available as
+    # `request.files[name].hash`.
+    # Set by the application
+    upload_hash = None
+
+    # An optional function that returns a writable file-like object where
+    # to stream each uploaded file instead of a temporary file.  It's called
+    # with `(filename, content_type, content_length)`.  Set it in a
+    # before-request hook (or in the view, before reading `files`).
+    upload_sink = None
+
+    # Uploads smaller than this are kept in memory.
+    max_upload_memory_size = 500 * 1024
+
+    form_data_parser_class = FormDataParser
+
+    # Measures the phases of the request.  Replaced by the application
+    # if the metrics are enabled.
+    timer = NULL_TIMER
+
+    # The resources used by this request (a `RequestResources`), or `None`
+    # if the application has none.  See `Shake.provide`.
+    resources = None
+
+    # The tasks deferred by `Shake.defer` during this request, queued
+    # after the response is sent.
+    deferred = None
+
+    # The `object_hook` used to decode the JSON data, if any.
+    # Set by the application (see `shake.serializers.get_json_decoder`).
+    json_object_hook = None
+
+    def make_form_data_parser(self):
+        return self.form_data_parser_class(self._get_file_stream,
+            self.charset, self.encoding_errors, self.max_form_memory_size,
+            self.max_content_length, self.parameter_storage_class,
+            chunk_size=self.upload_chunk_size,
+            max_file_size=self.max_file_size, hash_name=self.upload_hash)
+
+    def _get_file_stream(self, total_content_length, content_type,
+            filename=None, content_length=None):
+        if self.upload_sink is not None:
+            return self.upload_sink(filename, content_type, content_length)
+        if total_content_length is not None and \
+                total_content_length <= self.max_upload_memory_size:
+            return BytesIO()
+        return TemporaryFile('wb+', dir=self.uploads_dir)
+
+    @cached_property
+    def info(self):
+        """A `RequestInfo` with the method, the path and the host of
+        this request.
+        """
+        return RequestInfo(self)
+
     @property
     def is_get(self):
-        return self.method == 'GET'
+        return self.info.method == 'GET'
 
     @property
     def is_post(self):
-        return self.method == 'POST'
+        return self.info.method == 'POST'
 
     @property
     def is_put(self):
-        return self.method == 'PUT'
+        return self.info.method == 'PUT'
 
     @property
     def is_delete(self):
-        return self.method == 'DELETE'
+        return self.info.method == 'DELETE'
+
+    def get_cookie(self, name, default=None):
+        """Returns the value of the cookie `name`.  Unlike `cookies`, only
+        that cookie is parsed (unless the cookies were already parsed).
+        """
+        if 'cookies' in self.__dict__:
+            return self.cookies.get(name, default)
+        header = self.environ.get('HTTP_COOKIE')
+        if not header or name not in header:
+            return default
+        if '"' in header:
+            # A quoted value might include a ';'
+            return self.cookies.get(name, default)
+        # Like in `cookies`, if the cookie is repeated the last one wins.
+        for part in reversed(header.split(';')):
+            key, sep, value = part.partition('=')
+            if sep and key.strip() == name:
+                return parse_cookie(part, self.charset,
+                    self.encoding_errors).get(name, default)
+        return default
 
     @cached_property
     def json(self):
@@ -84,7 +203,7 @@ class Request(BaseRequest):
 
         """
         if self.mimetype == 'application/json':
-            return from_json(self.data)
+            return from_json(self.data, object_hook=self.json_object_hook)
 
 
 class Response(BaseResponse):
@@ -101,8 +220,77 @@ class Response(BaseResponse):
     default_mimetype = 'text/plain'
 
 
+class JSONStreamResponse(Response):
+    """A response that serializes an iterable (eg: a generator or a
+    database cursor) as a JSON array, one item at a time, instead of
+    building the whole document in memory first:
+
+        @app.route('/export.json')
+        def export(request):
+            rows = (row.to_dict() for row in db.query(Row).yield_per(1000))
+            return JSONStreamResponse(rows)
+
+    The encoded items are sent in chunks of about `chunk_size` bytes.
+
+    iterable
+    :   the items to serialize.
+    chunk_size
+    :   the minimum size in bytes of each chunk sent to the client.
+    json_encoder
+    :   the function used to serialize each item.  By default the one
+        of the current application is used.
+    kwargs
+    :   extra parameters passed to the `Response` constructor.
+
+    """
+    default_mimetype = 'application/json'
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, iterable, chunk_size=None, json_encoder=None, **kwargs):
+        self.chunk_size = chunk_size or self.chunk_size
+        if json_encoder is None:
+            app = getattr(local, 'app', None)
+            json_encoder = getattr(app, 'json_encoder', None) or encode_json
+        self.json_encoder = json_encoder
+        super(JSONStreamResponse, self).__init__(
+            self.iter_encoded_items(iterable), **kwargs)
+
+    def iter_encoded_items(self, iterable):
+        encode = self.json_encoder
+        chunk_size = self.chunk_size
+        buffer = []
+        size = 0
+        sep = '['
+        for item in iterable:
+            data = encode(item)
+            buffer.append(sep)
+            buffer.append(data)
+            sep = ','
+            size += len(data) + 1
+            if size >= chunk_size:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if not buffer and sep == '[':
+            buffer.append('[')
+        buffer.append(']')
+        yield ''.join(buffer)
+
+
 class Settings(object):
-    """A helper to manage custom and default settings
+    """A helper to manage custom and default settings.
+
+    The custom and default values are resolved once, into the `__dict__`
+    of this object, so reading a setting is a plain attribute lookup,
+    without locks.  Every change made through this object (or an explicit
+    `reload()`, after changing the custom settings object directly)
+    resolves them again and increments `version`, so the values derived
+    from the settings can be cached until it changes.
+
+    The names of the attributes and methods of this class (`custom`,
+    `default`, `get`, `version`...) can't be used as settings.
+
     """
 
     def __init__(self, custom, default):
@@ -112,59 +300,125 @@ class Settings(object):
             default = StorageDict(default)
         self.__dict__['custom'] = custom
         self.__dict__['default'] = default
+        self.__dict__['_frozen'] = False
+        self.__dict__['_version'] = 0
+        self.reload()
+
+    @property
+    def version(self):
+        """A number incremented every time the settings change."""
+        return self.__dict__['_version']
+
+    @property
+    def frozen(self):
+        return self.__dict__['_frozen']
+
+    def reload(self):
+        """Resolves the custom and default settings again."""
+        state = self.__dict__
+        values = get_public_attrs(state['default'])
+        values.update(get_public_attrs(state['custom']))
+        for key in values:
+            check_setting_name(key)
+        for key in [key for key in state
+                if key not in values and key not in RESERVED_STATE]:
+            del state[key]
+        state.update(values)
+        state['_version'] += 1
+
+    def freeze(self):
+        """Makes the settings read-only.  See `Shake.freeze`."""
+        self.__dict__['_frozen'] = True
+
+    def check_frozen(self):
+        if self.__dict__['_frozen']:
+            raise RuntimeError('The settings are frozen and can not be '
+                'changed anymore.')
 
     def __contains__(self, key):
         return hasattr(self.__dict__['custom'], key)
 
     def __getattr__(self, key):
-        dcustom = self.__dict__['custom']
-        ddefault = self.__dict__['default']
-        if hasattr(dcustom, key):
-            return getattr(dcustom, key)
-        if hasattr(ddefault, key):
-            return getattr(ddefault, key)
+        # Only called for the names that are not settings.
         # Deprecated: Case-insensitive search
+        ddefault = self.__dict__['default']
         if hasattr(ddefault, key.lower()):
             return getattr(ddefault, key.lower())
         raise AttributeError(key)
 
     def __setattr__(self, key, value):
+        check_setting_name(key)
+        self.check_frozen()
         setattr(self.__dict__['custom'], key, value)
+        self.reload()
 
     def __delattr__(self, key):
+        check_setting_name(key)
+        self.check_frozen()
         delattr(self.__dict__['custom'], key)
+        self.reload()
+
+    def __getitem__(self, key):
+        if key not in RESERVED_STATE:
+            try:
+                return self.__dict__[key]
+            except KeyError:
+                pass
+        return self.__getattr__(key)
 
-    __getitem__ = __getattr__
     __setitem__ = __setattr__
     __delitem__ = __delattr__
 
     def get(self, key, default=None):
-        dcustom = self.__dict__['custom']
-        ddefault = self.__dict__['default']
-        if hasattr(dcustom, key):
-            return getattr(dcustom, key)
-        if hasattr(ddefault, key):
-            return getattr(ddefault, key)
-        # Deprecated: Case-insensitive search
-        if hasattr(ddefault, key.lower()):
-            return getattr(ddefault, key.lower())
-        return default
+        try:
+            return self[key]
+        except AttributeError:
+            return default
 
     def setdefault(self, key, value):
+        check_setting_name(key)
         dcustom = self.__dict__['custom']
         if hasattr(dcustom, key):
             return getattr(dcustom, key)
+        self.check_frozen()
         setattr(dcustom, key, value)
+        self.reload()
         return value
 
     def update(self, dict_):
+        for key in dict_:
+            check_setting_name(key)
+        self.check_frozen()
         dcustom = self.__dict__['custom']
         for key, value in dict_.items():
             setattr(dcustom, key, value)
+        self.reload()
+
+
+# The keys of the `__dict__` of `Settings` that aren't settings
+RESERVED_STATE = frozenset(['custom', 'default', '_frozen', '_version'])
+
+
+def check_setting_name(key):
+    """Raises a `ValueError` if `key` would be hidden by an attribute or
+    method of `Settings`.
+    """
+    if key in RESERVED_STATE or hasattr(Settings, key):
+        raise ValueError('%r is reserved and can\'t be used as the name of '
+            'a setting' % key)
+
+
+def get_public_attrs(obj):
+    if isinstance(obj, dict):
+        items = obj.items()
+    else:
+        items = [(key, getattr(obj, key)) for key in dir(obj)]
+    return dict((key, value) for key, value in items
+        if not key.startswith('_'))
 
 
 def make_response(resp='', status=None, headers=None,
-        response_class=Response, **kwargs):
+        response_class=Response, json_encoder=None, **kwargs):
     """Converts the return value from a view function to a real
     response object that is an instance of `response_class`.
 
@@ -194,6 +448,11 @@ def make_response(resp='', status=None, headers=None,
     :   An optional status code.
     headers
     :   A dictionary with custom headers.
+    response_class
+    :   The class of the response object.
+    json_encoder
+    :   The function used to serialize a `dict` to JSON.  See
+        `shake.serializers.get_json_encoder`.
 
     return: an instance of `response_class`
 
@@ -203,7 +462,7 @@ def make_response(resp='', status=None, headers=None,
 
     if isinstance(resp, dict):
         kwargs['mimetype'] = 'application/json'
-        resp = to_json(resp, indent=None)
+        resp = (json_encoder or encode_json)(resp)
 
     if not isinstance(resp, BaseResponse):
         if isinstance(resp, basestring):
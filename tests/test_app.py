@@ -334,6 +334,45 @@ def test_is_json():
     assert resp.data == 'None'
 
 
+def test_json_parse_dates():
+    import datetime
+    from datetime import date
+    data = {'a': '2013-01-02T03:04:05', 'b': '2013-01-02', 'c': '2013-1-2',
+        'd': 'hello', 'e': '2013-13-02'}
+
+    app = Shake(__file__)
+
+    @app.route('/')
+    def index(request):
+        return repr(request.json)
+
+    c = app.test_client()
+    resp = c.post('/', content_type='application/json',
+        data=json.dumps(data))
+    assert eval(resp.data) == data
+
+    app = Shake(__file__, {'JSON_PARSE_DATES': True})
+    app.add_url('/', index)
+    c = app.test_client()
+    resp = c.post('/', content_type='application/json',
+        data=json.dumps(data))
+    result = eval(resp.data)
+    assert result['a'] == datetime.datetime(2013, 1, 2, 3, 4, 5)
+    assert result['b'] == date(2013, 1, 2)
+    assert result['c'] == date(2013, 1, 2)
+    assert result['d'] == 'hello'
+    assert result['e'] == '2013-13-02'
+
+    app = Shake(__file__, {'JSON_PARSE_DATES': ['b']})
+    app.add_url('/', index)
+    c = app.test_client()
+    resp = c.post('/', content_type='application/json',
+        data=json.dumps(data))
+    result = eval(resp.data)
+    assert result['a'] == '2013-01-02T03:04:05'
+    assert result['b'] == date(2013, 1, 2)
+
+
 def test_response_response():
     app = Shake(__file__)
 
@@ -391,6 +430,71 @@ def test_response_json():
     assert eval(resp.data) == data
 
 
+def test_response_json_datetime():
+    from datetime import datetime, date
+    settings = {'JSON_BACKEND': 'json', 'JSON_SORT_KEYS': True}
+    app = Shake(__file__, settings)
+
+    @app.route('/')
+    def index(request):
+        return {'b': datetime(2013, 1, 2, 3, 4, 5), 'a': date(2013, 1, 2)}
+
+    c = app.test_client()
+    resp = c.get('/')
+    assert resp.mimetype == 'application/json'
+    assert resp.data == '{"a":"2013-01-02","b":"2013-01-02T03:04:05"}'
+
+
+def test_json_backends():
+    from shake.serializers import get_json_encoder, JSON_BACKENDS
+
+    data = {'a': [1, 2, None], 'b': u'ñ', 'c': u'/path/'}
+    for name, factory in JSON_BACKENDS:
+        try:
+            encode = get_json_encoder(name)
+        except ImportError:
+            continue
+        result = encode(data)
+        assert isinstance(result, bytes)
+        assert json.loads(result) == data
+        # The same output with any backend
+        assert b'"c":"/path/"' in result
+
+    with pytest.raises(ValueError):
+        get_json_encoder('foobar')
+
+
+def test_json_sorted_by_default():
+    import types
+    from shake.serializers import get_json_encoder, has_speedups
+
+    assert get_json_encoder()({'b': 1, 'a': 2}) == '{"a":2,"b":1}'
+    # A simplejson without its C speedups is never picked automatically
+    assert not has_speedups(types.ModuleType('slowjson'))
+
+
+def test_response_json_stream():
+    from shake import JSONStreamResponse
+    app = Shake(__file__)
+
+    def rows(num):
+        for i in xrange(num):
+            yield {'id': i, 'name': 'row %i' % i}
+
+    @app.route('/<int:num>/')
+    def index(request, num):
+        return JSONStreamResponse(rows(num), chunk_size=100)
+
+    c = app.test_client()
+    for num in (0, 1, 100):
+        resp = c.get('/%i/' % num)
+        assert resp.mimetype == 'application/json'
+        assert json.loads(resp.data) == list(rows(num))
+
+    resp = app.test_client().get('/100/', buffered=False)
+    assert len(list(resp.response)) > 10
+
+
 def test_bad_responses():
 
     bad_responses = [
@@ -500,6 +604,91 @@ def test_processors_order_exception():
     assert r == 'br1 br2 view error eview ar1 ar2'.split()
 
 
+def test_scoped_hooks():
+    from shake import Submount, EndpointPrefix
+    app = Shake(__file__)
+    r = []
+
+    def index(request):
+        r.append('view')
+
+    def make_hook(name):
+        def before(request, **kwargs):
+            r.append('b-' + name)
+
+        def after(response):
+            r.append('a-' + name)
+            return response
+        return before, after
+
+    gb, ga = make_hook('global')
+    sb, sa = make_hook('sub')
+    pb, pa = make_hook('prefix')
+    rb, ra = make_hook('rule')
+
+    app.add_urls([
+        Rule('/', index),
+        Submount('/admin', [
+            EndpointPrefix('tests.test_app.', [
+                Rule('/', 'index', before=[rb], after=[ra]),
+            ], before=[pb], after=[pa]),
+        ], before=[sb], after=[sa]),
+    ])
+    app.before_request(gb)
+    app.after_request(ga)
+    c = app.test_client()
+
+    c.get('/')
+    assert r == 'b-global view a-global'.split()
+
+    del r[:]
+    c.get('/admin/')
+    # `tests.test_app.index` is the module-level view
+    assert r == ('b-global b-sub b-prefix b-rule '
+        'a-rule a-prefix a-sub a-global').split()
+
+    del r[:]
+    c.get('/foobar')
+    assert r == ['a-global']
+
+    # Hooks registered later are also used
+    lb, la = make_hook('later')
+    app.before_request(lb)
+    del r[:]
+    c.get('/')
+    assert r == 'b-global b-later view a-global'.split()
+
+    # ...and rules added later get the global hooks
+    app.add_url('/new/', index, before=[rb])
+    del r[:]
+    c.get('/new/')
+    assert r == 'b-global b-later b-rule view a-global'.split()
+
+
+def test_hooks_after_replacing_url_map():
+    from shake.routes import Map
+    app = Shake(__file__)
+
+    def index(request):
+        return u'index'
+
+    def deny(request, **kwargs):
+        return Response('denied', status=HTTP_FORBIDDEN)
+
+    app.add_urls([Rule('/', index), Rule('/other/', index)])
+    c = app.test_client()
+    assert c.get('/').status_code == HTTP_OK
+
+    # A new map with the same `rules_version` as the old one
+    app.url_map = Map([Rule('/', index), Rule('/secret/', index,
+        before=[deny])])
+    assert c.get('/secret/').status_code == HTTP_FORBIDDEN
+
+    # A rule that was never compiled keeps its own hooks
+    rule = Rule('/loose/', index, before=[deny])
+    assert app.get_hooks(rule)[0] == (deny,)
+
+
 def test_after_request_return():
     app = Shake(__file__)
 
@@ -565,3 +754,250 @@ def test_postdata_keyerror():
     with pytest.raises(KeyError):
         print c.post('/', data={'a':123})
 
+
+
+def test_session_binary_serializer():
+    from datetime import datetime
+    from shake import ItsdangerousSessionInterface, BinarySessionSerializer
+
+    settings = {'SECRET_KEY': 'abc'*20}
+    app = Shake(__file__, settings)
+    app.session_interface = ItsdangerousSessionInterface(app,
+        serializer=BinarySessionSerializer())
+    now = datetime(2013, 1, 2, 3, 4, 5, 6)
+    messages = [{'msg': u'hello ñ', 'cat': 'info', 'n': -3}] * 20
+
+    @app.route('/write/')
+    def write(request):
+        request.session['now'] = now
+        request.session['fm'] = messages
+
+    @app.route('/read/')
+    def read(request):
+        assert request.session['now'] == now
+        assert request.session['fm'] == messages
+
+    c = app.test_client()
+    c.get('/write/')
+    resp = c.get('/read/')
+    assert resp.status_code == HTTP_OK
+
+
+def test_binary_serializer_versions():
+    from shake import BinarySessionSerializer
+
+    s = BinarySessionSerializer(compress_threshold=10)
+    data = {'a': [1, 2.5, None, True, u'x' * 100], 'b': 'bytes'}
+    dumped = s.dumps(data)
+    assert len(dumped) < 100
+    assert s.loads(dumped) == data
+
+    with pytest.raises(ValueError):
+        s.loads('\xff\x00N')
+
+
+def test_binary_serializer_aware_datetime():
+    from datetime import datetime, timedelta
+    from shake import BinarySessionSerializer
+    from shake.session import FixedOffset
+
+    s = BinarySessionSerializer()
+    naive = datetime(2013, 1, 2, 3, 4, 5, 6)
+    aware = naive.replace(tzinfo=FixedOffset(-5 * 3600))
+    result = s.loads(s.dumps({'naive': naive, 'aware': aware}))
+    assert result['naive'] == naive
+    assert result['naive'].tzinfo is None
+    assert result['aware'] == aware
+    assert result['aware'].utcoffset() == timedelta(hours=-5)
+
+
+def test_session_max_size(caplog):
+    settings = {'SECRET_KEY': 'abc'*20, 'SESSION_COOKIE_MAX_SIZE': 200}
+    app = Shake(__file__, settings)
+
+    @app.route('/')
+    def write(request):
+        request.session['foo'] = os.urandom(300).encode('hex')
+
+    c = app.test_client()
+    resp = c.get('/')
+    assert 'Set-Cookie' not in resp.headers
+    # Reported every time
+    resp = c.get('/')
+    records = [record for record in caplog.records
+        if record.name == 'shake.session']
+    assert len(records) == 2
+    assert records[0].levelname == 'WARNING'
+    assert 'too big' in records[0].getMessage()
+
+    # The limit includes the name and the attributes of the cookie
+    app = Shake(__file__, settings)
+    plan = app.get_plan()
+    payload = plan.session_serializer.dumps({'foo': 'x' * 30})
+    assert len(payload) < 200
+
+    @app.route('/')
+    def write_small(request):
+        request.session['foo'] = 'x' * 30
+
+    app.settings.SESSION_COOKIE_MAX_SIZE = len(payload) + 20
+    c = app.test_client()
+    caplog.clear()
+    resp = c.get('/')
+    assert 'Set-Cookie' not in resp.headers
+    assert [record for record in caplog.records
+        if record.name == 'shake.session']
+
+    app.settings.SESSION_COOKIE_MAX_SIZE = 4000
+    resp = c.get('/')
+    assert len(resp.headers['Set-Cookie']) > len(payload) + 20
+
+
+def test_request_info():
+    from werkzeug.test import create_environ
+    env = create_environ('/foo/bar/', 'http://example.com:8080/',
+        method='post')
+    request = shake.Request(env)
+    info = request.info
+    assert request.info is info
+    assert info.method == 'POST'
+    assert info.path == u'/foo/bar/'
+    assert info.stripped_path == u'/foo/bar'
+    assert info.host == 'example.com:8080'
+    assert request.is_post
+    assert not request.is_get
+
+
+def test_request_get_cookie():
+    from werkzeug.test import create_environ
+    env = create_environ('/', headers={
+        'Cookie': 'a=1; session=abc.def; a=2; b=%C3%B1'})
+    request = shake.Request(env)
+    assert request.get_cookie('session') == 'abc.def'
+    assert request.get_cookie('a') == '2'
+    assert request.get_cookie('sess') is None
+    assert request.get_cookie('x', 'y') == 'y'
+    assert 'cookies' not in request.__dict__
+    assert request.get_cookie('b') == request.cookies['b']
+
+    env = create_environ('/', headers={'Cookie': 'q="a;b"; c=1'})
+    request = shake.Request(env)
+    assert request.get_cookie('q') == 'a;b'
+    assert request.get_cookie('c') == '1'
+
+    request = shake.Request(create_environ('/'))
+    assert request.get_cookie('session') is None
+
+
+def test_freeze(tmpdir):
+    tmpdir.mkdir('templates').join('index.html').write(u'{{ t("msg") }}')
+    tmpdir.join('templates', 'logo.png').write(b'\xff\xd8\xff', mode='wb')
+    # Not a Jinja template
+    tmpdir.join('templates', 'list.hbs').write(
+        u'{{#each items}}{{this}}{{/each}}')
+    tmpdir.mkdir('locales').join('en.yml').write(u'msg: Hello')
+    app = Shake(str(tmpdir), {'DEBUG': False})
+    app.add_url('/', lambda request: app.render('index.html'))
+
+    app.freeze()
+    assert app.frozen
+    assert app.hooks is not None
+    cached = app.render.env.cache.keys()
+    assert [key for key in cached if key.endswith('index.html')]
+    assert str(tmpdir.join('locales', 'en')) in app.i18n.translations
+
+    with pytest.raises(RuntimeError):
+        app.settings.DEBUG = True
+    with pytest.raises(RuntimeError):
+        app.settings.update({'DEBUG': True})
+    assert app.settings.DEBUG is False
+
+    c = app.test_client()
+    assert c.get('/').data == b'Hello'
+
+
+def test_settings():
+    from shake import Settings
+
+    class Custom(object):
+        A = 1
+        B = 2
+
+    settings = Settings(Custom(), {'B': 20, 'C': 30, 'lower': 'x'})
+    assert settings.A == 1
+    assert settings.B == 2
+    assert settings['C'] == 30
+    assert settings.get('D', 'default') == 'default'
+    assert settings.LOWER == 'x'
+    assert 'A' in settings
+    assert 'C' not in settings
+    with pytest.raises(AttributeError):
+        settings.D
+
+    version = settings.version
+    settings.update({'D': 4})
+    assert settings.D == 4
+    assert settings.setdefault('D', 5) == 4
+    assert settings.setdefault('E', 5) == 5
+    settings.B = 200
+    assert settings.B == 200
+    del settings.D
+    assert settings.get('D') is None
+    assert settings.version == version + 4
+
+    # Changes made directly to the custom settings need a `reload()`
+    version = settings.version
+    Custom.A = 100
+    assert settings.A == 1
+    settings.reload()
+    assert settings.A == 100
+    assert settings.version == version + 1
+
+    # The old attributes are still there
+    assert settings.custom.A == 100
+    assert settings.default.C == 30
+    with pytest.raises(AttributeError):
+        settings['custom']
+    # The names used by `Settings` can't be settings
+    for name in ('get', 'version', 'reload', 'freeze', 'custom'):
+        with pytest.raises(ValueError):
+            settings[name] = 1
+    with pytest.raises(ValueError):
+        Settings({'update': 1}, {})
+
+
+def test_request_plan():
+    from datetime import timedelta
+
+    settings = {'SECRET_KEY': 'abc' * 20, 'SERVER_NAME': 'example.com',
+        'SERVER_PORT': 8000}
+    app = Shake(__file__, settings)
+    plan = app.get_plan()
+    assert app.get_plan() is plan
+    assert plan.server_name == 'example.com:8000'
+    assert plan.script_name is None
+    assert plan.cookie_domain == '.example.com'
+    assert plan.session_serializer is not None
+
+    app.settings.SESSION_COOKIE_DOMAIN = 'foo.com'
+    plan = app.get_plan()
+    assert plan.cookie_domain == 'foo.com'
+
+    app.session_lifetime = timedelta(seconds=30)
+    assert app.get_plan() is not plan
+    assert app.get_plan().session_max_age == 30
+
+    def index(request):
+        request.session['a'] = 1
+        return u''
+
+    app.settings.update({'SERVER_PORT': None, 'SESSION_COOKIE_DOMAIN': None,
+        'SESSION_COOKIE_SECURE': True})
+    app.add_url('/', index)
+    c = app.test_client()
+    resp = c.get('/', 'http://example.com/')
+    cookie = resp.headers['Set-Cookie']
+    assert 'Domain=.example.com' in cookie
+    assert 'Path=/' in cookie
+    assert 'Secure' in cookie
+    assert 'HttpOnly' in cookie
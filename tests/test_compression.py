@@ -0,0 +1,107 @@
+# coding=utf-8
+import gzip
+import io
+import zlib
+
+from shake import Shake, Response, send_file
+from shake.compression import Compressor
+
+
+TEXT = u'Lorem ipsum dolor sit amet. ' * 100
+
+
+def get_app(**settings):
+    settings.setdefault('COMPRESSION', True)
+    settings.setdefault('DEBUG', False)
+    app = Shake(__file__, settings)
+    app.add_url('/', lambda request: TEXT)
+    app.add_url('/small/', lambda request: u'small')
+    return app
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def test_gzip():
+    c = get_app().test_client()
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert int(resp.headers['Content-Length']) == len(resp.data)
+    assert gunzip(resp.data).decode('utf8') == TEXT
+
+    resp = c.get('/', headers={'Accept-Encoding': 'deflate'})
+    assert resp.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(resp.data).decode('utf8') == TEXT
+
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert resp.data.decode('utf8') == TEXT
+
+
+def test_skip():
+    app = get_app(COMPRESSION_MIN_SIZE=100)
+
+    def image(request):
+        return Response(b'x' * 1000, mimetype='image/png')
+
+    app.add_url('/image/', image)
+    app.add_url('/file/', lambda request: send_file(request, __file__))
+    c = app.test_client()
+    headers = {'Accept-Encoding': 'gzip'}
+
+    resp = c.get('/small/', headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == b'small'
+    resp = c.get('/image/', headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+    assert 'Vary' not in resp.headers
+    resp = c.get('/file/', headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+
+    c = get_app(COMPRESSION=False).test_client()
+    resp = c.get('/', headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+
+
+def test_streaming():
+    app = get_app()
+    chunks = []
+    closed = []
+
+    class Body(object):
+        def __iter__(self):
+            for i in range(5):
+                chunks.append(i)
+                yield u'chunk %i\n' % i
+
+        def close(self):
+            closed.append(True)
+
+    def stream(request):
+        return Response(Body())
+
+    app.add_url('/stream/', stream)
+    c = app.test_client()
+    resp = c.get('/stream/', buffered=False,
+        headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in resp.headers
+    assert chunks == []
+    data = b''.join(resp.iter_encoded())
+    assert chunks == [0, 1, 2, 3, 4]
+    resp.close()
+    assert closed
+    assert gunzip(data) == b''.join(
+        b'chunk %i\n' % i for i in range(5))
+
+
+def test_incremental():
+    compressor = Compressor()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = compressor.compress_iter(iter([b'first', b'second']), 'gzip')
+    # Each chunk can be decompressed as soon as it arrives
+    assert decompressor.decompress(next(parts)) == b'first'
+    assert decompressor.decompress(next(parts)) == b'second'
@@ -393,6 +393,86 @@ def test_send_file_attachment():
     c.get('/')
 
 
+def test_send_file_ranges():
+    app = Shake(__file__)
+    c = app.test_client()
+    filename = path_join(__file__, 'static/index.html')
+    with io.open(filename, 'rb') as f:
+        content = f.read()
+    size = len(content)
+
+    @app.route('/')
+    def index(request):
+        return send_file(request, filename, conditional=True)
+
+    resp = c.get('/')
+    assert resp.status_code == 200
+    assert resp.data == content
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+    assert resp.headers['Content-Length'] == str(size)
+    etag = resp.headers['ETag']
+
+    resp = c.get('/', headers={'Range': 'bytes=2-5'})
+    assert resp.status_code == 206
+    assert resp.data == content[2:6]
+    assert resp.headers['Content-Range'] == 'bytes 2-5/%i' % size
+
+    resp = c.get('/', headers={'Range': 'bytes=-3'})
+    assert resp.status_code == 206
+    assert resp.data == content[-3:]
+
+    resp = c.get('/', headers={'Range': 'bytes=0-1,4-'})
+    assert resp.status_code == 206
+    mimetype, options = parse_options_header(resp.headers['Content-Type'])
+    assert mimetype == 'multipart/byteranges'
+    parts = resp.data.split('--' + options['boundary'])
+    assert len(parts) == 4
+    assert parts[1].endswith('\r\n\r\n' + content[:2] + '\r\n')
+    assert 'Content-Range: bytes 4-%i/%i' % (size - 1, size) in parts[2]
+    assert parts[2].endswith('\r\n\r\n' + content[4:] + '\r\n')
+    assert resp.headers['Content-Length'] == str(len(resp.data))
+
+    resp = c.get('/', headers={'Range': 'bytes=%i-' % size})
+    assert resp.status_code == 416
+    assert resp.headers['Content-Range'] == 'bytes */%i' % size
+
+    resp = c.get('/', headers={'Range': 'bytes=0-1', 'If-Range': etag})
+    assert resp.status_code == 206
+    resp = c.get('/', headers={'Range': 'bytes=0-1', 'If-Range': '"x"'})
+    assert resp.status_code == 200
+    assert resp.data == content
+
+    resp = c.get('/', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    # Other methods are not conditional
+    resp = c.post('/', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.data == content
+
+
+def test_send_file_x_accel_redirect():
+    app = Shake(__file__)
+    c = app.test_client()
+    static_dir = path_join(__file__, 'static')
+
+    @app.route('/')
+    def index(request):
+        filename = path_join(__file__, 'static/index.html')
+        resp = send_file(request, filename,
+            x_accel_redirect={static_dir: '/protected/'})
+        assert resp.headers['X-Accel-Redirect'] == '/protected/index.html'
+        assert 'x-sendfile' not in resp.headers
+
+        resp = send_file(request, filename, use_x_sendfile=True,
+            x_accel_redirect={'/other/': '/protected/'})
+        assert 'x-accel-redirect' not in resp.headers
+        assert resp.headers['X-Sendfile'] == filename
+        return ''
+
+    assert c.get('/').status_code == 200
+
+
 def test_safe_join_safe():
     assert safe_join('', '') == '.'
     assert safe_join('/static', 'foo/') == '/static/foo'
@@ -0,0 +1,117 @@
+# coding=utf-8
+import time
+
+from shake import Shake, Rule, Render
+from shake.metrics import Metrics, BUCKETS
+
+
+HTTP_OK = 200
+
+
+def index(request):
+    return 'hello'
+
+
+def slow(request):
+    time.sleep(0.01)
+    return Render().from_string('{{ 1 + 1 }}')
+
+
+def test_metrics_disabled():
+    app = Shake(__file__)
+    app.add_url('/', index)
+    assert app.metrics is None
+
+    c = app.test_client()
+    resp = c.get('/')
+    assert resp.status_code == HTTP_OK
+
+
+def test_metrics_phases():
+    app = Shake(__file__, {'METRICS': True})
+    app.add_urls([
+        Rule('/', index, name='home'),
+        Rule('/slow/', slow),
+    ])
+    c = app.test_client()
+    c.get('/')
+    c.get('/')
+    c.get('/slow/')
+    c.get('/foobar')
+
+    data = app.metrics.snapshot()
+    assert data[('home', 'total')].count == 2
+    for phase in ('match', 'before', 'view', 'response', 'after', 'session'):
+        assert data[('home', phase)].count == 2
+
+    slow_view = data[('tests.test_metrics.slow', 'view')]
+    assert slow_view.count == 1
+    assert slow_view.sum >= 0.01
+    assert slow_view.percentile(50) >= 0.01
+    assert data[('tests.test_metrics.slow', 'render')].count == 1
+
+    assert data[('<unmatched>', 'error')].count == 1
+
+
+def test_metrics_threads():
+    import threading
+
+    metrics = Metrics()
+
+    def work():
+        for i in range(100):
+            metrics.record(None, {'total': 0.001})
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    hist = metrics.snapshot()[('<unmatched>', 'total')]
+    assert hist.count == 400
+    assert abs(hist.sum - 0.4) < 1e-9
+
+    metrics.reset()
+    assert metrics.snapshot() == {}
+
+
+def test_metrics_short_lived_threads():
+    import threading
+
+    metrics = Metrics()
+
+    def work():
+        metrics.record(None, {'total': 0.001})
+
+    for i in range(500):
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+        # The stores of the finished threads are folded together
+        assert len(metrics._stores) <= 1
+
+    hist = metrics.snapshot()[('<unmatched>', 'total')]
+    assert hist.count == 500
+    assert metrics._stores == []
+
+
+def test_metrics_prometheus():
+    app = Shake(__file__, {'METRICS': True})
+    app.add_urls([
+        Rule('/', index, name='home'),
+        Rule('/metrics', 'shake.views.metrics_page'),
+    ])
+    c = app.test_client()
+    c.get('/')
+    resp = c.get('/metrics')
+    assert resp.status_code == HTTP_OK
+    assert resp.mimetype == 'text/plain'
+    lines = resp.data.splitlines()
+    assert '# TYPE shake_request_duration_seconds histogram' in lines
+    assert ('shake_request_duration_seconds_count'
+        '{endpoint="home",phase="total"} 1') in lines
+    buckets = [l for l in lines if l.startswith(
+        'shake_request_duration_seconds_bucket{endpoint="home",phase="total"')]
+    assert len(buckets) == len(BUCKETS) + 1
+    assert buckets[-1].endswith('le="+Inf"} 1')
@@ -0,0 +1,151 @@
+# coding=utf-8
+import os
+import re
+import time
+
+from shake import Shake, Rule
+
+
+HTTP_OK = 200
+
+
+def index(request):
+    return 'hello'
+
+
+def slow_function():
+    time.sleep(0.1)
+
+
+def slow(request):
+    slow_function()
+    return 'slow'
+
+
+def get_app(tmpdir, **settings):
+    settings.setdefault('PROFILER', True)
+    settings.setdefault('PROFILER_DIR', str(tmpdir))
+    app = Shake(__file__, settings)
+    app.add_urls([
+        Rule('/', index),
+        Rule('/slow/', slow),
+        Rule('/profiler/', 'shake.views.profiler_page'),
+    ])
+    return app
+
+
+def read_reports(tmpdir):
+    reports = []
+    for filename in sorted(os.listdir(str(tmpdir))):
+        with open(os.path.join(str(tmpdir), filename)) as f:
+            reports.append(f.read())
+    return reports
+
+
+def test_profiler_disabled(tmpdir):
+    app = get_app(tmpdir, PROFILER=False, PROFILER_SLOW_THRESHOLD=0)
+    assert app.profiler is None
+    c = app.test_client()
+    c.get('/slow/')
+    assert read_reports(tmpdir) == []
+
+
+def test_profiler_slow_requests(tmpdir):
+    app = get_app(tmpdir, PROFILER_SLOW_THRESHOLD=0.02,
+        PROFILER_INTERVAL=0.002, METRICS=True)
+    c = app.test_client()
+    resp = c.get('/')
+    assert resp.data == 'hello'
+    assert read_reports(tmpdir) == []
+
+    resp = c.get('/slow/')
+    assert resp.data == 'slow'
+    reports = read_reports(tmpdir)
+    assert len(reports) == 1
+    report = reports[0]
+    assert 'GET http://localhost/slow/' in report
+    assert 'Rule:     /slow/' in report
+    assert 'Endpoint: slow' in report
+    assert 'view=' in report
+    assert 'slow_function' in report
+
+
+def test_profiler_sample_rate(tmpdir):
+    app = get_app(tmpdir, PROFILER_SLOW_THRESHOLD=None,
+        PROFILER_SAMPLE_RATE=2)
+    c = app.test_client()
+    for i in range(4):
+        c.get('/')
+    reports = read_reports(tmpdir)
+    assert len(reports) == 2
+    assert 'cProfile' in reports[0]
+    assert 'function calls' in reports[0]
+
+
+def test_profiler_toggle(tmpdir):
+    app = get_app(tmpdir, PROFILER_SLOW_THRESHOLD=None,
+        PROFILER_SAMPLE_RATE=1, SECRET_KEY='abc' * 20)
+    c = app.test_client()
+    # Without the CSRF token
+    resp = c.post('/profiler/', data={'enabled': '0'})
+    assert resp.status_code == 403
+    assert app.profiler.enabled
+
+    resp = c.get('/profiler/')
+    assert 'The profiler is enabled' in resp.data
+    token = re.search(r'name="_csrf" value="([^"]+)"', resp.data).group(1)
+    resp = c.post('/profiler/', data={'enabled': '0', '_csrf': token})
+    assert resp.data == 'disabled'
+    assert not app.profiler.enabled
+    nreports = len(read_reports(tmpdir))
+    c.get('/')
+    assert len(read_reports(tmpdir)) == nreports
+
+    assert app.profiler.toggle() is True
+    c.get('/')
+    assert len(read_reports(tmpdir)) == nreports + 1
+
+
+def test_profiler_signal(tmpdir):
+    import signal
+
+    app = get_app(tmpdir)
+    app.profiler.install_signal(signal.SIGUSR2)
+    try:
+        assert app.profiler.enabled
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert not app.profiler.enabled
+    finally:
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+
+
+def test_profiler_sampler_stops(tmpdir):
+    app = get_app(tmpdir, PROFILER_SLOW_THRESHOLD=0.02,
+        PROFILER_INTERVAL=0.002)
+    c = app.test_client()
+    c.get('/slow/')
+    sampler = app.profiler._sampler
+    assert sampler is not None and sampler.is_alive()
+    app.profiler.toggle(False)
+    sampler.join(1)
+    assert not sampler.is_alive()
+    assert app.profiler._sampler is None
+
+    # Started again when needed
+    app.profiler.toggle(True)
+    c.get('/slow/')
+    assert len(read_reports(tmpdir)) == 2
+
+
+def test_profiler_report_dir(tmpdir):
+    report_dir = tmpdir.join('reports', 'new')
+    app = get_app(tmpdir, PROFILER_SLOW_THRESHOLD=None,
+        PROFILER_SAMPLE_RATE=1, PROFILER_DIR=str(report_dir))
+    c = app.test_client()
+    assert c.get('/').data == 'hello'
+    assert len(read_reports(report_dir)) == 1
+
+    # A report that can't be written doesn't break the request
+    app.profiler.report_dir = str(tmpdir.join('index.txt'))
+    tmpdir.join('index.txt').write('')
+    assert c.get('/').data == 'hello'
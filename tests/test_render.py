@@ -178,3 +178,49 @@ def get_test_request(path='/', **kwargs):
 
 
 
+
+
+def test_template_profiling():
+    render = Render(views_dir)
+    render.env.globals['url_for'] = lambda endpoint: '/' + endpoint
+    render('tmpl.html')
+    profiler = render.enable_profiling(max_helper_calls=2)
+
+    render('tmpl.html')
+    render('tmpl.html')
+    render.from_string('{% for i in range(3) %}{{ url_for("a") }}{% endfor %}',
+        to_string=True)
+
+    stats = profiler.stats.snapshot()
+    data = stats['tmpl.html']
+    assert data['compiles'] == 1
+    assert data['renders'] == 2
+    assert data['output_size'] == 2 * len('<h1>Hello World</h1>')
+    assert stats['<string>']['calls'] == {'url_for': 3}
+    assert profiler.stats.flagged() == [('<string>', 'url_for', 3)]
+
+
+def test_template_profiling_panel():
+    settings = {'TEMPLATE_PROFILING': True, 'DEBUG': True, 'METRICS': True}
+    app = Shake(__file__, settings)
+
+    def page(request):
+        return app.render.from_string('<body><p>{{ t("x") }}</p></body>')
+
+    def text(request):
+        return app.render.from_string('<p>{{ t("x") }}</p>',
+            mimetype='text/plain')
+
+    app.add_url('/', page)
+    app.add_url('/text/', text)
+    c = app.test_client()
+
+    resp = c.get('/')
+    assert 'id="shake-templates-panel"' in resp.data
+    assert '&lt;string&gt;' in resp.data
+    assert 't: 1' in resp.data
+    assert resp.data.endswith('</table></div></body>')
+    assert ('template:<string>', 'render') in app.metrics.snapshot()
+
+    resp = c.get('/text/')
+    assert 'shake-templates-panel' not in resp.data
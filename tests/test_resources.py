@@ -0,0 +1,147 @@
+# coding=utf-8
+import threading
+
+import pytest
+
+from shake import Shake, Pool, PoolTimeout, JSONStreamResponse
+
+
+class Conn(object):
+    count = 0
+
+    def __init__(self):
+        Conn.count += 1
+        self.id = Conn.count
+        self.resets = 0
+        self.closed = False
+
+
+def test_lazy_injection():
+    app = Shake(__file__, {'DEBUG': False})
+    made = []
+    released = []
+
+    def factory():
+        made.append(1)
+        return Conn()
+
+    pool = app.provide('db', factory, pool_size=2,
+        reset=lambda conn: released.append(conn.id))
+
+    def index(request):
+        return u'index'
+
+    def view(request, db):
+        return u'conn %i' % db.id
+
+    def manual(request):
+        return u'conn %i' % request.resources.get('db').id
+
+    def override(request, db):
+        return u'url %s' % db
+
+    app.add_url('/', index)
+    app.add_url('/view/', view)
+    app.add_url('/manual/', manual)
+    app.add_url('/override/<db>/', override)
+    # Buffered, so the responses are closed
+    c = app.test_client()
+
+    assert c.get('/', buffered=True).data == b'index'
+    assert made == []
+
+    first = c.get('/view/', buffered=True).data
+    assert first.startswith(b'conn ')
+    # Released and then reused
+    assert c.get('/view/', buffered=True).data == first
+    assert c.get('/manual/', buffered=True).data == first
+    assert len(made) == 1
+    assert len(released) == 3
+
+    assert c.get('/override/foo/', buffered=True).data == b'url foo'
+    assert len(made) == 1
+
+    stats = pool.stats()
+    assert stats['created'] == 1
+    assert stats['in_use'] == 0
+    assert stats['idle'] == 1
+
+
+def test_release_on_error():
+    app = Shake(__file__, {'DEBUG': False})
+    torn_down = []
+    app.provide('client', Conn, teardown=torn_down.append)
+
+    def fail(request, client):
+        raise ValueError
+
+    app.add_url('/', fail)
+    # Buffered, so the responses are closed
+    c = app.test_client()
+    resp = c.get('/', buffered=True)
+    assert resp.status_code == 500
+    assert len(torn_down) == 1
+
+
+def test_pool():
+    pool = Pool(Conn, size=1, timeout=0.05, close=lambda c: None)
+    conn = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+
+    got = []
+    thread = threading.Thread(target=lambda: got.append(pool.acquire()))
+    pool.timeout = 5
+    thread.start()
+    pool.release(conn)
+    thread.join()
+    assert got == [conn]
+
+    pool.release(conn, discard=True)
+    stats = pool.stats()
+    assert stats['created'] == 0
+    assert stats['wait_count'] >= 1
+
+
+def test_pool_timeout_response():
+    app = Shake(__file__, {'DEBUG': False, 'METRICS': True})
+    pool = app.provide('db', Conn, pool_size=1, timeout=0.01)
+
+    def view(request, db):
+        return u'ok'
+
+    app.add_url('/', view)
+    app.add_url('/metrics', 'shake.views.metrics_page')
+    c = app.test_client()
+    conn = pool.acquire()
+    assert c.get('/').status_code == 503
+    pool.release(conn)
+    assert c.get('/', buffered=True).status_code == 200
+
+    data = c.get('/metrics').data
+    assert b'shake_pool_timeouts{pool="db"} 1' in data
+
+
+def test_release_after_streaming():
+    app = Shake(__file__, {'DEBUG': False})
+    log = []
+
+    def rows():
+        for i in range(2):
+            log.append('row')
+            yield {'n': i}
+
+    app.provide('db', Conn, pool_size=1, reset=lambda conn: log.append('reset'))
+
+    def view(request, db):
+        return JSONStreamResponse(rows())
+
+    app.add_url('/', view)
+    c = app.test_client()
+    resp = c.get('/')
+    assert log == []
+    resp.get_data()
+    assert log == ['row', 'row']
+    resp.close()
+    assert log == ['row', 'row', 'reset']
@@ -348,14 +348,66 @@ def test_rule_emptying():
         build_only=False, subdomain='x', strict_slashes=True, redirect_to=None)
     rule2 = rule.empty()
 
-    assert rule.__dict__ == rule2.__dict__
+    def get_attrs(rule):
+        return dict((name, getattr(rule, name)) for name in r.Rule.__slots__)
+
+    assert get_attrs(rule) == get_attrs(rule2)
 
     rule.methods.add('GET')
-    assert rule.__dict__ != rule2.__dict__
+    assert get_attrs(rule) != get_attrs(rule2)
 
     rule.methods.discard('GET')
     rule.defaults['meh'] = 'aha'
-    assert rule.__dict__ != rule2.__dict__
+    assert get_attrs(rule) != get_attrs(rule2)
+
+
+def test_rule_sharing():
+    rule = r.Rule('/foo/<int:id>/<int(min=1):page>', 'foo')
+    map = r.Map([
+        rule,
+        r.Subdomain('x', [
+            r.Submount('/bar', [
+                r.Rule('/<int:id>', 'bar'),
+                r.Rule('/<int(min = 1):page>', 'baz'),
+            ]),
+        ]),
+    ])
+    rule1, rule2, rule3 = list(map.iter_rules())
+    assert not hasattr(rule1, '__dict__')
+    assert rule1 is rule
+    assert rule1._converters['id'] is rule2._converters['id']
+    assert rule1._converters['page'] is rule3._converters['page']
+    assert rule1._converters['id'] is not rule1._converters['page']
+    assert rule1._trace[-3] is rule2._trace[-1]
+    assert rule1.arguments == set(['id', 'page'])
+
+    inner = r.Rule('/', 'x')
+    r.Map([r.Subdomain('x', [r.Submount('/bar', [inner])])])
+    assert inner.map is None
+    assert inner.rule == '/'
+    assert inner.subdomain is None
+
+
+def test_factory_hooks():
+    def b1(request): pass
+    def b2(request): pass
+    def a1(response): pass
+    def a2(response): pass
+
+    map = r.Map([
+        r.Subdomain('foo', [
+            r.Submount('/bar', [
+                r.Rule('/', 'x', before=[b2], after=[a2]),
+            ]),
+        ], before=[b1], after=[a1]),
+        r.Rule('/', 'y'),
+    ])
+    rule1, rule2 = list(map.iter_rules())
+    assert rule1.before == (b1, b2)
+    assert rule1.after == (a2, a1)
+    assert rule2.before == rule2.after == ()
+
+    assert rule1.empty().before == (b1, b2)
 
 
 def test_rule_templates():
@@ -0,0 +1,126 @@
+# coding=utf-8
+import os
+import signal
+import socket
+import time
+import urllib2
+
+from shake import Shake
+from shake.server import PreforkServer
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get(port, path='/'):
+    deadline = time.time() + 10
+    while True:
+        try:
+            return urllib2.urlopen('http://127.0.0.1:%i%s' % (port, path),
+                timeout=5).read()
+        except (urllib2.URLError, socket.error):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def touch(path):
+    open(path, 'w').close()
+
+
+def start_server(settings=None, **kwargs):
+    app = Shake(__file__, dict({'DEBUG': False}, **(settings or {})))
+    app.add_url('/', lambda request: str(os.getpid()))
+    port = get_free_port()
+    pid = os.fork()
+    if not pid:
+        try:
+            server = PreforkServer(app, '127.0.0.1', port, **kwargs)
+            server.log = lambda *args: None
+            server.run()
+        finally:
+            os._exit(0)
+    return pid, port
+
+
+def stop_server(pid):
+    os.kill(pid, signal.SIGTERM)
+    _, status = os.waitpid(pid, 0)
+    return status
+
+
+def test_workers():
+    master, port = start_server(workers=2, threads=2)
+    try:
+        pids = set(get(port) for _ in range(20))
+        assert str(master) not in pids
+        assert 1 <= len(pids) <= 2
+    finally:
+        assert stop_server(master) == 0
+
+
+def test_max_requests():
+    master, port = start_server(workers=1, threads=1, max_requests=3)
+    try:
+        pids = [get(port) for _ in range(8)]
+        # The worker is replaced after at least 3 requests
+        assert len(set(pids)) >= 2
+        assert pids[0] == pids[1] == pids[2]
+    finally:
+        stop_server(master)
+
+
+def test_reload():
+    master, port = start_server(workers=1, threads=1)
+    try:
+        first = get(port)
+        os.kill(master, signal.SIGHUP)
+        deadline = time.time() + 10
+        while get(port) == first:
+            assert time.time() < deadline
+            time.sleep(0.05)
+    finally:
+        stop_server(master)
+
+
+def test_idle_connections_timeout():
+    master, port = start_server(workers=1, threads=1, queue_size=1,
+        timeout=0.5)
+    try:
+        get(port)
+        # Idle clients holding the only thread and the queue
+        idle = [socket.create_connection(('127.0.0.1', port))
+            for _ in range(2)]
+        start = time.time()
+        assert get(port)
+        assert time.time() - start < 5
+        for sock in idle:
+            sock.close()
+    finally:
+        stop_server(master)
+
+
+def test_recover_tasks_on_start(tmpdir):
+    from shake import SQLiteStore, TaskQueue
+
+    path = str(tmpdir.join('tasks.db'))
+    done = str(tmpdir.join('done'))
+    # A task left behind by a worker that died
+    store = SQLiteStore(path)
+    store.add(TaskQueue(store=store).make_task(touch, (done,)))
+    store.execute('UPDATE tasks SET owner = ?', (2 ** 22 + 1,))
+
+    master, port = start_server({'TASKS_DB': path}, workers=1, threads=1)
+    try:
+        # Without any request
+        deadline = time.time() + 10
+        while not os.path.exists(done):
+            assert time.time() < deadline
+            time.sleep(0.05)
+    finally:
+        stop_server(master)
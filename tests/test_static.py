@@ -0,0 +1,181 @@
+# coding=utf-8
+import gzip
+import hashlib
+import io
+import os
+
+from shake import Shake, StaticFiles
+from shake.static import fingerprint, load_manifest, parse_accept_encoding
+
+
+HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
+HTTP_NOT_FOUND = 404
+
+
+def write(path, data):
+    with io.open(path, 'wb') as f:
+        f.write(data)
+
+
+def get_app(tmpdir, **kwargs):
+    static = tmpdir.mkdir('static')
+    write(str(static.join('app.css')), b'body { color: red; }')
+    with gzip.open(str(static.join('app.css.gz')), 'wb') as f:
+        f.write(b'body { color: red; }')
+    write(str(static.join('app.css.br')), b'brotli')
+    write(str(static.join('logo.0123abcd.png')), b'png')
+    write(str(static.join('.hidden')), b'secret')
+    write(str(static.mkdir('js').join('main.js')), b'var a = 1;')
+
+    app = Shake(__file__, {'DEBUG': False})
+    app.add_url('/', lambda request: u'index')
+    app.add_static('/static', str(static))
+    middleware = app.serve_static(**kwargs)
+    return app, middleware
+
+
+def test_serve(tmpdir):
+    app, middleware = get_app(tmpdir)
+    assert isinstance(middleware, StaticFiles)
+    c = app.test_client()
+
+    resp = c.get('/static/js/main.js')
+    assert resp.status_code == HTTP_OK
+    assert resp.data == b'var a = 1;'
+    assert 'javascript' in resp.headers['Content-Type']
+    assert resp.headers['Cache-Control'] == 'public, max-age=43200'
+    assert 'Vary' not in resp.headers
+
+    resp = c.get('/static/logo.0123abcd.png')
+    assert resp.data == b'png'
+    assert resp.headers['Cache-Control'].endswith('immutable')
+
+    assert c.get('/static/.hidden').status_code == HTTP_NOT_FOUND
+    assert c.get('/static/../static/app.css').status_code == HTTP_NOT_FOUND
+    assert c.get('/').data == b'index'
+
+
+def test_precompressed(tmpdir):
+    app, middleware = get_app(tmpdir)
+    c = app.test_client()
+
+    resp = c.get('/static/app.css')
+    assert resp.data == b'body { color: red; }'
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['Content-Type'] == 'text/css; charset=utf-8'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+
+    resp = c.get('/static/app.css', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert gzip.GzipFile(fileobj=io.BytesIO(resp.data)).read() == \
+        b'body { color: red; }'
+
+    resp = c.get('/static/app.css',
+        headers={'Accept-Encoding': 'gzip, deflate, br'})
+    assert resp.headers['Content-Encoding'] == 'br'
+    assert resp.data == b'brotli'
+
+    resp = c.get('/static/app.css',
+        headers={'Accept-Encoding': 'gzip, br;q=0'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+
+
+def test_not_modified(tmpdir):
+    app, middleware = get_app(tmpdir)
+    c = app.test_client()
+    etag = c.get('/static/js/main.js').headers['ETag']
+    resp = c.get('/static/js/main.js', headers={'If-None-Match': etag})
+    assert resp.status_code == HTTP_NOT_MODIFIED
+    assert resp.data == b''
+
+    resp = c.head('/static/js/main.js')
+    assert resp.status_code == HTTP_OK
+    assert resp.headers['Content-Length'] == '10'
+
+
+def test_reload(tmpdir):
+    app, middleware = get_app(tmpdir, max_age=60)
+    c = app.test_client()
+    path = str(tmpdir.join('static', 'new.txt'))
+    write(path, b'new')
+    assert c.get('/static/new.txt').status_code == HTTP_NOT_FOUND
+    middleware.reload()
+    resp = c.get('/static/new.txt')
+    assert resp.data == b'new'
+    assert resp.headers['Cache-Control'] == 'public, max-age=60'
+
+    os.remove(path)
+    assert c.get('/static/new.txt').status_code == HTTP_NOT_FOUND
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding(None) == set()
+    assert parse_accept_encoding('gzip, deflate;q=0.5, br;q=0') == \
+        set(['gzip', 'deflate'])
+    assert parse_accept_encoding('GZIP;q=1.0') == set(['gzip'])
+
+
+def test_fingerprint(tmpdir):
+    static = tmpdir.mkdir('static')
+    write(str(static.join('app.css')), b'body { color: red; }')
+    write(str(static.join('app.css.gz')), b'gzipped')
+    write(str(static.mkdir('js').join('main.js')), b'var a = 1;')
+    write(str(static.join('logo.0123abcd.png')), b'png')
+
+    manifest = fingerprint(str(static), copy=True, hash_length=8)
+    assert sorted(manifest) == ['app.css', 'js/main.js']
+    hashed = manifest['app.css']
+    assert hashed == 'app.%s.css' % hashlib.md5(
+        b'body { color: red; }').hexdigest()[:8]
+    assert static.join(hashed).read() == 'body { color: red; }'
+    assert static.join(hashed + '.gz').read() == 'gzipped'
+    assert load_manifest(str(static)) == manifest
+
+    app = Shake(__file__, {'DEBUG': False})
+    app.add_static('/static', str(static))
+    assert app.static_url('app.css') == '/static/' + hashed
+    assert app.static_url('/static/js/main.js') == \
+        '/static/' + manifest['js/main.js']
+    assert app.static_url('missing.css') == '/static/missing.css'
+    tmpl = app.render.env.from_string(u"{{ static_url('app.css') }}")
+    assert tmpl.render() == '/static/' + hashed
+
+
+def test_serve_fingerprinted(tmpdir):
+    static = tmpdir.mkdir('static')
+    write(str(static.join('app.css')), b'body { color: red; }')
+    manifest = fingerprint(str(static))
+    assert not static.join(manifest['app.css']).check()
+
+    app = Shake(__file__, {'DEBUG': False})
+    app.add_static('/static', str(static))
+    app.serve_static()
+    c = app.test_client()
+    resp = c.get(app.static_url('app.css'))
+    assert resp.data == b'body { color: red; }'
+    assert resp.headers['Cache-Control'].endswith('immutable')
+    assert c.get('/static/manifest.json').status_code == HTTP_NOT_FOUND
+
+
+def test_outdated_manifest(tmpdir):
+    static = tmpdir.mkdir('static')
+    write(str(static.join('app.css')), b'body { color: red; }')
+    write(str(static.join('app.js')), b'var a = 1;')
+    manifest = fingerprint(str(static))
+    # Changed after fingerprinting
+    write(str(static.join('app.css')), b'body { color: blue; }')
+    assert load_manifest(str(static), verify=True) == {
+        'app.js': manifest['app.js']}
+
+    app = Shake(__file__, {'DEBUG': False})
+    app.add_static('/static', str(static))
+    app.serve_static()
+    c = app.test_client()
+    assert app.static_url('app.css') == '/static/app.css'
+    resp = c.get('/static/' + manifest['app.css'])
+    assert resp.status_code == HTTP_NOT_FOUND
+    resp = c.get('/static/app.css')
+    assert resp.data == b'body { color: blue; }'
+    assert not resp.headers['Cache-Control'].endswith('immutable')
+    assert c.get(app.static_url('app.js')).data == b'var a = 1;'
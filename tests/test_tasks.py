@@ -0,0 +1,168 @@
+# coding=utf-8
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from shake import Shake, TaskQueue, QueueFull, SQLiteStore
+
+
+done = []
+
+
+def record(value):
+    done.append(value)
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+def test_defer_after_response():
+    app = Shake(__file__, {'DEBUG': False, 'TASKS_WORKERS': 1})
+    calls = []
+
+    def index(request):
+        app.defer(calls.append, 'sent')
+        assert request.deferred
+        return u'index'
+
+    app.add_url('/', index)
+    c = app.test_client()
+    resp = c.get('/')
+    assert resp.data == b'index'
+    # Not queued until the response is closed
+    assert app.tasks.stats()['submitted'] == 0
+    resp.close()
+    assert app.tasks.join(5)
+    assert calls == ['sent']
+
+    stats = app.tasks.stats()
+    assert stats['submitted'] == 1
+    assert stats['completed'] == 1
+    app.tasks.stop()
+
+
+def test_retry():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError
+
+    tasks = TaskQueue(workers=1, max_retries=3, retry_delay=0.01)
+    tasks.put(tasks.make_task(flaky))
+    assert tasks.join(5)
+    assert len(attempts) == 3
+    stats = tasks.stats()
+    assert stats['retried'] == 2
+    assert stats['completed'] == 1
+
+    tasks.put(tasks.make_task(fail, ('boom',)))
+    assert tasks.join(5)
+    stats = tasks.stats()
+    assert stats['failed'] == 1
+    assert 'shake_tasks_failed 1' in tasks.to_prometheus()
+    tasks.stop()
+
+
+def test_max_size():
+    tasks = TaskQueue(workers=1, max_size=1)
+    event = threading.Event()
+    tasks.put(tasks.make_task(event.wait, (5,)))
+    while not tasks.stats()['running']:
+        time.sleep(0.01)
+    tasks.put(tasks.make_task(record, (1,)))
+    with pytest.raises(QueueFull):
+        tasks.put(tasks.make_task(record, (2,)))
+    assert tasks.stats()['rejected'] == 1
+    event.set()
+    assert tasks.join(5)
+    tasks.stop()
+
+
+def test_persistent(tmpdir):
+    path = str(tmpdir.join('tasks.db'))
+    store = SQLiteStore(path)
+    tasks = TaskQueue(workers=1, store=store, max_retries=0)
+
+    # Only importable functions with JSON arguments can be stored
+    with pytest.raises(ValueError):
+        tasks.make_task(lambda: None)
+    with pytest.raises(TypeError):
+        tasks.make_task(record, (object(),))
+
+    # A task left behind by a process that died
+    task = tasks.make_task(record, (u'recovered',))
+    store.add(task)
+    store.execute('UPDATE tasks SET owner = ?', (2 ** 22 + 1,))
+
+    del done[:]
+    tasks.put(tasks.make_task(fail, (u'lost',)))
+    assert tasks.join(5)
+    assert done == [u'recovered']
+
+    failed = store.failed()
+    assert len(failed) == 1
+    assert failed[0][1] == 'tests.test_tasks:fail'
+    assert failed[0][2] == [u'lost']
+    assert 'ValueError' in failed[0][5]
+    tasks.stop()
+
+
+def test_store_errors(tmpdir):
+    class BrokenStore(SQLiteStore):
+        def done(self, task):
+            raise sqlite3.OperationalError('database is locked')
+
+    store = BrokenStore(str(tmpdir.join('tasks.db')))
+    tasks = TaskQueue(workers=2, store=store)
+    del done[:]
+    for i in range(3):
+        tasks.put(tasks.make_task(record, (i,)))
+    assert tasks.join(5)
+    assert sorted(done) == [0, 1, 2]
+    assert tasks.stats()['completed'] == 3
+    assert all(thread.is_alive() for thread in tasks._threads)
+    tasks.stop()
+
+
+def test_defer_reserves_places():
+    app = Shake(__file__, {'DEBUG': False, 'TASKS_MAX_SIZE': 2})
+    calls = []
+
+    def index(request):
+        app.defer(calls.append, 1)
+        app.defer(calls.append, 2)
+        try:
+            app.defer(calls.append, 3)
+        except QueueFull:
+            return u'full'
+        return u'index'
+
+    app.add_url('/', index)
+    c = app.test_client()
+    resp = c.get('/')
+    assert resp.data == b'full'
+    assert app.tasks.stats()['reserved'] == 2
+    resp.close()
+    assert app.tasks.join(5)
+    assert sorted(calls) == [1, 2]
+    stats = app.tasks.stats()
+    assert stats['reserved'] == 0
+    assert stats['rejected'] == 1
+    app.tasks.stop()
+
+
+def test_start_keeps_reservations():
+    tasks = TaskQueue(workers=1)
+    tasks.reserve()
+    # The first `put` starts the threads
+    tasks.put(tasks.make_task(record, (1,)))
+    assert tasks.stats()['reserved'] == 1
+    tasks.put(tasks.make_task(record, (2,)), reserved=True)
+    assert tasks.stats()['reserved'] == 0
+    assert tasks.join(5)
+    tasks.stop()
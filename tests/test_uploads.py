@@ -0,0 +1,100 @@
+# coding=utf-8
+import hashlib
+from io import BytesIO
+import os
+
+from werkzeug.test import EnvironBuilder
+from shake import Shake, Rule, Request, UploadedFile
+
+
+HTTP_OK = 200
+HTTP_TOO_LARGE = 413
+
+
+def get_data(size):
+    # Binary data, with newlines and a few things that look like boundaries
+    data = os.urandom(size // 2) + b'\r\n--\r\n\r\n' + os.urandom(size // 2)
+    return data.replace(b'\n', b'') + b'\r\n\r\n--'
+
+
+def make_request(data, **kwargs):
+    builder = EnvironBuilder('/', method='POST', data=data)
+    env = builder.get_environ()
+    builder.close()
+    request = Request(env, **kwargs)
+    request.max_content_length = None
+    request.max_form_memory_size = None
+    return request
+
+
+def test_parse():
+    content = get_data(10000)
+    request = make_request({
+        'a': u'ñandú',
+        'b': 'x' * 5000,
+        'file': (BytesIO(content), u'ñ.bin'),
+        'empty': (BytesIO(b''), 'empty.txt'),
+    })
+    request.upload_chunk_size = 1024
+    request.upload_hash = 'sha1'
+
+    assert request.form['a'] == u'ñandú'
+    assert request.form['b'] == 'x' * 5000
+    upload = request.files['file']
+    assert isinstance(upload, UploadedFile)
+    assert upload.filename == u'ñ.bin'
+    assert upload.read() == content
+    assert upload.size == len(content)
+    assert upload.hash == hashlib.sha1(content).hexdigest()
+    empty = request.files['empty']
+    assert empty.read() == b''
+    assert empty.size == 0
+
+
+def test_sink():
+    content = get_data(300000)
+    chunks = []
+
+    class Sink(object):
+        def write(self, data):
+            chunks.append(data)
+
+    request = make_request({'file': (BytesIO(content), 'big.bin')})
+    request.upload_chunk_size = 4096
+    request.upload_sink = lambda filename, content_type, length: Sink()
+
+    assert request.files['file'].size == len(content)
+    assert b''.join(chunks) == content
+    assert max(len(chunk) for chunk in chunks) <= 4096 * 2
+
+
+def test_temp_file():
+    request = make_request({'file': (BytesIO(b'a' * 600000), 'big.bin')})
+    stream = request.files['file'].stream
+    assert not isinstance(stream, BytesIO)
+    assert stream.read() == b'a' * 600000
+
+    request = make_request({'file': (BytesIO(b'a' * 1000), 'small.bin')})
+    assert isinstance(request.files['file'].stream, BytesIO)
+
+
+def test_rule_limits():
+    settings = {'UPLOAD_MAX_FILE_SIZE': 100, 'DEBUG': False}
+    app = Shake(__file__, settings)
+
+    def upload(request):
+        return str(request.files['file'].size)
+
+    app.add_urls([
+        Rule('/', upload),
+        Rule('/big/', upload, max_file_size=1000),
+        Rule('/small/', upload, max_content_length=100),
+    ])
+    c = app.test_client()
+
+    data = lambda size: {'file': (BytesIO(b'a' * size), 'a.txt')}
+    assert c.post('/', data=data(100)).data == '100'
+    assert c.post('/', data=data(101)).status_code == HTTP_TOO_LARGE
+    assert c.post('/big/', data=data(1000)).data == '1000'
+    assert c.post('/big/', data=data(1001)).status_code == HTTP_TOO_LARGE
+    assert c.post('/small/', data=data(50)).status_code == HTTP_TOO_LARGE
@@ -3,8 +3,9 @@ import os
 
 import pytest
 from shake import Shake, Rule, Render, Forbidden
+from shake.helpers import FileInfoCache
 from shake.views import (not_found_page, error_page, not_allowed_page,
-    render_template)
+    render_template, send_from_directory, CachedErrorPage, FALLBACK_ERROR_PAGE)
 
 
 HTTP_OK = 200
@@ -102,3 +103,122 @@ def test_render_template_view_args():
     assert resp.data == 'You are here'
     assert resp.mimetype == 'foo/bar'
 
+
+
+def test_send_from_directory(tmpdir):
+    settings = {'DEBUG': False}
+    app = Shake(__file__, settings)
+    cache = FileInfoCache(ttl=60)
+    path = tmpdir.join('hello.txt')
+    path.write('hello')
+
+    def view(request, filename):
+        return send_from_directory(request, str(tmpdir), filename,
+            cache=cache)
+
+    app.add_url('/<path:filename>', view)
+    c = app.test_client()
+
+    resp = c.get('/hello.txt')
+    assert resp.status_code == HTTP_OK
+    assert resp.data == 'hello'
+    assert resp.mimetype == 'text/plain'
+    etag = resp.headers['ETag']
+    info = cache.get(os.path.join(str(tmpdir), 'hello.txt'))
+    assert etag == '"%s"' % info.etag
+
+    # Served from the cache
+    assert c.get('/hello.txt', headers={'If-None-Match': etag}).status_code == 304
+
+    # The cached stat doesn't match the opened file
+    path.write('hello world')
+    resp = c.get('/hello.txt')
+    assert resp.data == 'hello world'
+    assert resp.headers['Content-Length'] == '11'
+    new_etag = resp.headers['ETag']
+    assert new_etag != etag
+    # ...so the entry is dropped
+    info = cache.get(os.path.join(str(tmpdir), 'hello.txt'))
+    assert new_etag == '"%s"' % info.etag
+    assert c.get('/hello.txt', headers={'If-None-Match': etag}).status_code == HTTP_OK
+
+    assert c.get('/missing.txt').status_code == HTTP_NOT_FOUND
+    tmpdir.mkdir('dir')
+    assert c.get('/dir').status_code == HTTP_NOT_FOUND
+
+
+def test_not_found_rules_only_in_debug():
+    app = Shake(__file__, {'DEBUG': True})
+    app.add_url('/secret-admin/', index)
+    c = app.test_client()
+    resp = c.get('/bla')
+    assert resp.status_code == HTTP_NOT_FOUND
+    assert '/secret-admin/' in resp.data
+
+    app = Shake(__file__, {'DEBUG': False})
+    app.add_url('/secret-admin/', index)
+    c = app.test_client()
+    resp = c.get('/bla?<script>')
+    assert resp.status_code == HTTP_NOT_FOUND
+    assert '<title>Page not found</title>' in resp.data
+    assert '/secret-admin/' not in resp.data
+    assert '/bla' not in resp.data
+
+
+def test_cached_error_page():
+    calls = []
+
+    class CountingRender(Render):
+        def render(self, tmpl, *args, **kwargs):
+            calls.append(tmpl.name)
+            return Render.render(self, tmpl, *args, **kwargs)
+
+    page = CachedErrorPage('tmpl.html', render=CountingRender(templates_dir),
+        max_renders=2, period=60)
+    app = Shake(__file__, {'DEBUG': False, 'PAGE_NOT_FOUND': page})
+    c = app.test_client()
+    for _ in range(5):
+        resp = c.get('/bla')
+        assert resp.status_code == HTTP_NOT_FOUND
+        assert resp.data == '<h1>Hello World</h1>'
+        assert resp.mimetype == 'text/html'
+    assert calls == ['tmpl.html']
+
+    # Over the rate limit
+    page.clear()
+    page.per_locale = False
+    assert c.get('/bla').data == '<h1>Hello World</h1>'
+    page.clear()
+    resp = c.get('/bla')
+    assert resp.status_code == HTTP_NOT_FOUND
+    assert resp.data == FALLBACK_ERROR_PAGE
+    assert len(resp.data) > 512
+
+
+def test_cached_error_page_failure():
+    page = CachedErrorPage('missing.html', render=render)
+    app = Shake(__file__, {'DEBUG': False, 'PAGE_ERROR': page})
+    app.add_url('/', fail)
+    c = app.test_client()
+    resp = c.get('/')
+    assert resp.status_code == HTTP_ERROR
+    assert resp.data == FALLBACK_ERROR_PAGE
+
+
+def test_cached_error_page_per_app():
+    from jinja2 import DictLoader
+
+    page = CachedErrorPage('page.html', max_renders=1, period=60)
+    app1 = Shake(__file__, {'DEBUG': False, 'PAGE_NOT_FOUND': page})
+    app1.render = Render(loader=DictLoader({'page.html': u'app1'}))
+    app2 = Shake(__file__, {'DEBUG': False, 'PAGE_NOT_FOUND': page})
+    app2.render = Render(loader=DictLoader({'page.html': u'app2'}))
+
+    c1 = app1.test_client()
+    c2 = app2.test_client()
+    assert c1.get('/bla').data == 'app1'
+    # app1 has used its only render, but app2 has its own budget and cache
+    assert c2.get('/bla').data == 'app2'
+    assert c1.get('/bla').data == 'app1'
+    page.clear()
+    assert c1.get('/bla').data == FALLBACK_ERROR_PAGE